@@ -0,0 +1,69 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:  # optional: only .gz siblings are written then
+    brotli = None
+
+# Asset pipeline for /static: copies every top-level file of the static directory to
+# dist/<name>.<hash>.<ext>, with .gz and .br siblings for text files, and writes dist/manifest.json
+# mapping "/static/<name>" to the fingerprinted URL. References between assets (the background image
+# in styles.css) are rewritten first, so a fingerprint changes whenever anything it points to changes.
+# The app runs this at startup; it can also run as a deploy step: python assets.py [static-dir]
+
+DIST_DIR = "dist"
+COMPRESSIBLE = (".css", ".js", ".json", ".svg", ".txt", ".html", ".ico")
+ASSET_URL_RE = re.compile(r"/static/[\w.\-/]+")
+
+def rewrite_urls(text: str, manifest: dict) -> str:
+    return ASSET_URL_RE.sub(lambda match: manifest.get(match.group(0), match.group(0)), text)
+
+def _write(path: str, data: bytes):
+    # Fingerprinted names never change content, so an existing file is already right
+    if os.path.exists(path):
+        return
+    part = f"{path}.{os.getpid()}.part"
+    with open(part, "wb") as f:
+        f.write(data)
+    os.replace(part, path)
+
+def build(static_dir: str = "static") -> dict:
+    dist = os.path.join(static_dir, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    names = sorted(
+        name for name in os.listdir(static_dir)
+        if os.path.isfile(os.path.join(static_dir, name)) and not name.startswith(".")
+    )
+    # Files that can point at other assets go last, once what they point at has its final name
+    names.sort(key=lambda name: name.endswith((".css", ".js", ".html")))
+
+    manifest = {}
+    for name in names:
+        with open(os.path.join(static_dir, name), "rb") as f:
+            data = f.read()
+        if name.endswith((".css", ".js", ".html")):
+            data = rewrite_urls(data.decode("utf-8"), manifest).encode("utf-8")
+        stem, extension = os.path.splitext(name)
+        fingerprinted = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+        target = os.path.join(dist, fingerprinted)
+        _write(target, data)
+        if extension in COMPRESSIBLE:
+            _write(target + ".gz", gzip.compress(data, 9))
+            if brotli is not None:
+                _write(target + ".br", brotli.compress(data, quality=11))
+        manifest[f"/static/{name}"] = f"/static/{DIST_DIR}/{fingerprinted}"
+
+    part = os.path.join(dist, f"manifest.json.{os.getpid()}.part")
+    with open(part, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(part, os.path.join(dist, "manifest.json"))
+    return manifest
+
+if __name__ == "__main__":
+    for source, target in build(sys.argv[1] if len(sys.argv) > 1 else "static").items():
+        print(f"{source} -> {target}")
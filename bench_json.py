@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute, serialize_response
+
+# Importing main runs the migrations; keep them off the local chat.db
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+import main
+
+# Serialization cost of a message history page: what FastAPI does with a returned list of dicts
+# (validate every row against the route's response_model, dump it back out, json.dumps) against the
+# ORJSONResponse the list endpoints now return. No database or HTTP involved, only the encoding.
+#
+#   python bench_json.py [messages] [rounds]      (defaults: 10000 messages, 20 rounds)
+
+def history_rows(count):
+    # The dicts history_response builds: a handful of senders, some messages with attachments
+    return [
+        {
+            "id": n,
+            "content": f"Сообщение номер {n}, немного текста для реалистичного размера",
+            "timestamp": "2024-05-01T12:34:56.789012",
+            "sender_id": n % 7 + 1,
+            "receiver_id": None,
+            "group_id": 1,
+            "is_read": n % 3 == 0,
+            "files": [{"file_url": f"/static/uploads/{n:064x}.jpg", "file_type": "image", "file_name": "photo.jpg"}]
+                     if n % 10 == 0 else [],
+            "username": f"user{n % 7 + 1}",
+            "avatar_url": f"/static/avatars/{n % 7:064x}.png",
+        }
+        for n in range(count)
+    ]
+
+def route_field(path):
+    for route in main.app.routes:
+        if isinstance(route, APIRoute) and route.path == path:
+            return route.response_field
+    raise LookupError(path)
+
+def measure(label, encode, rounds):
+    size = len(encode())
+    started = time.perf_counter()
+    for _ in range(rounds):
+        encode()
+    per_call = (time.perf_counter() - started) / rounds
+    print(f"  {label:<34} {per_call * 1000:8.1f} ms/page  {size:10d} bytes")
+    return per_call
+
+def bench_json():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rows = history_rows(count)
+    field = route_field("/messages/group/{group_id}")
+
+    def through_response_model():
+        content = asyncio.run(serialize_response(field=field, response_content=rows))
+        return JSONResponse(content).body
+
+    # Same bytes either way, so the clients see no difference
+    assert through_response_model() == main.ORJSONResponse(rows).body
+    print(f"{count} messages per page, {rounds} rounds")
+    before = measure("response_model + JSONResponse", through_response_model, rounds)
+    after = measure("ORJSONResponse", lambda: main.ORJSONResponse(rows).body, rounds)
+    print(f"  {before / after:.1f}x faster")
+
+if __name__ == "__main__":
+    bench_json()
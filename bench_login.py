@@ -0,0 +1,40 @@
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import passwords
+
+# Login throughput of the password pool: bcrypt verifications per second for pool sizes from 1 up to
+# the number of cores, with the same process pool setup the app uses. Throughput should grow roughly
+# linearly with the pool size until the cores run out.
+
+def bench_login():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("BCRYPT_ROUNDS", "12"))
+    cores = os.cpu_count() or 1
+    hashed = passwords.hash_password("correct horse battery staple", rounds)
+    print(f"bcrypt cost {rounds}, {cores} cores")
+
+    sizes = sorted({1, 2, cores // 2, cores} - {0})
+    baseline = None
+    for size in sizes:
+        if size > cores:
+            continue
+        logins = 8 * size
+        with ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # Warm the workers up so process start-up is not part of the measurement
+            list(pool.map(passwords.verify_and_update, ["x"] * size, [hashed] * size, [rounds] * size))
+            started = time.perf_counter()
+            results = list(pool.map(
+                passwords.verify_and_update,
+                ["correct horse battery staple"] * logins, [hashed] * logins, [rounds] * logins
+            ))
+            elapsed = time.perf_counter() - started
+        assert all(valid for valid, _ in results)
+        rate = logins / elapsed
+        baseline = baseline or rate
+        print(f"pool of {size:>3}: {rate:8.1f} logins/s  ({rate / baseline:.1f}x)")
+
+if __name__ == "__main__":
+    bench_login()
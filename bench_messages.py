@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+import main  # only for access tokens; the server runs in its own process
+
+# Chat message throughput under many concurrent senders: every user holds a WebSocket and sends
+# messages to a partner, each waiting for its own echo before sending the next. Runs once with the
+# group-commit writer as configured and once with MESSAGE_BATCH_SIZE=1 (a commit per message, as
+# before the writer) for comparison.
+#
+#   python bench_messages.py [senders] [messages-per-sender]      (defaults: 1000 senders, 20 messages)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(env, port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/favicon.ico", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def create_users(db_path, count):
+    # Straight into the database: the WebSocket endpoint only needs the rows, and signing up a thousand
+    # users through bcrypt would take longer than the benchmark
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executemany(
+        "INSERT INTO users (username, email, hashed_password) VALUES (?, ?, 'x')",
+        [(f"bench{i}", f"bench{i}@example.com") for i in range(count)]
+    )
+    conn.commit()
+    ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+    conn.close()
+    return ids
+
+async def sender(port, user_id, partner_id, messages, latencies, connected, go):
+    token = main.create_access_token({"sub": str(user_id)})
+    url = f"ws://127.0.0.1:{port}/ws/{user_id}?token={token}"
+    async with websockets.connect(url, max_queue=None, open_timeout=60) as ws:
+        connected()
+        await go.wait()
+        for n in range(messages):
+            content = f"{user_id}:{n}"
+            started = time.perf_counter()
+            await ws.send(json.dumps({"receiver_id": partner_id, "content": content}))
+            # Frames from the partner arrive in between; wait for our own echo
+            while True:
+                frame = json.loads(await ws.recv())
+                if frame.get("sender_id") == user_id and frame.get("content") == content:
+                    break
+            latencies.append(time.perf_counter() - started)
+
+async def run_clients(port, ids, messages):
+    latencies = []
+    go = asyncio.Event()
+    ready = 0
+
+    def connected():
+        nonlocal ready
+        ready += 1
+        if ready == len(ids):
+            go.set()
+
+    # Pairs of users write to each other
+    tasks = [
+        asyncio.create_task(sender(port, user_id, ids[i ^ 1] if (i ^ 1) < len(ids) else ids[0], messages, latencies, connected, go))
+        for i, user_id in enumerate(ids)
+    ]
+    await go.wait()
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def run(label, senders, messages, extra_env):
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ, DB_PATH=os.path.join(directory, "bench.db"), **extra_env)
+    port = free_port()
+    server = start_server(env, port)
+    try:
+        ids = create_users(env["DB_PATH"], senders)
+        rate, median, p99 = asyncio.run(run_clients(port, ids, messages))
+    finally:
+        server.kill()
+    print(f"{label:<28} {rate:8.0f} messages/s   median {median * 1000:6.1f} ms   p99 {p99 * 1000:6.1f} ms")
+
+def bench_messages():
+    senders = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print(f"{senders} concurrent senders, {messages} messages each")
+    run("commit per message", senders, messages, {"MESSAGE_BATCH_SIZE": "1", "MESSAGE_BATCH_DELAY_MS": "0"})
+    run("group commit", senders, messages, {})
+
+if __name__ == "__main__":
+    bench_messages()
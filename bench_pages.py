@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# Requests per second for the HTML entry points. Runs against this tree and, when a git ref is given,
+# against that ref too (checked out into a temporary worktree), so the page cache can be compared with
+# the code before it:
+#
+#   python bench_pages.py [baseline-ref] [seconds] [connections]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(directory, port):
+    env = dict(os.environ, DB_PATH=os.path.join(tempfile.mkdtemp(), "bench.db"))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=directory,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/favicon.ico", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server in {directory} did not start")
+
+def get_token(port):
+    body = json.dumps({"username": "bench", "email": "bench@example.com", "password": "secret123"}).encode()
+    urllib.request.urlopen(urllib.request.Request(
+        f"http://127.0.0.1:{port}/signup", data=body, headers={"Content-Type": "application/json"}
+    ))
+    form = b"username=bench&password=secret123"
+    return json.load(urllib.request.urlopen(f"http://127.0.0.1:{port}/token", data=form))["access_token"]
+
+async def fetch(reader, writer, request):
+    # One request on a keep-alive connection; returns (status, headers, body length)
+    writer.write(request)
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    if length:
+        await reader.readexactly(length)
+    return int(lines[0].split()[1]), headers, length
+
+async def load(port, path, headers, seconds, connections):
+    request = f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n{headers}\r\n".encode()
+    done = 0
+    transferred = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client():
+        nonlocal done, transferred
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while time.perf_counter() < deadline:
+            _, _, length = await fetch(reader, writer, request)
+            done += 1
+            transferred += length
+        writer.close()
+
+    await asyncio.gather(*[client() for _ in range(connections)])
+    return done / seconds, transferred / max(done, 1)
+
+async def scenarios(port, token, seconds, connections):
+    auth = f"Authorization: Bearer {token}\r\n"
+    compressed = "Accept-Encoding: gzip, br\r\n"
+    # The ETag the server hands out for /chat, for the revalidation case; none before the page cache
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = f"GET /chat HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n{auth}{compressed}\r\n".encode()
+    _, headers, _ = await fetch(reader, writer, request)
+    writer.close()
+    etag = headers.get("etag")
+
+    cases = [
+        ("/ (signin)", "/", ""),
+        ("/chat", "/chat", auth),
+        ("/chat, gzip/br accepted", "/chat", auth + compressed),
+    ]
+    if etag:
+        cases.append(("/chat, revalidated (304)", "/chat", auth + compressed + f"If-None-Match: {etag}\r\n"))
+    results = []
+    for name, path, headers in cases:
+        rate, size = await load(port, path, headers, seconds, connections)
+        results.append((name, rate, size))
+    return results
+
+def run(directory, seconds, connections):
+    port = free_port()
+    server = start_server(directory, port)
+    try:
+        token = get_token(port)
+        return asyncio.run(scenarios(port, token, seconds, connections))
+    finally:
+        server.kill()
+
+def bench_pages():
+    baseline = sys.argv[1] if len(sys.argv) > 1 else None
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    connections = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    runs = [("this tree", here)]
+    worktree = None
+    if baseline:
+        worktree = tempfile.mkdtemp()
+        subprocess.run(["git", "worktree", "add", "--detach", worktree, baseline], cwd=here, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        runs.insert(0, (baseline, worktree))
+    try:
+        for label, directory in runs:
+            print(f"{label}: {connections} connections, {seconds:g} s per case")
+            for name, rate, size in run(directory, seconds, connections):
+                print(f"  {name:<28} {rate:8.0f} req/s  {size:8.0f} bytes/response")
+    finally:
+        if worktree:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=here, stdout=subprocess.DEVNULL)
+            shutil.rmtree(worktree, ignore_errors=True)
+
+if __name__ == "__main__":
+    bench_pages()
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# Concurrency benchmark for /upload-file: starts a server on a scratch database, uploads many large
+# video files at once and reports per-upload latency and total throughput. While it runs, the server
+# keeps answering a cheap request; its worst latency shows whether uploads hold up the event loop.
+#
+#   python bench_upload.py [uploads] [megabytes]      (defaults: 20 uploads of 100 MB)
+
+CHUNK = 1024 * 1024
+BOUNDARY = "----bench-upload-boundary"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(env, port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/favicon.ico", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def get_token(port):
+    body = json.dumps({"username": "bench", "email": "bench@example.com", "password": "secret123"}).encode()
+    urllib.request.urlopen(urllib.request.Request(
+        f"http://127.0.0.1:{port}/signup", data=body, headers={"Content-Type": "application/json"}
+    ))
+    form = b"username=bench&password=secret123"
+    return json.load(urllib.request.urlopen(f"http://127.0.0.1:{port}/token", data=form))["access_token"]
+
+async def upload(port, token, index, size):
+    head = (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="bench{index}.mp4"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{BOUNDARY}--\r\n".encode()
+    # An MP4 "ftyp" box up front so the content check passes, then filler
+    payload_head = b"\x00\x00\x00\x18ftypmp42" + bytes(CHUNK - 12)
+    filler = bytes(CHUNK)
+
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write((
+        "POST /upload-file HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{port}\r\n"
+        f"Authorization: Bearer {token}\r\n"
+        f"Content-Type: multipart/form-data; boundary={BOUNDARY}\r\n"
+        f"Content-Length: {len(head) + size + len(tail)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode() + head)
+    for offset in range(0, size, CHUNK):
+        writer.write((payload_head if offset == 0 else filler)[:size - offset])
+        await writer.drain()
+    writer.write(tail)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status = int(response.split(b" ", 2)[1])
+    body = json.loads(response.split(b"\r\n\r\n", 1)[1] or b"{}")
+    return status, body, time.perf_counter() - started
+
+async def probe(port, stop):
+    # Latency of a request that does no work, sampled while the uploads run
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /favicon.ico HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        await reader.read()
+        writer.close()
+        worst = max(worst, time.perf_counter() - started)
+        await asyncio.sleep(0.05)
+    return worst
+
+async def run(port, token, uploads, size):
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(port, stop))
+    started = time.perf_counter()
+    results = await asyncio.gather(*[upload(port, token, index, size) for index in range(uploads)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    worst_probe = await prober
+    return results, elapsed, worst_probe
+
+def bench_upload():
+    uploads = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    size = megabytes * 1024 * 1024
+
+    env = dict(os.environ, DB_PATH=os.path.join(tempfile.mkdtemp(), "bench.db"))
+    port = free_port()
+    server = start_server(env, port)
+    try:
+        token = get_token(port)
+        results, elapsed, worst_probe = asyncio.run(run(port, token, uploads, size))
+    finally:
+        server.kill()
+
+    failed = [status for status, _, _ in results if status != 200]
+    latencies = sorted(seconds for _, _, seconds in results)
+    for status, body, _ in results:
+        if status == 200:
+            os.remove(body["file_url"].lstrip("/"))
+    print(f"{uploads} concurrent uploads of {megabytes} MB, {len(failed)} failed")
+    print(f"total {uploads * megabytes / elapsed:.1f} MB/s over {elapsed:.1f} s")
+    print(f"per upload: fastest {latencies[0]:.1f} s, median {latencies[len(latencies) // 2]:.1f} s, slowest {latencies[-1]:.1f} s")
+    print(f"worst latency of other requests meanwhile: {worst_probe * 1000:.0f} ms")
+
+if __name__ == "__main__":
+    bench_upload()
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+
+# Busy group chat over WebSockets: every member of one group is connected, a few of them send a burst
+# of messages, and each member has to receive all of them. Runs the server the way `python run.py`
+# does (with TunedWebSocketProtocol) under several WS_* settings and reports what /admin/ws-stats
+# counted: frames and bytes on the wire per delivered event, plus delivery time and latency. Every
+# message also sends each member a conversation_updated event for the chat list; its frames and bytes
+# are counted against the message.
+#
+#   python bench_ws.py [members] [senders] [messages-per-sender]      (defaults: 50 members, 5 senders, 200 messages)
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+import main
+import wire
+
+SETUPS = [
+    ("json, no deflate", {"WS_DEFLATE": "0"}, False, False),
+    ("json, deflate", {}, False, False),
+    ("msgpack, deflate", {}, True, False),
+    ("msgpack, deflate, 10 ms batches", {"WS_COALESCE_MS": "10"}, True, True),
+    ("msgpack, deflate 9 bits, memLevel 1", {"WS_DEFLATE_SERVER_WINDOW_BITS": "9", "WS_DEFLATE_MEM_LEVEL": "1"}, True, False),
+]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(env, port):
+    process = subprocess.Popen(
+        [sys.executable, "-c",
+         "import uvicorn, main, ws_protocol; uvicorn.run(main.app, host='127.0.0.1', port=%d, "
+         "log_level='warning', ws=ws_protocol.TunedWebSocketProtocol)" % port],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/favicon.ico", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def create_group(db_path, members):
+    # Straight into the database, like bench_messages.py; the first user is the admin reading the stats
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executemany(
+        "INSERT INTO users (username, email, hashed_password, is_admin) VALUES (?, ?, 'x', ?)",
+        [(f"bench{i}", f"bench{i}@example.com", int(i == 0)) for i in range(members)]
+    )
+    ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+    group_id = conn.execute(
+        "INSERT INTO groups (name, creator_id, created_at) VALUES ('bench', ?, '2024-01-01T00:00:00')", (ids[0],)
+    ).lastrowid
+    conn.executemany("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)", [(group_id, i) for i in ids])
+    conn.commit()
+    conn.close()
+    return ids, group_id
+
+def ws_stats(port, user_id):
+    token = main.create_access_token({"sub": str(user_id)})
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/admin/ws-stats", headers={"Authorization": f"Bearer {token}"})
+    return json.load(urllib.request.urlopen(request))
+
+def decode(frame):
+    events = wire.unpack(frame) if isinstance(frame, bytes) else json.loads(frame)
+    return events if isinstance(events, list) else [events]
+
+async def member(port, user_id, binary, batch, expected, latencies, connected, go):
+    url = f"ws://127.0.0.1:{port}/ws/{user_id}?token={main.create_access_token({'sub': str(user_id)})}"
+    url += "&batch=1" if batch else ""
+    subprotocols = [wire.SUBPROTOCOL] if binary else None
+    async with websockets.connect(url, subprotocols=subprotocols, max_queue=None, open_timeout=60) as ws:
+        connected()
+        await go.wait()
+        received = 0
+        while received < expected:
+            for event in decode(await ws.recv()):
+                if event.get("action"):
+                    continue  # pings
+                received += 1
+                latencies.append(time.time() - float(event["content"].split()[1]))
+        return ws
+
+async def sender(ws, group_id, messages, binary):
+    for n in range(messages):
+        message = {"group_id": group_id, "content": f"{n} {time.time()!r}"}
+        await ws.send(wire.pack(message) if binary else json.dumps(message))
+        if n % 10 == 9:
+            await asyncio.sleep(0.005)  # a steady stream rather than one write burst
+
+async def run_clients(port, ids, group_id, senders, messages, binary, batch):
+    latencies = []
+    go = asyncio.Event()
+    ready = 0
+
+    def connected():
+        nonlocal ready
+        ready += 1
+        if ready == len(ids):
+            go.set()
+
+    # Senders use separate sessions so their own echoes don't interfere with the counting
+    sender_sockets = [
+        await websockets.connect(
+            f"ws://127.0.0.1:{port}/ws/{user_id}?token={main.create_access_token({'sub': str(user_id)})}",
+            subprotocols=[wire.SUBPROTOCOL] if binary else None
+        )
+        for user_id in ids[:senders]
+    ]
+    expected = senders * messages
+    tasks = [
+        asyncio.create_task(member(port, user_id, binary, batch, expected, latencies, connected, go))
+        for user_id in ids
+    ]
+    await go.wait()
+    before = await asyncio.to_thread(ws_stats, port, ids[0])
+    started = time.perf_counter()
+    await asyncio.gather(*[sender(ws, group_id, messages, binary) for ws in sender_sockets])
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    after = await asyncio.to_thread(ws_stats, port, ids[0])
+    for ws in sender_sockets:
+        await ws.close()
+    latencies.sort()
+    return before, after, elapsed, latencies
+
+def run(label, extra_env, binary, batch, members, senders, messages):
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ, DB_PATH=os.path.join(directory, "bench.db"), **extra_env)
+    port = free_port()
+    server = start_server(env, port)
+    try:
+        ids, group_id = create_group(env["DB_PATH"], members)
+        before, after, elapsed, latencies = asyncio.run(
+            run_clients(port, ids, group_id, senders, messages, binary, batch)
+        )
+    finally:
+        server.kill()
+    # Senders' own sessions receive the group messages too
+    delivered = (members + senders) * senders * messages
+    frames = after["frames"] - before["frames"]
+    wire_bytes = after["wire_bytes"] - before["wire_bytes"]
+    payload = after["payload_bytes"] - before["payload_bytes"]
+    print(f"{label:<38} {frames / delivered:5.2f} frames/event  {wire_bytes / delivered:6.1f} B/event on the wire "
+          f"({payload / delivered:6.1f} B payload)  {frames / elapsed:7.0f} frames/s  "
+          f"median {latencies[len(latencies) // 2] * 1000:6.1f} ms  p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.1f} ms")
+
+def bench_ws():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    senders = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    print(f"{members} members, {senders} senders, {messages} messages each")
+    for label, extra_env, binary, batch in SETUPS:
+        run(label, extra_env, binary, batch, members, senders, messages)
+
+if __name__ == "__main__":
+    bench_ws()
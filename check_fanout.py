@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+
+# Multi-worker check for the Unix-socket message bus: starts separate uvicorn processes on one
+# database, connects users to different processes and checks that messages cross between them,
+# including after the process hosting the broker is killed.
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_worker(env, port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/favicon.ico", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Worker on port {port} did not start")
+
+def signup(port, username):
+    # Returns (user id, access token)
+    body = json.dumps({"username": username, "email": f"{username}@example.com", "password": "secret123"}).encode()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/signup", data=body, headers={"Content-Type": "application/json"}
+    )
+    urllib.request.urlopen(request)
+    form = f"username={username}&password=secret123".encode()
+    token = json.load(urllib.request.urlopen(f"http://127.0.0.1:{port}/token", data=form))["access_token"]
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/users/me", headers={"Authorization": f"Bearer {token}"})
+    return json.load(urllib.request.urlopen(request))["id"], token
+
+async def expect_message(ws, content):
+    # Presence and chat list events can come first
+    frame = {"action": None}
+    while "action" in frame:
+        frame = json.loads(await asyncio.wait_for(ws.recv(), timeout=5))
+    if frame.get("content") != content:
+        raise AssertionError(f"Expected {content!r}, got {frame}")
+
+async def exchange(sender_port, sender_user, receiver_port, receiver_user, content):
+    (sender_id, sender_token), (receiver_id, receiver_token) = sender_user, receiver_user
+    async with websockets.connect(f"ws://127.0.0.1:{receiver_port}/ws/{receiver_id}?token={receiver_token}") as receiver, \
+            websockets.connect(f"ws://127.0.0.1:{sender_port}/ws/{sender_id}?token={sender_token}") as sender:
+        # Give the subscriptions a moment to reach the broker
+        await asyncio.sleep(0.3)
+        await sender.send(json.dumps({"receiver_id": receiver_id, "content": content}))
+        await expect_message(sender, content)
+        await expect_message(receiver, content)
+
+def check_fanout():
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ, DB_PATH=os.path.join(directory, "chat.db"), BUS_BACKEND="unix")
+    ports = [free_port() for _ in range(3)]
+    workers = []
+    try:
+        workers.append(start_worker(env, ports[0]))
+        workers.append(start_worker(env, ports[1]))
+        alice = signup(ports[0], "alice")
+        bob = signup(ports[1], "bob")
+
+        asyncio.run(exchange(ports[0], alice, ports[1], bob, "from worker 1 to worker 2"))
+        asyncio.run(exchange(ports[1], bob, ports[0], alice, "from worker 2 to worker 1"))
+        print("Messages cross between workers")
+
+        # The first worker hosts the broker; once it is gone another worker has to take over
+        workers[0].kill()
+        workers[0].wait()
+        workers.append(start_worker(env, ports[2]))
+        time.sleep(0.5)
+        asyncio.run(exchange(ports[1], bob, ports[2], alice, "after the broker moved"))
+        print("Messages cross between workers after the broker worker exited")
+    finally:
+        for worker in workers:
+            worker.kill()
+
+if __name__ == "__main__":
+    check_fanout()
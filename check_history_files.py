@@ -0,0 +1,77 @@
+import asyncio
+import glob
+import io
+import json
+import os
+import tempfile
+
+from fastapi.routing import APIRoute, serialize_response
+from fastapi.testclient import TestClient
+from PIL import Image
+
+# Importing main runs the migrations; keep them off the local chat.db
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "check.db"))
+import main
+
+# Message history with an uploaded image, whose file entry carries the nested thumbnails dict and the
+# placeholder, checked against the response models of the history routes (the list and the compact
+# page, private and group). The endpoints answer with ORJSONResponse and skip validation, so this runs
+# FastAPI's own response validation on what they return.
+#
+#   python check_history_files.py
+
+HISTORY_ROUTES = ("/messages/{receiver_id}", "/messages/group/{group_id}")
+
+def route_field(path):
+    for route in main.app.routes:
+        if isinstance(route, APIRoute) and route.path == path:
+            return route.response_field
+    raise LookupError(path)
+
+def signup(client, username):
+    client.post("/signup", json={"username": username, "email": f"{username}@example.com", "password": "secret123"})
+    token = client.post("/token", data={"username": username, "password": "secret123"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    return client.get("/users/me", headers=headers).json()["id"], token, headers
+
+def noise_jpeg():
+    # Random pixels, so the blob is new on every run and the pool really makes its variants
+    buffer = io.BytesIO()
+    Image.effect_noise((1200, 900), 64).convert("RGB").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def check_history_files():
+    with TestClient(main.app) as client:
+        alice, alice_token, alice_headers = signup(client, "alice")
+        bob, _, bob_headers = signup(client, "bob")
+        group_id = client.post(
+            "/groups", data={"name": "check", "member_ids": json.dumps([bob])}, headers=alice_headers
+        ).json()["group_id"]
+        attachment = client.post(
+            "/upload-file", files={"file": ("photo.jpg", noise_jpeg(), "image/jpeg")}, headers=alice_headers
+        ).json()
+        try:
+            assert attachment.get("thumbnails") and attachment.get("placeholder"), attachment
+
+            with client.websocket_connect(f"/ws/{alice}?token={alice_token}") as ws:
+                for target in ({"receiver_id": bob}, {"group_id": group_id}):
+                    ws.send_text(json.dumps({**target, "content": None, "files": [attachment]}))
+                    while "id" not in ws.receive_json():
+                        pass
+
+            for path, url in zip(HISTORY_ROUTES, (f"/messages/{alice}", f"/messages/group/{group_id}")):
+                for compact in (False, True):
+                    response = client.get(url, params={"compact": compact}, headers=bob_headers)
+                    assert response.status_code == 200, response.text
+                    content = asyncio.run(serialize_response(field=route_field(path), response_content=response.json()))
+                    messages = content["messages"] if compact else content
+                    assert messages[-1]["files"][0]["thumbnails"] == attachment["thumbnails"], messages[-1]
+                    print(f"{url}?compact={str(compact).lower()}: matches the response model")
+        finally:
+            stem = os.path.splitext(attachment["file_url"].lstrip("/"))[0]
+            for path in glob.glob(stem + ".*"):
+                os.remove(path)
+    print("History with thumbnailed images fits the response models")
+
+if __name__ == "__main__":
+    check_history_files()
@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+def check_query_plans():
+    if len(sys.argv) > 2:
+        print("Usage: python check_query_plans.py [path/to/chat.db]")
+        sys.exit(1)
+
+    # Without an argument the check runs against a fresh database built by the migrations,
+    # so it verifies the schema itself rather than whatever data happens to be local
+    if len(sys.argv) == 2:
+        os.environ["DB_PATH"] = sys.argv[1]
+    else:
+        os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "plan-check.db")
+
+    import main
+
+    with main.get_db() as conn:
+        problems = main.check_query_plans(conn)
+
+    if problems:
+        print("Hot queries falling back to a full scan:")
+        for problem in problems:
+            print(f"  {problem}")
+        sys.exit(1)
+
+    print(f"All {len(main.HOT_QUERIES)} hot queries use indexes")
+
+if __name__ == "__main__":
+    check_query_plans()
@@ -1,31 +1,119 @@
+import asyncio
+import multiprocessing
+import queue
 import sqlite3
+import threading
+import time
 import uuid
-from fastapi import FastAPI, WebSocket, HTTPException, Depends, status, Request, File, UploadFile, Form, Query
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, status, Request, File, UploadFile, Form, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, Response, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import List, Dict
 from pydantic import BaseModel
+import glob
+import gzip
+import hashlib
 import json
+import mimetypes
 import os
+import re
+import sys
 import shutil
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 import requests
+import passwords
+import media
+import assets
+import wire
+from python_multipart.multipart import MultipartParser, parse_options_header
+try:
+    import brotli
+except ImportError:  # optional: pages are then offered with gzip only
+    brotli = None
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await bus.start()
+    manager.start()
+    message_writer.start()
+    presence.start()
+    typing_relay.start()
+    storage_sweeper = asyncio.create_task(sweep_storage())
+    asset_manifest.update(await asyncio.to_thread(assets.build, "static"))
+    await page_cache.preload(HTML_PAGES)
+    yield
+    storage_sweeper.cancel()
+    typing_relay.stop()
+    presence.stop()
+    await message_writer.stop()
+    manager.stop()
+    await bus.stop()
+    password_executor.shutdown(wait=True)
+    media_executor.shutdown(wait=False, cancel_futures=True)
+    db_executor.shutdown(wait=True)
+    db_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+
+class AssetFileResponse(FileResponse):
+    chunk_size = 1024 * 1024  # fewer thread hops when streaming (or seeking through) large videos
+
+class AssetFiles(StaticFiles):
+    # /static with precompressed .br/.gz siblings (written by assets.py) picked by Accept-Encoding, and
+    # year-long immutable caching for names that carry their content hash: fingerprinted assets in
+    # dist/ and the content-addressed blobs in uploads/ and avatars/. Range requests (video seeking)
+    # are answered by FileResponse and always get the plain file.
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        path = str(full_path)
+        relative = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        headers = {}
+        if relative.startswith(f"{assets.DIST_DIR}/") or FINGERPRINTED_BLOB_RE.match(relative):
+            headers["Cache-Control"] = "public, max-age=31536000, immutable"
+
+        response = None
+        if relative.startswith(f"{assets.DIST_DIR}/") and path.endswith(assets.COMPRESSIBLE):
+            headers["Vary"] = "Accept-Encoding"
+            if "range" not in request_headers:
+                accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+                for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+                    if encoding not in accepted:
+                        continue
+                    try:
+                        sibling_stat = os.stat(path + suffix)
+                    except FileNotFoundError:
+                        continue
+                    response = AssetFileResponse(
+                        path + suffix, status_code=status_code, stat_result=sibling_stat,
+                        media_type=mimetypes.guess_type(path)[0], headers={**headers, "Content-Encoding": encoding}
+                    )
+                    break
+        if response is None:
+            response = AssetFileResponse(path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+FINGERPRINTED_BLOB_RE = re.compile(r"^(uploads|avatars)/[0-9a-f]{64}[.\w]*$")
+# "/static/<name>" -> fingerprinted URL, filled by the asset build at startup
+asset_manifest = {}
 
 # Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", AssetFiles(directory="static"), name="static")
 
 # Ensure avatars directory exists
 AVATARS_DIR = "static/avatars"
@@ -37,6 +125,45 @@ UPLOADS_DIR = "static/uploads"
 if not os.path.exists(UPLOADS_DIR):
     os.makedirs(UPLOADS_DIR)
 
+# Upload limits per kind of file, in megabytes
+UPLOAD_MAX_MB = {
+    "image": int(os.getenv("UPLOAD_MAX_IMAGE_MB", "20")),
+    "video": int(os.getenv("UPLOAD_MAX_VIDEO_MB", "512")),
+    "file": int(os.getenv("UPLOAD_MAX_FILE_MB", "50")),
+}
+UPLOAD_WRITE_SIZE = 1024 * 1024  # bytes gathered before each write to disk
+
+# Resumable uploads keep their chunks here (outside /static) until the session is completed. Sessions
+# without a new chunk for UPLOAD_SESSION_TTL are removed by a background sweep.
+UPLOAD_SESSIONS_DIR = os.getenv("UPLOAD_SESSIONS_DIR", "upload_sessions")
+os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_MB", "8")) * 1024 * 1024
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))  # seconds
+
+# Uploaded files and avatars are stored once per content, named after their SHA-256 digest, with a
+# reference count kept by triggers on messages.files and the avatar columns. Blobs nothing refers to
+# are deleted once BLOB_GC_GRACE has passed since their last upload, which covers files that were
+# uploaded but not sent yet.
+BLOB_GC_GRACE = float(os.getenv("BLOB_GC_GRACE", str(24 * 3600)))  # seconds
+STORAGE_SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", "600"))  # seconds
+
+# Uploaded images and avatars get WebP thumbnails at these widths plus a tiny blurred placeholder, made
+# in a process pool. /upload-file waits up to MEDIA_WAIT_TIMEOUT for them and otherwise answers without;
+# variants still missing when requested through /media/variant are made then.
+MEDIA_THUMBNAIL_WIDTHS = [int(width) for width in os.getenv("MEDIA_THUMBNAIL_WIDTHS", "160,320,640").split(",")]
+MEDIA_PLACEHOLDER_WIDTH = 16
+MEDIA_POOL_SIZE = int(os.getenv("MEDIA_POOL_SIZE", str(max(1, (os.cpu_count() or 1) // 2))))
+MEDIA_QUEUE_LIMIT = int(os.getenv("MEDIA_QUEUE_LIMIT", "64"))
+MEDIA_WAIT_TIMEOUT = float(os.getenv("MEDIA_WAIT_TIMEOUT", "2"))  # seconds
+
+# HTML pages are kept in memory with their gzip/brotli bodies made once per version of the file;
+# the file is stat'ed at most once per PAGE_CACHE_CHECK_INTERVAL to pick up edits
+PAGE_CACHE_CHECK_INTERVAL = float(os.getenv("PAGE_CACHE_CHECK_INTERVAL", "2"))  # seconds
+HTML_PAGES = [
+    "signin.html", "signup.html", "forgot-password.html", "reset-password.html", "chat.html",
+    "my-profile.html", "profile.html", "edit-profile.html", "settings.html", "templates/admin.html",
+]
+
 # SMTP Configuration
 SMTP_HOST = "smtp.gmail.com"
 SMTP_PORT = 587
@@ -46,9 +173,76 @@ SMTP_PASSWORD = "vvwudivtxwvacajf"
 SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
-RESET_TOKEN_EXPIRE_MINUTES = 60  # Password reset token valid for 60 minutes   
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+RESET_TOKEN_EXPIRE_MINUTES = 60  # Password reset token valid for 60 minutes
+
+# Database configuration
+DB_PATH = os.getenv("DB_PATH", "chat.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+# WebSocket fan-out: "memory" for a single process, "unix" to run several uvicorn workers on one host
+BUS_BACKEND = os.getenv("BUS_BACKEND", "memory")
+BUS_SOCKET_PATH = os.getenv("BUS_SOCKET_PATH", DB_PATH + ".bus")
+BUS_CONNECT_TIMEOUT = float(os.getenv("BUS_CONNECT_TIMEOUT", "10"))
+BUS_MAX_FRAME = 16 * 1024 * 1024
+
+# Incoming chat messages are written with group commit: one writer collects inserts from all sockets
+# for up to MESSAGE_BATCH_DELAY_MS or MESSAGE_BATCH_SIZE messages and commits them in one transaction
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "256"))
+MESSAGE_BATCH_DELAY = float(os.getenv("MESSAGE_BATCH_DELAY_MS", "5")) / 1000
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))  # senders wait once this many are pending
+
+# Outbound WebSocket queues. When a client falls WS_SEND_QUEUE_SIZE messages behind:
+# "drop_oldest" discards its oldest queued message, "coalesce" replaces an obsolete queued edit/delete/read
+# event and disconnects if there is none, "disconnect" closes the socket so the client resumes from sync
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))  # seconds for one send before the client counts as stalled
+WS_QUEUE_POLICY = os.getenv("WS_QUEUE_POLICY", "coalesce")
+if WS_QUEUE_POLICY not in ("drop_oldest", "coalesce", "disconnect"):
+    raise RuntimeError(f"Unknown WS_QUEUE_POLICY: {WS_QUEUE_POLICY}")
+# Sessions get a {"action": "ping"} every interval and are closed after the idle timeout without any frame
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+# Clients that offer the wire.SUBPROTOCOL get binary frames; everyone else stays on JSON text frames
+WS_BINARY_ENABLED = os.getenv("WS_BINARY_ENABLED", "1") == "1"
+# permessage-deflate as negotiated by ws_protocol.TunedWebSocketProtocol, which `python run.py` runs with
+# (the plain uvicorn CLI keeps uvicorn's own defaults). Fewer window bits and a lower memLevel cost
+# compression ratio but save memory on every connection; the level trades CPU for ratio.
+WS_DEFLATE = os.getenv("WS_DEFLATE", "1") == "1"
+WS_DEFLATE_SERVER_WINDOW_BITS = int(os.getenv("WS_DEFLATE_SERVER_WINDOW_BITS", "12"))  # 8..15
+WS_DEFLATE_CLIENT_WINDOW_BITS = int(os.getenv("WS_DEFLATE_CLIENT_WINDOW_BITS", "12"))  # 8..15
+WS_DEFLATE_MEM_LEVEL = int(os.getenv("WS_DEFLATE_MEM_LEVEL", "5"))  # 1..9
+WS_DEFLATE_LEVEL = int(os.getenv("WS_DEFLATE_LEVEL", "6"))  # 1..9
+# Coalescing for clients that connect with ?batch=1: while a session is busy, it gets at most one frame
+# per WS_COALESCE_MS, carrying everything queued meanwhile as an array of events. A session that has
+# been quiet for longer still gets its next event right away. 0 turns it off.
+WS_COALESCE_DELAY = float(os.getenv("WS_COALESCE_MS", "0")) / 1000
+WS_COALESCE_MAX = int(os.getenv("WS_COALESCE_MAX", "64"))  # events per array frame
+
+# Presence changes are collected and announced every PRESENCE_INTERVAL seconds, only to partners of
+# private chats active within PRESENCE_RECENT_DAYS. Typing is relayed at most once per TYPING_INTERVAL
+# per user and chat; typists in a group go out together at most once per TYPING_GROUP_INTERVAL.
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL", "2"))
+PRESENCE_RECENT_DAYS = int(os.getenv("PRESENCE_RECENT_DAYS", "30"))
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", "3"))
+TYPING_GROUP_INTERVAL = float(os.getenv("TYPING_GROUP_INTERVAL", "1"))
+
+# Identity cache in get_current_user. Entries are dropped on profile, password and admin changes made
+# by this process; other workers pick those up when the TTL runs out.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))  # seconds
+# Sender profiles (username, avatar) for message history, dropped the same way as identities
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "50000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))  # seconds
+
+# Password hashing runs in its own process pool so bcrypt never blocks the event loop. Jobs beyond the
+# workers plus PASSWORD_QUEUE_LIMIT waiting ones are turned away with 503 instead of piling up.
+PASSWORD_POOL_SIZE = int(os.getenv("PASSWORD_POOL_SIZE", str(os.cpu_count() or 1)))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", str(4 * PASSWORD_POOL_SIZE)))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # stored hashes with another cost are redone on login
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 # Admin-related models
@@ -91,17 +285,37 @@ class Token(BaseModel):
     access_token: str
     token_type: str
     
-class Message(BaseModel):
+# One attachment as stored in messages.files: images also get thumbnails (width -> url) and a blurred
+# placeholder data URI once the media pool has made them
+class FileAttachment(BaseModel):
+    file_url: str
+    file_type: str | None = None
+    file_name: str | None = None
+    thumbnails: Dict[str, str] | None = None
+    placeholder: str | None = None
+
+class CompactMessage(BaseModel):
     id: int  # Добавляем поле id
     content: str | None = None
     timestamp: str
     sender_id: int
     receiver_id: int | None = None
     group_id: int | None = None
+    is_read: bool = False
+    files: List[FileAttachment] | None = None
+
+class Message(CompactMessage):
+    username: str
+    avatar_url: str | None = None
+
+class SenderProfile(BaseModel):
     username: str
     avatar_url: str | None = None
-    is_read: bool = False
-    files: List[Dict[str, str]] | None = None
+
+# History page with compact=true: every sender's profile once, keyed by user id
+class MessagePage(BaseModel):
+    messages: List[CompactMessage]
+    users: Dict[int, SenderProfile]
 
 class RecentChat(BaseModel):
     user_id: int | None = None
@@ -110,6 +324,26 @@ class RecentChat(BaseModel):
     avatar_url: str | None = None
     unread_count: int
     is_group: bool = False
+    last_message_id: int = 0
+    last_activity: str | None = None
+    preview: str | None = None
+
+class MessageSearchResult(BaseModel):
+    id: int
+    content: str | None = None
+    timestamp: str
+    sender_id: int
+    receiver_id: int | None = None
+    group_id: int | None = None
+    username: str
+    avatar_url: str | None = None
+    snippet: str
+    rank: float
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    content_type: str
+    size: int
 
 class GroupCreate(BaseModel):
     name: str
@@ -132,18 +366,181 @@ class GroupInfo(BaseModel):
     creator: dict
     members: List[dict]
     
+class DBStats:
+    # Pool wait and query latency counters, shared by all DB worker threads
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._window = window
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquired = 0
+            self.waited = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.queries = 0
+            self.errors = 0
+            self.query_total = 0.0
+            self.query_max = 0.0
+            self._recent_queries = deque(maxlen=self._window)
+
+    def record_wait(self, seconds: float, waited: bool):
+        with self._lock:
+            self.acquired += 1
+            if waited:
+                self.waited += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_query(self, seconds: float, failed: bool):
+        with self._lock:
+            self.queries += 1
+            if failed:
+                self.errors += 1
+            self.query_total += seconds
+            self.query_max = max(self.query_max, seconds)
+            self._recent_queries.append(seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            recent = sorted(self._recent_queries)
+
+            def percentile(p):
+                if not recent:
+                    return 0.0
+                return recent[min(len(recent) - 1, int(len(recent) * p))] * 1000
+
+            return {
+                "pool": {
+                    "acquired": self.acquired,
+                    "waited": self.waited,
+                    "wait_avg_ms": self.wait_total / self.acquired * 1000 if self.acquired else 0.0,
+                    "wait_max_ms": self.wait_max * 1000,
+                },
+                "queries": {
+                    "count": self.queries,
+                    "errors": self.errors,
+                    "avg_ms": self.query_total / self.queries * 1000 if self.queries else 0.0,
+                    "max_ms": self.query_max * 1000,
+                    "p50_ms": percentile(0.50),
+                    "p95_ms": percentile(0.95),
+                    "p99_ms": percentile(0.99),
+                },
+            }
+
+db_stats = DBStats()
+
+class ConnectionPool:
+    # Bounded pool of long-lived SQLite connections, configured once on creation
+    def __init__(self, path: str, size: int, timeout: float):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,  # a connection is only ever used by one thread at a time
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        start = time.perf_counter()
+        waited = False
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                waited = True
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    db_stats.record_wait(time.perf_counter() - start, waited)
+                    raise HTTPException(status_code=503, detail="Database is busy, try again later")
+        db_stats.record_wait(time.perf_counter() - start, waited)
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken connection: drop it so a fresh one is opened next time
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def status(self) -> dict:
+        return {"size": self.size, "open": self._created, "idle": self._idle.qsize()}
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+# Blocking SQLite work never runs on the event loop: handlers hand it to this executor via run_db()
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
 @contextmanager
 def get_db():
-    conn = sqlite3.connect("chat.db")
+    conn = db_pool.acquire()
     try:
         yield conn
     finally:
-        conn.close()
+        db_pool.release(conn)
 
-def init_db():
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute("""
+def _call_with_db(fn, args):
+    with get_db() as conn:
+        start = time.perf_counter()
+        failed = False
+        try:
+            return fn(conn, *args)
+        except sqlite3.Error:
+            failed = True
+            raise
+        finally:
+            db_stats.record_query(time.perf_counter() - start, failed)
+
+async def run_db(fn, *args):
+    # Runs fn(conn, *args) on the DB executor with a pooled connection
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _call_with_db, fn, args)
+
+# Schema migrations, applied in order. Each step is an SQL string or a callable taking the connection;
+# every migration runs in its own transaction and is recorded in schema_migrations.
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
@@ -154,8 +551,8 @@ def init_db():
             avatar_url TEXT,
             is_admin INTEGER DEFAULT 0
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             sender_id INTEGER,
@@ -169,8 +566,8 @@ def init_db():
             FOREIGN KEY (receiver_id) REFERENCES users(id),
             FOREIGN KEY (group_id) REFERENCES groups(id)
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS groups (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -180,8 +577,8 @@ def init_db():
             created_at TEXT NOT NULL,
             FOREIGN KEY (creator_id) REFERENCES users(id)
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS group_members (
             group_id INTEGER,
             user_id INTEGER,
@@ -190,43 +587,1646 @@ def init_db():
             FOREIGN KEY (group_id) REFERENCES groups(id),
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS password_reset_tokens (
             token TEXT PRIMARY KEY,
             user_id INTEGER,
             expires_at TEXT NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
+        """,
+    ]),
+    (2, "indexes for conversation, group timeline and unread lookups", [
+        # Private history in either direction, and the sender side of the recent-chats list
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(sender_id, receiver_id, timestamp)",
+        # Covers private unread counts and mark-read, and the receiver side of the recent-chats list
+        "CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages(receiver_id, sender_id, is_read)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_group_timeline ON messages(group_id, timestamp)",
+        # Covers group unread counts and group mark-read
+        "CREATE INDEX IF NOT EXISTS idx_messages_group_unread ON messages(group_id, is_read, sender_id)",
+        # The primary key is (group_id, user_id); "groups of a user" needs the reverse order
+        "CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(user_id, group_id)",
+    ]),
+    (3, "key conversation indexes by message id for keyset pagination", [
+        "DROP INDEX IF EXISTS idx_messages_conversation",
+        "CREATE INDEX idx_messages_conversation ON messages(sender_id, receiver_id, id)",
+        "DROP INDEX IF EXISTS idx_messages_group_timeline",
+        "CREATE INDEX idx_messages_group_timeline ON messages(group_id, id)",
+    ]),
+    (4, "change log of message edits and deletes for delta sync", [
+        """
+        CREATE TABLE message_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            action TEXT NOT NULL,  -- 'edit' or 'delete'
+            sender_id INTEGER,
+            receiver_id INTEGER,
+            group_id INTEGER,
+            high_water_id INTEGER NOT NULL,  -- newest message id ever assigned when the change happened
+            changed_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX idx_message_changes_high_water ON message_changes(high_water_id)",
+        # Triggers catch every edit and delete path, including chat clears and members leaving groups.
+        # sqlite_sequence keeps growing after deletes, unlike MAX(id).
+        """
+        CREATE TRIGGER messages_log_edit AFTER UPDATE OF content, files ON messages
+        BEGIN
+            INSERT INTO message_changes (message_id, action, sender_id, receiver_id, group_id, high_water_id, changed_at)
+            VALUES (NEW.id, 'edit', NEW.sender_id, NEW.receiver_id, NEW.group_id,
+                    (SELECT seq FROM sqlite_sequence WHERE name = 'messages'), strftime('%Y-%m-%dT%H:%M:%f', 'now'));
+        END
+        """,
+        """
+        CREATE TRIGGER messages_log_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO message_changes (message_id, action, sender_id, receiver_id, group_id, high_water_id, changed_at)
+            VALUES (OLD.id, 'delete', OLD.sender_id, OLD.receiver_id, OLD.group_id,
+                    (SELECT seq FROM sqlite_sequence WHERE name = 'messages'), strftime('%Y-%m-%dT%H:%M:%f', 'now'));
+        END
+        """,
+    ]),
+    (5, "materialized conversations with per-member last activity and unread counters", [
+        """
+        CREATE TABLE conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conv_key TEXT UNIQUE NOT NULL,  -- 'p:<low user id>:<high user id>' or 'g:<group id>'
+            group_id INTEGER,
+            user_low INTEGER,
+            user_high INTEGER,
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            last_activity TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE conversation_members (
+            conversation_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            partner_id INTEGER,  -- the other user of a private chat
+            group_id INTEGER,
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            last_activity TEXT NOT NULL,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (conversation_id, user_id),
+            FOREIGN KEY (conversation_id) REFERENCES conversations(id)
+        )
+        """,
+        # The recent-chats list is a range read of this index
+        "CREATE INDEX idx_conversation_members_recent ON conversation_members(user_id, last_activity)",
+        # Backfill from existing messages and group memberships
+        """
+        INSERT INTO conversations (conv_key, user_low, user_high, last_message_id, last_activity)
+        SELECT 'p:' || min(sender_id, receiver_id) || ':' || max(sender_id, receiver_id),
+               min(sender_id, receiver_id), max(sender_id, receiver_id), MAX(id), timestamp
+        FROM messages
+        WHERE group_id IS NULL AND receiver_id IS NOT NULL AND sender_id != receiver_id
+        GROUP BY min(sender_id, receiver_id), max(sender_id, receiver_id)
+        """,
+        """
+        INSERT INTO conversation_members (conversation_id, user_id, partner_id, last_message_id, last_activity, unread_count)
+        SELECT c.id, me.user_id, me.partner_id, c.last_message_id, c.last_activity,
+               (SELECT COUNT(*) FROM messages m
+                WHERE m.receiver_id = me.user_id AND m.sender_id = me.partner_id AND m.is_read = 0)
+        FROM conversations c
+        JOIN (SELECT id, user_low AS user_id, user_high AS partner_id FROM conversations WHERE group_id IS NULL
+              UNION ALL
+              SELECT id, user_high, user_low FROM conversations WHERE group_id IS NULL) me ON me.id = c.id
+        """,
+        """
+        INSERT INTO conversations (conv_key, group_id, last_message_id, last_activity)
+        SELECT 'g:' || g.id, g.id,
+               COALESCE((SELECT MAX(id) FROM messages WHERE group_id = g.id), 0),
+               COALESCE((SELECT timestamp FROM messages WHERE group_id = g.id ORDER BY id DESC LIMIT 1), g.created_at)
+        FROM groups g
+        """,
+        """
+        INSERT INTO conversation_members (conversation_id, user_id, group_id, last_message_id, last_activity, unread_count)
+        SELECT c.id, gm.user_id, gm.group_id, c.last_message_id, c.last_activity,
+               (SELECT COUNT(*) FROM messages m
+                WHERE m.group_id = gm.group_id AND m.is_read = 0 AND m.sender_id != gm.user_id)
+        FROM group_members gm
+        JOIN conversations c ON c.conv_key = 'g:' || gm.group_id
+        """,
+        # From here on the triggers keep both tables current on every write path: sends, deletes,
+        # chat clears, joins and leaves. Mark-read resets the reader's counter in the handlers.
+        """
+        CREATE TRIGGER conversations_private_message AFTER INSERT ON messages
+        WHEN NEW.group_id IS NULL AND NEW.receiver_id IS NOT NULL AND NEW.sender_id != NEW.receiver_id
+        BEGIN
+            INSERT INTO conversations (conv_key, user_low, user_high, last_message_id, last_activity)
+            VALUES ('p:' || min(NEW.sender_id, NEW.receiver_id) || ':' || max(NEW.sender_id, NEW.receiver_id),
+                    min(NEW.sender_id, NEW.receiver_id), max(NEW.sender_id, NEW.receiver_id), NEW.id, NEW.timestamp)
+            ON CONFLICT (conv_key) DO UPDATE SET
+                last_message_id = excluded.last_message_id, last_activity = excluded.last_activity;
+            INSERT INTO conversation_members (conversation_id, user_id, partner_id, last_message_id, last_activity, unread_count)
+            SELECT id, NEW.sender_id, NEW.receiver_id, NEW.id, NEW.timestamp, 0 FROM conversations
+            WHERE conv_key = 'p:' || min(NEW.sender_id, NEW.receiver_id) || ':' || max(NEW.sender_id, NEW.receiver_id)
+            ON CONFLICT (conversation_id, user_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id, last_activity = excluded.last_activity;
+            INSERT INTO conversation_members (conversation_id, user_id, partner_id, last_message_id, last_activity, unread_count)
+            SELECT id, NEW.receiver_id, NEW.sender_id, NEW.id, NEW.timestamp, NEW.is_read = 0 FROM conversations
+            WHERE conv_key = 'p:' || min(NEW.sender_id, NEW.receiver_id) || ':' || max(NEW.sender_id, NEW.receiver_id)
+            ON CONFLICT (conversation_id, user_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id, last_activity = excluded.last_activity,
+                unread_count = unread_count + excluded.unread_count;
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_group_message AFTER INSERT ON messages
+        WHEN NEW.group_id IS NOT NULL
+        BEGIN
+            UPDATE conversations SET last_message_id = NEW.id, last_activity = NEW.timestamp
+            WHERE conv_key = 'g:' || NEW.group_id;
+            UPDATE conversation_members
+            SET last_message_id = NEW.id, last_activity = NEW.timestamp,
+                unread_count = unread_count + (user_id != NEW.sender_id)
+            WHERE conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || NEW.group_id);
+        END
+        """,
+        # Deletes only rewind last_message_id when the newest message of the chat goes away.
+        # A private chat with no messages left drops out of both users' lists, as it did before.
+        """
+        CREATE TRIGGER conversations_private_delete AFTER DELETE ON messages
+        WHEN OLD.group_id IS NULL AND OLD.receiver_id IS NOT NULL AND OLD.sender_id != OLD.receiver_id
+        BEGIN
+            UPDATE conversation_members SET unread_count = unread_count - 1
+            WHERE OLD.is_read = 0 AND unread_count > 0 AND user_id = OLD.receiver_id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key =
+                  'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id));
+            UPDATE conversations
+            SET last_message_id = COALESCE((
+                    SELECT id FROM messages
+                    WHERE id IN ((SELECT id FROM messages WHERE sender_id = user_low AND receiver_id = user_high
+                                  ORDER BY id DESC LIMIT 1),
+                                 (SELECT id FROM messages WHERE sender_id = user_high AND receiver_id = user_low
+                                  ORDER BY id DESC LIMIT 1))
+                    ORDER BY id DESC LIMIT 1), 0)
+            WHERE conv_key = 'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id)
+              AND last_message_id = OLD.id;
+            UPDATE conversations SET last_activity = (SELECT timestamp FROM messages WHERE id = last_message_id)
+            WHERE conv_key = 'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id)
+              AND last_message_id < OLD.id AND last_message_id != 0;
+            UPDATE conversation_members
+            SET last_message_id = (SELECT last_message_id FROM conversations WHERE id = conversation_id),
+                last_activity = (SELECT last_activity FROM conversations WHERE id = conversation_id)
+            WHERE last_message_id = OLD.id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key =
+                  'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id));
+            DELETE FROM conversation_members
+            WHERE conversation_id = (SELECT id FROM conversations WHERE last_message_id = 0 AND conv_key =
+                  'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id));
+            DELETE FROM conversations
+            WHERE conv_key = 'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id)
+              AND last_message_id = 0;
+        END
+        """,
+        # is_read is a single flag on group messages, so the counter is only an estimate for members who
+        # already marked the group read; it never goes below zero
+        """
+        CREATE TRIGGER conversations_group_delete AFTER DELETE ON messages
+        WHEN OLD.group_id IS NOT NULL
+        BEGIN
+            UPDATE conversation_members SET unread_count = unread_count - 1
+            WHERE OLD.is_read = 0 AND unread_count > 0 AND user_id != OLD.sender_id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || OLD.group_id);
+            UPDATE conversations
+            SET last_message_id = COALESCE(
+                    (SELECT id FROM messages WHERE group_id = OLD.group_id ORDER BY id DESC LIMIT 1), 0)
+            WHERE conv_key = 'g:' || OLD.group_id AND last_message_id = OLD.id;
+            UPDATE conversations
+            SET last_activity = COALESCE((SELECT timestamp FROM messages WHERE id = last_message_id), last_activity)
+            WHERE conv_key = 'g:' || OLD.group_id AND last_message_id < OLD.id;
+            UPDATE conversation_members
+            SET last_message_id = (SELECT last_message_id FROM conversations WHERE id = conversation_id),
+                last_activity = (SELECT last_activity FROM conversations WHERE id = conversation_id)
+            WHERE last_message_id = OLD.id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || OLD.group_id);
+        END
+        """,
+        # A new member sees the group at the top of their list
+        """
+        CREATE TRIGGER conversations_group_join AFTER INSERT ON group_members
+        BEGIN
+            INSERT INTO conversations (conv_key, group_id, last_message_id, last_activity)
+            VALUES ('g:' || NEW.group_id, NEW.group_id,
+                    COALESCE((SELECT MAX(id) FROM messages WHERE group_id = NEW.group_id), 0),
+                    strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+            ON CONFLICT (conv_key) DO NOTHING;
+            INSERT INTO conversation_members (conversation_id, user_id, group_id, last_message_id, last_activity, unread_count)
+            SELECT id, NEW.user_id, NEW.group_id, last_message_id, strftime('%Y-%m-%dT%H:%M:%f', 'now'), 0
+            FROM conversations WHERE conv_key = 'g:' || NEW.group_id
+            ON CONFLICT (conversation_id, user_id) DO NOTHING;
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_group_leave AFTER DELETE ON group_members
+        BEGIN
+            DELETE FROM conversation_members
+            WHERE user_id = OLD.user_id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || OLD.group_id);
+        END
+        """,
+    ]),
+    (6, "per-user read cursors replace the is_read flag and the materialized unread counters", [
+        """
+        CREATE TABLE read_cursors (
+            user_id INTEGER NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            last_read_message_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, conversation_id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (conversation_id) REFERENCES conversations(id)
+        )
+        """,
+        # "Has anyone else in the group read my message" is a range read on this index
+        "CREATE INDEX idx_read_cursors_conversation ON read_cursors(conversation_id, last_read_message_id)",
+        # Everything before the first unread message counts as read. Group is_read was shared by all
+        # members, so group cursors start from that shared position.
+        """
+        INSERT INTO read_cursors (user_id, conversation_id, last_read_message_id, updated_at)
+        SELECT cm.user_id, cm.conversation_id,
+               COALESCE((SELECT MIN(m.id) - 1 FROM messages m
+                         WHERE m.sender_id = cm.partner_id AND m.receiver_id = cm.user_id AND m.is_read = 0),
+                        cm.last_message_id),
+               strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        FROM conversation_members cm
+        WHERE cm.partner_id IS NOT NULL
+        """,
+        """
+        INSERT INTO read_cursors (user_id, conversation_id, last_read_message_id, updated_at)
+        SELECT cm.user_id, cm.conversation_id,
+               COALESCE((SELECT MIN(m.id) - 1 FROM messages m
+                         WHERE m.group_id = cm.group_id AND m.sender_id != cm.user_id AND m.is_read = 0),
+                        cm.last_message_id),
+               strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        FROM conversation_members cm
+        WHERE cm.group_id IS NOT NULL
+        """,
+        # The conversation triggers no longer keep counters; unread counts are now counted from the cursor
+        "DROP TRIGGER conversations_private_message",
+        "DROP TRIGGER conversations_group_message",
+        "DROP TRIGGER conversations_private_delete",
+        "DROP TRIGGER conversations_group_delete",
+        "DROP TRIGGER conversations_group_join",
+        "ALTER TABLE conversation_members DROP COLUMN unread_count",
+        """
+        CREATE TRIGGER conversations_private_message AFTER INSERT ON messages
+        WHEN NEW.group_id IS NULL AND NEW.receiver_id IS NOT NULL AND NEW.sender_id != NEW.receiver_id
+        BEGIN
+            INSERT INTO conversations (conv_key, user_low, user_high, last_message_id, last_activity)
+            VALUES ('p:' || min(NEW.sender_id, NEW.receiver_id) || ':' || max(NEW.sender_id, NEW.receiver_id),
+                    min(NEW.sender_id, NEW.receiver_id), max(NEW.sender_id, NEW.receiver_id), NEW.id, NEW.timestamp)
+            ON CONFLICT (conv_key) DO UPDATE SET
+                last_message_id = excluded.last_message_id, last_activity = excluded.last_activity;
+            INSERT INTO conversation_members (conversation_id, user_id, partner_id, last_message_id, last_activity)
+            SELECT c.id, p.user_id, p.partner_id, NEW.id, NEW.timestamp
+            FROM conversations c
+            JOIN (SELECT NEW.sender_id AS user_id, NEW.receiver_id AS partner_id
+                  UNION ALL
+                  SELECT NEW.receiver_id, NEW.sender_id) p
+            WHERE c.conv_key = 'p:' || min(NEW.sender_id, NEW.receiver_id) || ':' || max(NEW.sender_id, NEW.receiver_id)
+            ON CONFLICT (conversation_id, user_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id, last_activity = excluded.last_activity;
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_group_message AFTER INSERT ON messages
+        WHEN NEW.group_id IS NOT NULL
+        BEGIN
+            UPDATE conversations SET last_message_id = NEW.id, last_activity = NEW.timestamp
+            WHERE conv_key = 'g:' || NEW.group_id;
+            UPDATE conversation_members SET last_message_id = NEW.id, last_activity = NEW.timestamp
+            WHERE conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || NEW.group_id);
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_private_delete AFTER DELETE ON messages
+        WHEN OLD.group_id IS NULL AND OLD.receiver_id IS NOT NULL AND OLD.sender_id != OLD.receiver_id
+        BEGIN
+            UPDATE conversations
+            SET last_message_id = COALESCE((
+                    SELECT id FROM messages
+                    WHERE id IN ((SELECT id FROM messages WHERE sender_id = user_low AND receiver_id = user_high
+                                  ORDER BY id DESC LIMIT 1),
+                                 (SELECT id FROM messages WHERE sender_id = user_high AND receiver_id = user_low
+                                  ORDER BY id DESC LIMIT 1))
+                    ORDER BY id DESC LIMIT 1), 0)
+            WHERE conv_key = 'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id)
+              AND last_message_id = OLD.id;
+            UPDATE conversations SET last_activity = (SELECT timestamp FROM messages WHERE id = last_message_id)
+            WHERE conv_key = 'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id)
+              AND last_message_id < OLD.id AND last_message_id != 0;
+            UPDATE conversation_members
+            SET last_message_id = (SELECT last_message_id FROM conversations WHERE id = conversation_id),
+                last_activity = (SELECT last_activity FROM conversations WHERE id = conversation_id)
+            WHERE last_message_id = OLD.id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key =
+                  'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id));
+            DELETE FROM read_cursors
+            WHERE conversation_id = (SELECT id FROM conversations WHERE last_message_id = 0 AND conv_key =
+                  'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id));
+            DELETE FROM conversation_members
+            WHERE conversation_id = (SELECT id FROM conversations WHERE last_message_id = 0 AND conv_key =
+                  'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id));
+            DELETE FROM conversations
+            WHERE conv_key = 'p:' || min(OLD.sender_id, OLD.receiver_id) || ':' || max(OLD.sender_id, OLD.receiver_id)
+              AND last_message_id = 0;
+        END
+        """,
+        """
+        CREATE TRIGGER conversations_group_delete AFTER DELETE ON messages
+        WHEN OLD.group_id IS NOT NULL
+        BEGIN
+            UPDATE conversations
+            SET last_message_id = COALESCE(
+                    (SELECT id FROM messages WHERE group_id = OLD.group_id ORDER BY id DESC LIMIT 1), 0)
+            WHERE conv_key = 'g:' || OLD.group_id AND last_message_id = OLD.id;
+            UPDATE conversations
+            SET last_activity = COALESCE((SELECT timestamp FROM messages WHERE id = last_message_id), last_activity)
+            WHERE conv_key = 'g:' || OLD.group_id AND last_message_id < OLD.id;
+            UPDATE conversation_members
+            SET last_message_id = (SELECT last_message_id FROM conversations WHERE id = conversation_id),
+                last_activity = (SELECT last_activity FROM conversations WHERE id = conversation_id)
+            WHERE last_message_id = OLD.id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || OLD.group_id);
+        END
+        """,
+        # Messages from before a member joined never count as unread for them
+        """
+        CREATE TRIGGER conversations_group_join AFTER INSERT ON group_members
+        BEGIN
+            INSERT INTO conversations (conv_key, group_id, last_message_id, last_activity)
+            VALUES ('g:' || NEW.group_id, NEW.group_id,
+                    COALESCE((SELECT MAX(id) FROM messages WHERE group_id = NEW.group_id), 0),
+                    strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+            ON CONFLICT (conv_key) DO NOTHING;
+            INSERT INTO conversation_members (conversation_id, user_id, group_id, last_message_id, last_activity)
+            SELECT id, NEW.user_id, NEW.group_id, last_message_id, strftime('%Y-%m-%dT%H:%M:%f', 'now')
+            FROM conversations WHERE conv_key = 'g:' || NEW.group_id
+            ON CONFLICT (conversation_id, user_id) DO NOTHING;
+            INSERT INTO read_cursors (user_id, conversation_id, last_read_message_id, updated_at)
+            SELECT NEW.user_id, id, last_message_id, strftime('%Y-%m-%dT%H:%M:%f', 'now')
+            FROM conversations WHERE conv_key = 'g:' || NEW.group_id
+            ON CONFLICT (user_id, conversation_id) DO NOTHING;
+        END
+        """,
+        """
+        CREATE TRIGGER read_cursors_group_leave AFTER DELETE ON group_members
+        BEGIN
+            DELETE FROM read_cursors
+            WHERE user_id = OLD.user_id
+              AND conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || OLD.group_id);
+        END
+        """,
+    ]),
+    (7, "full-text index on message content", [
+        # External-content FTS5 table: the text lives in messages only, the index stores tokens and rowids
+        """
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content, content = 'messages', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+        )
+        """,
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+        """
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+        WHEN NEW.content IS NOT NULL
+        BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+        WHEN OLD.content IS NOT NULL
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            SELECT 'delete', OLD.id, OLD.content WHERE OLD.content IS NOT NULL;
+            INSERT INTO messages_fts (rowid, content)
+            SELECT NEW.id, NEW.content WHERE NEW.content IS NOT NULL;
+        END
+        """,
+    ]),
+    (8, "resumable upload sessions", [
+        """
+        CREATE TABLE upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        """,
+        "CREATE INDEX idx_upload_sessions_updated ON upload_sessions (updated_at)",
+    ]),
+    (9, "content-addressed blobs with reference counts", [
+        """
+        CREATE TABLE blobs (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            uploaded_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX idx_blobs_unreferenced ON blobs (uploaded_at) WHERE ref_count = 0",
+        # messages.files is a JSON list of {file_url, file_type}; json_tree picks the urls out of it.
+        # Files written before this migration have no row in blobs, so these updates skip them.
+        """
+        CREATE TRIGGER blobs_message_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE blobs SET ref_count = ref_count + 1 WHERE url IN (
+                SELECT value FROM json_tree(CASE WHEN json_valid(NEW.files) THEN NEW.files END) WHERE key = 'file_url'
+            );
+        END
+        """,
+        """
+        CREATE TRIGGER blobs_message_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1 WHERE url IN (
+                SELECT value FROM json_tree(CASE WHEN json_valid(OLD.files) THEN OLD.files END) WHERE key = 'file_url'
+            );
+        END
+        """,
+        """
+        CREATE TRIGGER blobs_message_update AFTER UPDATE OF files ON messages
+        WHEN OLD.files IS NOT NEW.files
+        BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1 WHERE url IN (
+                SELECT value FROM json_tree(CASE WHEN json_valid(OLD.files) THEN OLD.files END) WHERE key = 'file_url'
+            );
+            UPDATE blobs SET ref_count = ref_count + 1 WHERE url IN (
+                SELECT value FROM json_tree(CASE WHEN json_valid(NEW.files) THEN NEW.files END) WHERE key = 'file_url'
+            );
+        END
+        """,
+        *[
+            sql.format(table=table)
+            for table in ("users", "groups")
+            for sql in (
+                """
+                CREATE TRIGGER blobs_{table}_avatar_insert AFTER INSERT ON {table}
+                BEGIN
+                    UPDATE blobs SET ref_count = ref_count + 1 WHERE url = NEW.avatar_url;
+                END
+                """,
+                """
+                CREATE TRIGGER blobs_{table}_avatar_delete AFTER DELETE ON {table}
+                BEGIN
+                    UPDATE blobs SET ref_count = ref_count - 1 WHERE url = OLD.avatar_url;
+                END
+                """,
+                """
+                CREATE TRIGGER blobs_{table}_avatar_update AFTER UPDATE OF avatar_url ON {table}
+                WHEN OLD.avatar_url IS NOT NEW.avatar_url
+                BEGIN
+                    UPDATE blobs SET ref_count = ref_count - 1 WHERE url = OLD.avatar_url;
+                    UPDATE blobs SET ref_count = ref_count + 1 WHERE url = NEW.avatar_url;
+                END
+                """,
+            )
+        ],
+    ]),
+]
+
+def migrate(conn) -> int:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
     """)
-    conn.commit()
-    conn.close()
-    
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        # Explicit BEGIN so the DDL is part of the transaction too. IMMEDIATE takes the write lock up front:
+        # with several workers starting at once, the others wait here and then find the migration applied.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            applied = conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone()
+            if applied:
+                conn.rollback()
+                current = version
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.utcnow().isoformat())
+            )
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied schema migration {version}: {description}")
+        current = version
+    return current
+
+def init_db():
+    with get_db() as conn:
+        migrate(conn)
+
 init_db()
 
+# SQL for the hot paths. Handlers use these constants and check_query_plans() verifies
+# that none of them falls back to a full table scan.
+# is_read of a message as seen by a viewer (the two "?"): a private message is read once the receiver's
+# cursor has passed it; in a group the viewer's own messages are read once any other member's cursor has,
+# everyone else's once the viewer's cursor has.
+_MESSAGE_IS_READ_SQL = """
+    CASE
+        WHEN m.group_id IS NULL THEN EXISTS (
+            SELECT 1 FROM read_cursors rc
+            WHERE rc.user_id = m.receiver_id AND rc.last_read_message_id >= m.id
+              AND rc.conversation_id = (SELECT id FROM conversations WHERE conv_key =
+                  'p:' || min(m.sender_id, m.receiver_id) || ':' || max(m.sender_id, m.receiver_id)))
+        WHEN m.sender_id = ? THEN EXISTS (
+            SELECT 1 FROM read_cursors rc
+            WHERE rc.conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || m.group_id)
+              AND rc.last_read_message_id >= m.id AND rc.user_id != m.sender_id)
+        ELSE EXISTS (
+            SELECT 1 FROM read_cursors rc
+            WHERE rc.user_id = ? AND rc.last_read_message_id >= m.id
+              AND rc.conversation_id = (SELECT id FROM conversations WHERE conv_key = 'g:' || m.group_id))
+    END
+"""
+
+# History pages are keyset-paginated on message id: "id < before AND id > after", newest first
+# unless the page is anchored on after_id only. Each direction of a private chat is limited
+# separately so both halves are range reads on idx_messages_conversation.
+# Both queries return the same columns; sender profiles are not joined in but come from profile_cache.
+_PRIVATE_HISTORY_PAGE_SQL = """
+    SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id, m.group_id, {is_read}, m.files
+    FROM messages m
+    WHERE m.id IN (
+        SELECT id FROM (
+            SELECT id FROM messages
+            WHERE sender_id = ? AND receiver_id = ? AND id < ? AND id > ?
+            ORDER BY id {order} LIMIT ?
+        )
+        UNION ALL
+        SELECT id FROM (
+            SELECT id FROM messages
+            WHERE sender_id = ? AND receiver_id = ? AND id < ? AND id > ?
+            ORDER BY id {order} LIMIT ?
+        )
+    )
+    ORDER BY m.id {order}
+    LIMIT ?
+"""
+PRIVATE_HISTORY_SQL = _PRIVATE_HISTORY_PAGE_SQL.format(order="DESC", is_read=_MESSAGE_IS_READ_SQL)
+PRIVATE_HISTORY_AFTER_SQL = _PRIVATE_HISTORY_PAGE_SQL.format(order="ASC", is_read=_MESSAGE_IS_READ_SQL)
+
+_GROUP_HISTORY_PAGE_SQL = """
+    SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id, m.group_id, {is_read}, m.files
+    FROM messages m
+    WHERE m.group_id = ? AND m.id < ? AND m.id > ?
+    ORDER BY m.id {order}
+    LIMIT ?
+"""
+GROUP_HISTORY_SQL = _GROUP_HISTORY_PAGE_SQL.format(order="DESC", is_read=_MESSAGE_IS_READ_SQL)
+GROUP_HISTORY_AFTER_SQL = _GROUP_HISTORY_PAGE_SQL.format(order="ASC", is_read=_MESSAGE_IS_READ_SQL)
+
+# One row per chat of the user in conversation_members, ordered by last activity.
+# Unread counts are range counts past the user's read cursor on the conversation indexes.
+RECENT_CHATS_SQL = """
+    SELECT cm.partner_id, cm.group_id, COALESCE(u.username, g.name), COALESCE(u.avatar_url, g.avatar_url),
+           CASE WHEN cm.group_id IS NULL
+                THEN (SELECT COUNT(*) FROM messages m
+                      WHERE m.sender_id = cm.partner_id AND m.receiver_id = cm.user_id
+                        AND m.id > COALESCE(rc.last_read_message_id, 0))
+                ELSE (SELECT COUNT(*) FROM messages m
+                      WHERE m.group_id = cm.group_id AND m.id > COALESCE(rc.last_read_message_id, 0)
+                        AND m.sender_id != cm.user_id)
+           END,
+           cm.last_message_id, cm.last_activity, substr(lm.content, 1, ?)
+    FROM conversation_members cm
+    LEFT JOIN read_cursors rc ON rc.user_id = cm.user_id AND rc.conversation_id = cm.conversation_id
+    LEFT JOIN users u ON u.id = cm.partner_id
+    LEFT JOIN groups g ON g.id = cm.group_id
+    LEFT JOIN messages lm ON lm.id = cm.last_message_id
+    WHERE cm.user_id = ?
+    ORDER BY cm.last_activity DESC
+    LIMIT ?
+"""
+
+# Last message of one conversation after an edit or delete, for conversation_updated events
+CONVERSATION_STATE_SQL = """
+    SELECT c.last_message_id, c.last_activity, substr(m.content, 1, ?)
+    FROM conversations c
+    LEFT JOIN messages m ON m.id = c.last_message_id
+    WHERE c.conv_key = ?
+"""
+
+# Members whose read cursor is at or past a message, i.e. who do not count it as unread
+READ_PAST_SQL = """
+    SELECT rc.user_id FROM read_cursors rc
+    JOIN conversations c ON c.id = rc.conversation_id
+    WHERE c.conv_key = ? AND rc.last_read_message_id >= ?
+"""
+
+# Mark-read moves one cursor to the newest message of the conversation; cursors never move back
+MARK_READ_SQL = """
+    INSERT INTO read_cursors (user_id, conversation_id, last_read_message_id, updated_at)
+    SELECT ?, id, last_message_id, ? FROM conversations WHERE conv_key = ?
+    ON CONFLICT (user_id, conversation_id) DO UPDATE SET
+        last_read_message_id = max(last_read_message_id, excluded.last_read_message_id),
+        updated_at = excluded.updated_at
+    RETURNING last_read_message_id
+"""
+
+GROUP_MEMBER_IDS_SQL = "SELECT user_id FROM group_members WHERE group_id = ?"
+
+# Per other member, how many of one sender's group messages lie past their read cursor
+GROUP_SENDER_UNREAD_SQL = """
+    SELECT gm.user_id, COUNT(m.id)
+    FROM group_members gm
+    JOIN conversations c ON c.conv_key = ?
+    LEFT JOIN read_cursors rc ON rc.user_id = gm.user_id AND rc.conversation_id = c.id
+    JOIN messages m ON m.group_id = gm.group_id AND m.sender_id = ? AND m.id > COALESCE(rc.last_read_message_id, 0)
+    WHERE gm.group_id = ? AND gm.user_id != ?
+    GROUP BY gm.user_id
+"""
+
+# Partners of the user's recently active private chats: a range read on idx_conversation_members_recent
+PRESENCE_PARTNERS_SQL = """
+    SELECT partner_id FROM conversation_members
+    WHERE user_id = ? AND last_activity > ? AND partner_id IS NOT NULL
+"""
+
+USER_GROUPS_SQL = """
+    SELECT g.id, g.name, g.description, g.avatar_url, g.creator_id, g.created_at
+    FROM groups g
+    JOIN group_members gm ON g.id = gm.group_id
+    WHERE gm.user_id = ?
+"""
+
+# Delta sync: everything in the user's private chats and groups newer than the client's last seen message id.
+# The unary "+" keeps the planner on the id range instead of walking the user's whole history through
+# the per-conversation indexes: a reconnecting client is usually only a few messages behind.
+SYNC_NEW_MESSAGES_SQL = """
+    SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id,
+           m.group_id, u.username, u.avatar_url, """ + _MESSAGE_IS_READ_SQL + """, m.files
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.id > ?
+      AND (+m.sender_id = ? OR +m.receiver_id = ?
+           OR +m.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+    ORDER BY m.id
+    LIMIT ?
+"""
+
+# A change logged while the newest message id was N can only be missing from a client that has seen
+# up to N or less, so "high_water_id >= since" never loses a change; replaying a few extra is harmless.
+SYNC_CHANGES_SQL = """
+    SELECT c.message_id, c.action, c.sender_id, c.receiver_id, c.group_id,
+           m.content, m.timestamp, m.files, """ + _MESSAGE_IS_READ_SQL + """, u.username, u.avatar_url, c.id
+    FROM message_changes c
+    LEFT JOIN messages m ON m.id = c.message_id
+    LEFT JOIN users u ON u.id = c.sender_id
+    WHERE c.high_water_id >= ? AND c.message_id <= ?
+      AND (+c.sender_id = ? OR +c.receiver_id = ?
+           OR +c.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+"""
+
+# Full-text search, best match first. {scope} narrows the hits to what the caller may see:
+# one of the SEARCH_SCOPE_* fragments below, each with its own parameters.
+_SEARCH_MESSAGES_SQL = """
+    SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id, m.group_id, u.username, u.avatar_url,
+           snippet(messages_fts, 0, ?, ?, '...', 16), bm25(messages_fts)
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN users u ON u.id = m.sender_id
+    WHERE messages_fts MATCH ? {scope}
+    ORDER BY bm25(messages_fts), m.id DESC
+    LIMIT ? OFFSET ?
+"""
+SEARCH_SCOPE_MEMBER = """
+    AND (m.sender_id = ? OR m.receiver_id = ? OR m.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+"""
+SEARCH_SCOPE_PRIVATE = "AND ((m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?))"
+SEARCH_SCOPE_GROUP = "AND m.group_id = ?"
+SEARCH_MESSAGES_SQL = _SEARCH_MESSAGES_SQL.format(scope=SEARCH_SCOPE_MEMBER)
+SEARCH_PRIVATE_MESSAGES_SQL = _SEARCH_MESSAGES_SQL.format(scope=SEARCH_SCOPE_PRIVATE)
+SEARCH_GROUP_MESSAGES_SQL = _SEARCH_MESSAGES_SQL.format(scope=SEARCH_SCOPE_GROUP)
+SEARCH_ALL_MESSAGES_SQL = _SEARCH_MESSAGES_SQL.format(scope="")
+
+HOT_QUERIES = {
+    "private_history": (PRIVATE_HISTORY_SQL, (1, 1, 1, 2, 100, 0, 50, 2, 1, 100, 0, 50, 50)),
+    "private_history_after": (PRIVATE_HISTORY_AFTER_SQL, (1, 1, 1, 2, 100, 0, 50, 2, 1, 100, 0, 50, 50)),
+    "group_history": (GROUP_HISTORY_SQL, (1, 1, 1, 100, 0, 50)),
+    "group_history_after": (GROUP_HISTORY_AFTER_SQL, (1, 1, 1, 100, 0, 50)),
+    "recent_chats": (RECENT_CHATS_SQL, (100, 1, 10)),
+    "conversation_state": (CONVERSATION_STATE_SQL, (100, "p:1:2")),
+    "read_past": (READ_PAST_SQL, ("p:1:2", 100)),
+    "mark_read": (MARK_READ_SQL, (1, "2024-01-01T00:00:00", "p:1:2")),
+    "group_member_ids": (GROUP_MEMBER_IDS_SQL, (1,)),
+    "presence_partners": (PRESENCE_PARTNERS_SQL, (1, "2024-01-01T00:00:00")),
+    "user_groups": (USER_GROUPS_SQL, (1,)),
+    "sync_new_messages": (SYNC_NEW_MESSAGES_SQL, (1, 1, 100, 1, 1, 1, 500)),
+    "sync_changes": (SYNC_CHANGES_SQL, (1, 1, 100, 600, 1, 1, 1)),
+    "search_messages": (SEARCH_MESSAGES_SQL, ("[", "]", '"hello"', 1, 1, 1, 20, 0)),
+    "search_private_messages": (SEARCH_PRIVATE_MESSAGES_SQL, ("[", "]", '"hello"', 1, 2, 2, 1, 20, 0)),
+    "search_group_messages": (SEARCH_GROUP_MESSAGES_SQL, ("[", "]", '"hello"', 1, 20, 0)),
+}
+
+RECENT_CHATS_LIMIT = 10
+CONVERSATION_PREVIEW_LENGTH = 100  # characters of the last message shown in the chat list
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+MAX_MESSAGE_ID = 2 ** 63 - 1
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+# Markers around the hit in snippets: control characters cannot clash with message text, so a client
+# can HTML-escape the snippet first and then turn them into highlighting
+SEARCH_MATCH_START = "\x02"
+SEARCH_MATCH_END = "\x03"
+
+def private_conv_key(user1_id: int, user2_id: int) -> str:
+    return f"p:{min(user1_id, user2_id)}:{max(user1_id, user2_id)}"
+
+def group_conv_key(group_id: int) -> str:
+    return f"g:{group_id}"
+
+def fetch_private_history_page(conn, user1_id: int, user2_id: int, before_id: int | None, after_id: int | None, limit: int):
+    # Rows come back oldest first whichever direction the page was read in
+    newer = after_id is not None and before_id is None
+    upper = before_id if before_id is not None else MAX_MESSAGE_ID
+    lower = after_id if after_id is not None else 0
+    cursor = conn.cursor()
+    cursor.execute(
+        PRIVATE_HISTORY_AFTER_SQL if newer else PRIVATE_HISTORY_SQL,
+        (user1_id, user1_id, user1_id, user2_id, upper, lower, limit, user2_id, user1_id, upper, lower, limit, limit)
+    )
+    rows = cursor.fetchall()
+    return rows if newer else rows[::-1]
+
+def fetch_group_history_page(conn, group_id: int, viewer_id: int, before_id: int | None, after_id: int | None, limit: int):
+    newer = after_id is not None and before_id is None
+    upper = before_id if before_id is not None else MAX_MESSAGE_ID
+    lower = after_id if after_id is not None else 0
+    cursor = conn.cursor()
+    cursor.execute(
+        GROUP_HISTORY_AFTER_SQL if newer else GROUP_HISTORY_SQL,
+        (viewer_id, viewer_id, group_id, upper, lower, limit)
+    )
+    rows = cursor.fetchall()
+    return rows if newer else rows[::-1]
+
+def fts_query(text: str) -> str:
+    # Every word is matched as a quoted term, the last one as a prefix so results show up while typing.
+    # Quoting keeps FTS5 operators and punctuation in user input from being parsed as query syntax.
+    terms = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+def search_messages(conn, query: str, scope_sql: str, scope_params: tuple, limit: int, offset: int) -> List[dict]:
+    cursor = conn.cursor()
+    cursor.execute(
+        scope_sql,
+        (SEARCH_MATCH_START, SEARCH_MATCH_END, fts_query(query), *scope_params, limit, offset)
+    )
+    return [
+        {
+            "id": row[0],
+            "content": row[1],
+            "timestamp": row[2],
+            "sender_id": row[3],
+            "receiver_id": row[4],
+            "group_id": row[5],
+            "username": row[6],
+            "avatar_url": row[7],
+            "snippet": row[8],
+            "rank": row[9]
+        }
+        for row in cursor.fetchall()
+    ]
+
+SYNC_PAGE_SIZE = 500
+
+def fetch_sync_page(conn, user_id: int, since: int, limit: int = SYNC_PAGE_SIZE) -> dict:
+    cursor = conn.cursor()
+    cursor.execute(SYNC_NEW_MESSAGES_SQL, (user_id, user_id, since, user_id, user_id, user_id, limit))
+    messages = [
+        {
+            "id": row[0],
+            "content": row[1],
+            "timestamp": row[2],
+            "sender_id": row[3],
+            "receiver_id": row[4],
+            "group_id": row[5],
+            "username": row[6],
+            "avatar_url": row[7],
+            "is_read": bool(row[8]),
+            "files": json.loads(row[9]) if row[9] else None
+        }
+        for row in cursor.fetchall()
+    ]
+    has_more = len(messages) == limit
+    last_message_id = messages[-1]["id"] if messages else since
+
+    # Changes to messages beyond this page are picked up when the page containing them is read,
+    # in their current state. Only the latest change per message matters.
+    cursor.execute(SYNC_CHANGES_SQL, (user_id, user_id, since, last_message_id, user_id, user_id, user_id))
+    # Sorted here rather than in SQL: an ORDER BY c.id tempts the planner into walking the whole log
+    changes = {}
+    for row in sorted(cursor.fetchall(), key=lambda r: r[11]):
+        changes.pop(row[0], None)
+        changes[row[0]] = row
+    edited = []
+    deleted = []
+    for message_id, row in changes.items():
+        if row[1] == "delete" or row[6] is None:
+            deleted.append({"action": "delete", "message_id": message_id, "receiver_id": row[3], "group_id": row[4]})
+        else:
+            edited.append({
+                "action": "edit",
+                "message_id": message_id,
+                "content": row[5],
+                "timestamp": row[6],
+                "sender_id": row[2],
+                "receiver_id": row[3],
+                "group_id": row[4],
+                "username": row[9],
+                "avatar_url": row[10],
+                "is_read": bool(row[8]),
+                "files": json.loads(row[7]) if row[7] else None
+            })
+    return {
+        "messages": messages,
+        "edited": edited,
+        "deleted": deleted,
+        "last_message_id": last_message_id,
+        "has_more": has_more
+    }
+
+def check_query_plans(conn) -> List[str]:
+    # Returns one line per hot query step that scans a whole table; an empty list means all plans are indexed
+    problems = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        # Scanning a materialized subquery or CTE only walks rows that were already found through an index
+        derived = {d.split()[1] for d in details if d.startswith(("MATERIALIZE ", "CO-ROUTINE "))}
+        for detail in details:
+            if (detail.startswith("SCAN ") and detail.split()[1] not in derived and detail != "SCAN CONSTANT ROW"
+                    and "VIRTUAL TABLE INDEX" not in detail):
+                problems.append(f"{name}: {detail}")
+    return problems
+
+def coalesce_key(message: dict):
+    # Events that a later event of the same key makes obsolete: the newest edit or delete of a message,
+    # the newest read position of a reader in a chat
+    action = message.get("action")
+    if action in ("edit", "delete"):
+        return ("message", message.get("message_id"))
+    if action == "read":
+        return ("read", message.get("user_id"), message.get("receiver_id"), message.get("group_id"))
+    if action == "ping":
+        return ("ping",)
+    if action == "typing":
+        return ("typing", message.get("group_id") or tuple(message.get("user_ids") or ()))
+    return None
+
+def encode_frame(message: dict, binary: bool) -> str | bytes:
+    if binary:
+        return wire.pack(message)
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+def join_frames(frames: list, binary: bool) -> str | bytes:
+    # Already encoded events as one array frame, without decoding them again
+    if binary:
+        return wire.array_header(len(frames)) + b"".join(frames)
+    return "[" + ",".join(frames) + "]"
+
+class WebSocketStats:
+    # Outbound WebSocket traffic. events are what the app queued and frames what it handed to the server
+    # after coalescing; payload and wire bytes are counted by ws_protocol.py, before and after
+    # permessage-deflate, and stay 0 under another protocol implementation. Only touched from the event loop.
+    def __init__(self, window: int = 10):
+        self.window = window
+        self.events = 0
+        self.frames = 0
+        self.payload_bytes = 0
+        self.wire_bytes = 0
+        self.deflate_sessions = 0
+        self._seconds = deque(maxlen=window + 1)  # [second, frames, wire bytes] for the recent rates
+
+    def _current(self) -> list:
+        second = int(time.monotonic())
+        if not self._seconds or self._seconds[-1][0] != second:
+            self._seconds.append([second, 0, 0])
+        return self._seconds[-1]
+
+    def record_frame(self, events: int):
+        self.events += events
+        self.frames += 1
+        self._current()[1] += 1
+
+    def record_wire(self, payload: int, wire_bytes: int):
+        self.payload_bytes += payload
+        self.wire_bytes += wire_bytes
+        self._current()[2] += wire_bytes
+
+    def snapshot(self) -> dict:
+        # Rates over the last full seconds of the window; the second in progress is left out
+        now = int(time.monotonic())
+        recent = [entry for entry in self._seconds if now - self.window <= entry[0] < now]
+        return {
+            "events": self.events,
+            "frames": self.frames,
+            "events_per_frame": self.events / self.frames if self.frames else 0.0,
+            "payload_bytes": self.payload_bytes,
+            "wire_bytes": self.wire_bytes,
+            "compression_ratio": self.wire_bytes / self.payload_bytes if self.payload_bytes else 1.0,
+            "frames_per_second": sum(entry[1] for entry in recent) / self.window,
+            "wire_bytes_per_second": sum(entry[2] for entry in recent) / self.window,
+            "deflate_sessions": self.deflate_sessions,
+        }
+
+ws_stats = WebSocketStats()
+
+class ClientConnection:
+    # One WebSocket with a bounded outbound queue drained by its own writer task, so a slow client
+    # only ever delays itself. What happens when the queue is full is set by WS_QUEUE_POLICY.
+    def __init__(self, websocket: WebSocket, user_id: int, binary: bool, batch: bool):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.binary = binary
+        self.batch = batch
+        self.last_sent = 0.0
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self.writer = asyncio.create_task(self._write())
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    async def receive(self) -> dict:
+        # Binary frames are MessagePack, text frames JSON, whichever protocol was negotiated
+        frame = await self.websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(frame.get("code", 1000))
+        self.touch()
+        if frame.get("bytes") is not None:
+            return wire.unpack(frame["bytes"])
+        return json.loads(frame["text"])
+
+    def enqueue(self, frame: str | bytes, key=None) -> bool:
+        if self.closed:
+            return False
+        if len(self.queue) >= WS_SEND_QUEUE_SIZE and not self._make_room(key):
+            print(f"Disconnecting slow client of user {self.user_id}: {len(self.queue)} messages queued")
+            self.close()
+            return False
+        self.queue.append((key, frame))
+        self.ready.set()
+        return True
+
+    def _make_room(self, key) -> bool:
+        if WS_QUEUE_POLICY == "drop_oldest":
+            self.queue.popleft()
+            return True
+        if WS_QUEUE_POLICY == "coalesce" and key is not None:
+            for index, (queued_key, _) in enumerate(self.queue):
+                if queued_key == key:
+                    del self.queue[index]
+                    return True
+        # "disconnect", or nothing to coalesce: the client reconnects and catches up with a resume
+        return False
+
+    async def _write(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                if self.batch:
+                    # Busy session: wait out the rest of the window, then send whatever has piled up
+                    wait = self.last_sent + WS_COALESCE_DELAY - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    frames = [self.queue.popleft()[1] for _ in range(min(len(self.queue), WS_COALESCE_MAX))]
+                    if not frames:
+                        continue
+                    frame = frames[0] if len(frames) == 1 else join_frames(frames, self.binary)
+                else:
+                    frames = [self.queue.popleft()[1]]
+                    frame = frames[0]
+                send = self.websocket.send_bytes if self.binary else self.websocket.send_text
+                await asyncio.wait_for(send(frame), timeout=WS_SEND_TIMEOUT)
+                self.last_sent = time.monotonic()
+                ws_stats.record_frame(len(frames))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Send to user {self.user_id} failed: {e!r}")
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        # Closing the socket ends the receive loop in websocket_endpoint, which then unregisters us
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1013), timeout=WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
 class ConnectionManager:
+    # Every user can have several sessions (tabs, devices); events go to all of them
+    def __init__(self):
+        self.active_connections: Dict[int, set] = {}
+        self.heartbeat = None
+
+    def start(self):
+        self.heartbeat = asyncio.create_task(self._heartbeat())
+
+    def stop(self):
+        if self.heartbeat:
+            self.heartbeat.cancel()
+
+    async def connect(self, websocket: WebSocket, user_id: int) -> ClientConnection:
+        binary = WS_BINARY_ENABLED and wire.SUBPROTOCOL in websocket.scope.get("subprotocols", ())
+        batch = WS_COALESCE_DELAY > 0 and websocket.query_params.get("batch") == "1"
+        await websocket.accept(subprotocol=wire.SUBPROTOCOL if binary else None)
+        connection = ClientConnection(websocket, user_id, binary, batch)
+        self.active_connections.setdefault(user_id, set()).add(connection)
+        return connection
+
+    def disconnect(self, user_id: int, connection: ClientConnection):
+        connection.closed = True
+        connection.writer.cancel()
+        sessions = self.active_connections.get(user_id)
+        if sessions is not None:
+            sessions.discard(connection)
+            if not sessions:
+                del self.active_connections[user_id]
+
+    async def send_personal_message(self, message: dict, user_id: int):
+        self.send_to_users([user_id], message)
+
+    def send_to_users(self, user_ids: List[int], message: dict):
+        # Encoded at most once per protocol and the same frame queued for every recipient;
+        # never waits on a client
+        frames = {}
+        key = coalesce_key(message)
+        for user_id in user_ids:
+            for connection in self.active_connections.get(user_id, ()):
+                frame = frames.get(connection.binary)
+                if frame is None:
+                    frame = frames[connection.binary] = encode_frame(message, connection.binary)
+                connection.enqueue(frame, key)
+
+    async def _heartbeat(self):
+        # Pings keep idle sessions talking; a session that has sent nothing for WS_IDLE_TIMEOUT is dead
+        # (closed laptop, lost network) and gets closed instead of sitting in memory until a send fails
+        pings = {binary: encode_frame({"action": "ping"}, binary) for binary in (False, True)}
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for sessions in list(self.active_connections.values()):
+                for connection in list(sessions):
+                    if now - connection.last_seen > WS_IDLE_TIMEOUT:
+                        print(f"Closing idle session of user {connection.user_id}")
+                        connection.close()
+                        self.disconnect(connection.user_id, connection)
+                    else:
+                        connection.enqueue(pings[connection.binary], ("ping",))
+
+manager = ConnectionManager()
+
+class MessageBus:
+    # Delivers events to users wherever their WebSocket lives. Handlers publish to the bus instead of
+    # calling the ConnectionManager directly; each process delivers to the sockets it holds.
+    def __init__(self, manager: ConnectionManager):
+        self.manager = manager
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def subscribe(self, user_id: int):
+        pass
+
+    async def unsubscribe(self, user_id: int):
+        pass
+
+    async def publish(self, user_ids: List[int], message: dict):
+        await self.deliver(user_ids, message)
+
+    async def deliver(self, user_ids: List[int], message: dict):
+        self.manager.send_to_users(user_ids, message)
+
+class InMemoryBus(MessageBus):
+    pass
+
+class UnixSocketBus(MessageBus):
+    # Every worker keeps a connection to one broker on a Unix-domain socket. The broker runs inside
+    # whichever worker holds the lock file; if that worker exits, the lock is released and another
+    # worker takes over. Workers tell the broker which users are connected to them, so a published
+    # event only travels to workers that have one of its recipients. Frames are JSON lines.
+    def __init__(self, manager: ConnectionManager, path: str):
+        super().__init__(manager)
+        self.path = path
+        self.lock_file = None
+        self.server = None
+        self.routes: Dict[int, set] = {}  # broker side: user id -> writers of the workers holding that user
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+        await asyncio.wait_for(self.connected.wait(), timeout=BUS_CONNECT_TIMEOUT)
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+        if self.server:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        if self.lock_file:
+            self.lock_file.close()
+
+    async def subscribe(self, user_id: int):
+        await self._send({"op": "sub", "user_id": user_id})
+
+    async def unsubscribe(self, user_id: int):
+        await self._send({"op": "unsub", "user_id": user_id})
+
+    async def publish(self, user_ids: List[int], message: dict):
+        # Local recipients are served directly; the broker forwards to the other workers
+        await self.deliver([user_id for user_id in user_ids if user_id in self.manager.active_connections], message)
+        await self._send({"op": "pub", "user_ids": user_ids, "message": message})
+
+    async def _send(self, frame: dict):
+        # While the broker is being replaced there is nowhere to send; subscriptions are replayed on reconnect
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(json.dumps(frame).encode() + b"\n")
+            await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            print(f"Message bus send failed: {e}")
+
+    async def _run(self):
+        while True:
+            await self._become_broker_if_free()
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=BUS_MAX_FRAME)
+            except OSError:
+                await asyncio.sleep(0.1)
+                continue
+            self.writer = writer
+            for user_id in list(self.manager.active_connections):
+                await self.subscribe(user_id)
+            self.connected.set()
+            try:
+                while line := await reader.readline():
+                    frame = json.loads(line)
+                    await self.deliver(frame["user_ids"], frame["message"])
+            except (ConnectionError, OSError, ValueError) as e:
+                print(f"Message bus connection lost: {e}")
+            finally:
+                self.connected.clear()
+                self.writer = None
+                writer.close()
+            await asyncio.sleep(0.1)
+
+    async def _become_broker_if_free(self):
+        if self.server is not None:
+            return
+        import fcntl
+        if self.lock_file is None:
+            self.lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        # Holding the lock means any socket file left behind belongs to a broker that is gone
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve_worker, path=self.path, limit=BUS_MAX_FRAME)
+        print(f"Message bus broker listening on {self.path}")
+
+    async def _serve_worker(self, reader, writer):
+        subscribed = set()
+        try:
+            while line := await reader.readline():
+                frame = json.loads(line)
+                if frame["op"] == "sub":
+                    self.routes.setdefault(frame["user_id"], set()).add(writer)
+                    subscribed.add(frame["user_id"])
+                elif frame["op"] == "unsub":
+                    self.routes.get(frame["user_id"], set()).discard(writer)
+                    subscribed.discard(frame["user_id"])
+                elif frame["op"] == "pub":
+                    # One frame per worker, carrying only the recipients that worker holds
+                    targets: Dict[asyncio.StreamWriter, list] = {}
+                    for user_id in frame["user_ids"]:
+                        for target in self.routes.get(user_id, ()):
+                            if target is not writer:
+                                targets.setdefault(target, []).append(user_id)
+                    for target, user_ids in targets.items():
+                        try:
+                            target.write(json.dumps({"user_ids": user_ids, "message": frame["message"]}).encode() + b"\n")
+                            await target.drain()
+                        except (ConnectionError, OSError):
+                            pass
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"Message bus worker connection lost: {e}")
+        finally:
+            for user_id in subscribed:
+                self.routes.get(user_id, set()).discard(writer)
+                if not self.routes.get(user_id):
+                    self.routes.pop(user_id, None)
+            writer.close()
+
+if BUS_BACKEND == "unix":
+    bus = UnixSocketBus(manager, BUS_SOCKET_PATH)
+elif BUS_BACKEND == "memory":
+    bus = InMemoryBus(manager)
+else:
+    raise RuntimeError(f"Unknown BUS_BACKEND: {BUS_BACKEND}")
+
+def fetch_recipient_ids(conn, sender_id: int, receiver_id: int | None, group_id: int | None) -> List[int]:
+    # Everyone who should see an event in a chat: all group members, or both sides of a private chat
+    if group_id:
+        cursor = conn.cursor()
+        cursor.execute(GROUP_MEMBER_IDS_SQL, (group_id,))
+        return [row[0] for row in cursor.fetchall()]
+    recipient_ids = [sender_id]
+    if receiver_id and receiver_id != sender_id:
+        recipient_ids.append(receiver_id)
+    return recipient_ids
+
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (sender_id, receiver_id, group_id, content, timestamp, is_read, files)
+    VALUES (?, ?, ?, ?, ?, 0, ?)
+"""
+
+def insert_message_batch(conn, items: list) -> list:
+    # All messages of a batch in one transaction. Returns (message_id, timestamp, recipient_ids) per
+    # message, or the error for a message that could not be stored; the others are committed anyway.
+    cursor = conn.cursor()
+    timestamp = datetime.utcnow().isoformat()
+    recipients = {}
+    results = []
+    for sender_id, message in items:
+        receiver_id, group_id = message.get("receiver_id"), message.get("group_id")
+        try:
+            files_json = json.dumps(message.get("files")) if message.get("files") else None
+            cursor.execute(INSERT_MESSAGE_SQL, (sender_id, receiver_id, group_id, message.get("content"), timestamp, files_json))
+            message_id = cursor.lastrowid
+            key = (sender_id, receiver_id, group_id)
+            if key not in recipients:
+                recipients[key] = fetch_recipient_ids(conn, sender_id, receiver_id, group_id)
+            results.append((message_id, timestamp, recipients[key]))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            results.append(e)
+    conn.commit()
+    return results
+
+class MessageWriter:
+    # Group commit for chat messages. Senders queue their message and wait for its id; the writer task
+    # takes whatever is queued, waits up to MESSAGE_BATCH_DELAY for more (or until MESSAGE_BATCH_SIZE)
+    # and stores the batch with one commit, so a burst costs one fsync instead of one per message.
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
+        self.queue = None
+        self.arrived = None
+        self.task = None
+        self.batches = 0
+        self.messages = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(MESSAGE_QUEUE_SIZE)
+        self.arrived = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Whatever is queued is still written
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+
+    async def write(self, sender_id: int, message: dict):
+        # Returns (message_id, timestamp, recipient_ids) once the message is committed
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sender_id, message, future))
+        self.arrived.set()
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch": self.messages / self.batches if self.batches else 0.0,
+            "queued": self.queue.qsize() if self.queue else 0,
+        }
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = loop.time() + MESSAGE_BATCH_DELAY
+            while len(batch) < MESSAGE_BATCH_SIZE:
+                if self.queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    self.arrived.clear()
+                    try:
+                        await asyncio.wait_for(self.arrived.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    continue
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        try:
+            results = await run_db(insert_message_batch, [(sender_id, message) for sender_id, message, _ in batch])
+        except Exception as e:
+            print(f"Failed to store a batch of {len(batch)} messages: {e}")
+            results = [e] * len(batch)
+        self.batches += 1
+        self.messages += len(batch)
+        for (_, _, future), result in zip(batch, results):
+            # A sender that disconnected meanwhile has cancelled its future
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+message_writer = MessageWriter()
 
-    def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+def fetch_presence_partners(conn, user_ids: List[int]) -> Dict[int, List[int]]:
+    since = (datetime.utcnow() - timedelta(days=PRESENCE_RECENT_DAYS)).isoformat()
+    cursor = conn.cursor()
+    partners = {}
+    for user_id in user_ids:
+        cursor.execute(PRESENCE_PARTNERS_SQL, (user_id, since))
+        partners[user_id] = [row[0] for row in cursor.fetchall() if row[0] != user_id]
+    return partners
+
+class PresenceTracker:
+    # Online/offline status from ConnectionManager sessions. Connects and disconnects only mark the user;
+    # every PRESENCE_INTERVAL the marked users whose status really changed are announced, with one event
+    # per distinct set of changes, so a reconnect or a flapping tab announces nothing and a wave of logins
+    # costs each partner a single frame. With several workers each one only knows its own sessions.
+    def __init__(self):
+        self.announced = set()  # users last announced as online
+        self.changed = set()
+        self.task = None
 
-    async def send_personal_message(self, message: dict, user_id: int):  
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_json(message)
+    def start(self):
+        self.task = asyncio.create_task(self._run())
 
-manager = ConnectionManager()
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    def mark(self, user_id: int):
+        self.changed.add(user_id)
+
+    async def snapshot(self, connection: ClientConnection):
+        # A new session learns which of its partners are online; later changes arrive as events
+        partners = (await run_db(fetch_presence_partners, [connection.user_id]))[connection.user_id]
+        online = [user_id for user_id in partners if user_id in self.announced]
+        if online:
+            event = {"action": "presence", "online": online, "offline": []}
+            connection.enqueue(encode_frame(event, connection.binary))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Presence flush failed: {e!r}")
+
+    async def flush(self):
+        changed, self.changed = self.changed, set()
+        online = [user_id for user_id in changed
+                  if user_id in manager.active_connections and user_id not in self.announced]
+        offline = [user_id for user_id in changed
+                   if user_id not in manager.active_connections and user_id in self.announced]
+        if not online and not offline:
+            return
+        self.announced.update(online)
+        self.announced.difference_update(offline)
+
+        partners = await run_db(fetch_presence_partners, online + offline)
+        changes = {}  # recipient -> (came online, went offline)
+        for user_id in online + offline:
+            for partner_id in partners[user_id]:
+                changes.setdefault(partner_id, ([], []))[0 if user_id in self.announced else 1].append(user_id)
+        audiences = {}
+        for partner_id, (came, went) in changes.items():
+            audiences.setdefault((tuple(came), tuple(went)), []).append(partner_id)
+        for (came, went), recipient_ids in audiences.items():
+            await bus.publish(recipient_ids, {"action": "presence", "online": list(came), "offline": list(went)})
+
+presence = PresenceTracker()
+
+class TypingRelay:
+    # "typing" events from clients. A user is relayed at most once per TYPING_INTERVAL per chat; group
+    # typists are collected and every group gets at most one event per TYPING_GROUP_INTERVAL naming them
+    # all, so however many people type in a 1,000-member group, each member gets about one frame a second.
+    def __init__(self):
+        self.relayed = {}  # (user id, receiver id, group id) -> when it was last let through
+        self.groups: Dict[int, set] = {}  # group id -> users who typed since the last flush
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    async def typing(self, user_id: int, receiver_id, group_id):
+        if not isinstance(receiver_id, (int, type(None))) or not isinstance(group_id, (int, type(None))):
+            return
+        key = (user_id, receiver_id, group_id)
+        now = time.monotonic()
+        if now - self.relayed.get(key, -TYPING_INTERVAL) < TYPING_INTERVAL:
+            return
+        self.relayed[key] = now
+        if group_id:
+            self.groups.setdefault(group_id, set()).add(user_id)
+        elif receiver_id and receiver_id != user_id:
+            await bus.publish([receiver_id], {"action": "typing", "user_ids": [user_id]})
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TYPING_GROUP_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Typing flush failed: {e!r}")
+
+    async def flush(self):
+        cutoff = time.monotonic() - TYPING_INTERVAL
+        self.relayed = {key: at for key, at in self.relayed.items() if at > cutoff}
+        groups, self.groups = self.groups, {}
+        if not groups:
+            return
+
+        def fetch_members(conn):
+            return {group_id: fetch_recipient_ids(conn, None, None, group_id) for group_id in groups}
+
+        for group_id, member_ids in (await run_db(fetch_members)).items():
+            typists = sorted(groups[group_id].intersection(member_ids))
+            if not typists:
+                continue
+            profiles = await load_profiles(typists)
+            await bus.publish(member_ids, {
+                "action": "typing",
+                "group_id": group_id,
+                "user_ids": typists,
+                "usernames": [profiles[user_id]["username"] if user_id in profiles else None for user_id in typists],
+            })
+
+typing_relay = TypingRelay()
+
+def update_read_cursor(conn, user_id: int, conv_key: str) -> int | None:
+    # Returns the new read position, or None if the conversation has no messages yet
+    cursor = conn.cursor()
+    cursor.execute(MARK_READ_SQL, (user_id, datetime.utcnow().isoformat(), conv_key))
+    rows = cursor.fetchall()
+    conn.commit()
+    return rows[0][0] if rows else None
+
+def conversation_key(sender_id: int, receiver_id: int | None, group_id: int | None) -> str:
+    return group_conv_key(group_id) if group_id else private_conv_key(sender_id, receiver_id)
+
+def fetch_conversation_state(conn, sender_id: int, receiver_id: int | None, group_id: int | None) -> dict:
+    # What the chat list shows after an edit or delete: the conversation's last message
+    # (last_message_id 0 once a private chat has none left)
+    cursor = conn.cursor()
+    cursor.execute(CONVERSATION_STATE_SQL, (CONVERSATION_PREVIEW_LENGTH, conversation_key(sender_id, receiver_id, group_id)))
+    row = cursor.fetchone()
+    if row is None:
+        return {"last_message_id": 0, "last_activity": None, "preview": None}
+    return {"last_message_id": row[0], "last_activity": row[1], "preview": row[2]}
+
+def fetch_read_past(conn, sender_id: int, receiver_id: int | None, group_id: int | None, message_id: int) -> set:
+    # Who no longer counts message_id as unread. Must run before the message is deleted: deleting the
+    # last message of a private chat drops the conversation together with its read cursors.
+    cursor = conn.cursor()
+    cursor.execute(READ_PAST_SQL, (conversation_key(sender_id, receiver_id, group_id), message_id))
+    return {row[0] for row in cursor.fetchall()}
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def fetch_sender_unread(conn, sender_id: int, group_id: int) -> dict:
+    # Unread deltas for deleting all of sender_id's messages in a group. Must run before the delete.
+    cursor = conn.cursor()
+    cursor.execute(GROUP_SENDER_UNREAD_SQL, (group_conv_key(group_id), sender_id, group_id, sender_id))
+    return {row[0]: -row[1] for row in cursor.fetchall()}
+
+async def publish_conversation_update(sender_id: int, receiver_id: int | None, group_id: int | None,
+                                      recipient_ids: List[int], update: dict, unread_delta: int = 0,
+                                      read_ids=frozenset(), unread_deltas: dict | None = None):
+    # conversation_updated keeps the chat list current without re-fetching /messages/recent. Every
+    # recipient but the sender and read_ids gets unread_delta (or their own from unread_deltas, after a
+    # bulk delete); in a private chat each side sees the other as user_id. One event per distinct view,
+    # so a group message costs two encodings at most.
+    audiences = {}
+    for user_id in recipient_ids:
+        partner_id = None if group_id else (receiver_id if user_id == sender_id else sender_id)
+        if unread_deltas is not None:
+            delta = unread_deltas.get(user_id, 0)
+        else:
+            delta = 0 if user_id == sender_id or user_id in read_ids else unread_delta
+        audiences.setdefault((partner_id, delta), []).append(user_id)
+    for (partner_id, delta), user_ids in audiences.items():
+        await bus.publish(user_ids, {
+            "action": "conversation_updated",
+            "user_id": partner_id,
+            "group_id": group_id,
+            **update,
+            "unread_delta": delta,
+        })
+
+async def publish_group_departure(user_id: int, group_id: int, recipient_ids: List[int], state: dict,
+                                  unread_deltas: dict):
+    # A member left or was removed together with their messages: the others get the new last message
+    # and lose those messages from their unread counts, the member's own sessions drop the group
+    await publish_conversation_update(user_id, None, group_id, recipient_ids, state, unread_deltas=unread_deltas)
+    await bus.publish([user_id], {"action": "conversation_updated", "user_id": None, "group_id": group_id,
+                                  "removed": True})
+
+def message_preview(content) -> str | None:
+    return content[:CONVERSATION_PREVIEW_LENGTH] if isinstance(content, str) and content else None
+
+# Workers are spawned rather than forked. A spawned worker imports the script that started the process and
+# then passwords.py; started through run.py (or the uvicorn CLI) that script does nothing, so the workers
+# never import this module. `python main.py` hands over to run.py for the same reason.
+password_executor = ProcessPoolExecutor(
+    max_workers=PASSWORD_POOL_SIZE, mp_context=multiprocessing.get_context("spawn")
+)
+password_jobs = 0
+
+async def run_password_job(fn, *args):
+    global password_jobs
+    if password_jobs >= PASSWORD_POOL_SIZE + PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many sign-in requests, try again shortly",
+            headers={"Retry-After": "1"}
+        )
+    password_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    finally:
+        password_jobs -= 1
+
+async def verify_password(plain_password, hashed_password):
+    # Returns (valid, new_hash); new_hash is set when the stored hash should be upgraded to BCRYPT_ROUNDS
+    return await run_password_job(passwords.verify_and_update, plain_password, hashed_password, BCRYPT_ROUNDS)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await run_password_job(passwords.hash_password, password, BCRYPT_ROUNDS)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -235,17 +2235,15 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def create_reset_token(user_id: int):
+def create_reset_token(conn, user_id: int):
     token = str(uuid.uuid4())
     expires_at = (datetime.utcnow() + timedelta(minutes=RESET_TOKEN_EXPIRE_MINUTES)).isoformat()
-    conn = sqlite3.connect("chat.db")
     cursor = conn.cursor()
     cursor.execute(
         "INSERT INTO password_reset_tokens (token, user_id, expires_at) VALUES (?, ?, ?)",
         (token, user_id, expires_at)
     )
     conn.commit()
-    conn.close()
     return token
 
 def send_reset_email(email: str, reset_link: str):
@@ -283,103 +2281,291 @@ def send_reset_email(email: str, reset_link: str):
         print(f"Ошибка отправки email: {e}")
         raise HTTPException(status_code=500, detail=f"Не удалось отправить email: {str(e)}")
 
+class TTLCache:
+    # LRU-bounded mapping whose entries also expire; only used from the event loop, so no locking
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+# token -> user id (skips the JWT decode), and user id -> (user dict, is_admin)
+token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+identity_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+def decode_token_user_id(token: str, credentials_exception: HTTPException) -> int:
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id = payload.get("sub")
+        if user_id is None:
+            raise credentials_exception
+    except JWTError as e:
+        print(f"JWT Error: {e}")
+        raise credentials_exception
+    # Never keep a token around past its own expiry
+    token_cache.put(token, int(user_id), ttl=payload.get("exp", 0) - time.time())
+    return int(user_id)
+
+async def load_identity(user_id: int):
+    # Returns (user dict, is_admin) or None; callers get copies so they can't change the cached entry
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        def fetch_user(conn):
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id, username, email, mobile, date_of_birth, avatar_url, is_admin FROM users WHERE id = ?",
+                (user_id,)
+            )
+            return cursor.fetchone()
+
+        user = await run_db(fetch_user)
+        if user is None:
+            return None
+        identity = (
+            {"id": user[0], "username": user[1], "email": user[2], "mobile": user[3], "date_of_birth": user[4], "avatar_url": user[5]},
+            bool(user[6])
+        )
+        identity_cache.put(user_id, identity)
+    return dict(identity[0]), identity[1]
+
+# user id -> {"username", "avatar_url"}; shared by every history page, so the users table is read
+# once per sender rather than once per message
+profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+async def load_profiles(user_ids) -> dict:
+    # Cached profiles plus one IN query for the rest; users that no longer exist are left out
+    profiles = {}
+    missing = []
+    for user_id in set(user_ids):
+        profile = profile_cache.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = profile
+    if missing:
+        def fetch_profiles(conn):
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT id, username, avatar_url FROM users WHERE id IN ({','.join('?' * len(missing))})",
+                missing
+            )
+            return cursor.fetchall()
+
+        for user_id, username, avatar_url in await run_db(fetch_profiles):
+            profile = {"username": username, "avatar_url": avatar_url}
+            profile_cache.put(user_id, profile)
+            profiles[user_id] = profile
+    return profiles
+
+async def history_response(rows, compact: bool, no_files=None) -> ORJSONResponse:
+    # rows in the *_HISTORY_SQL layout. Without compact every message carries its sender's profile as
+    # before; with it the profiles are sent once in a users map.
+    # List endpoints build their dicts from database rows in exactly the response_model's shape and
+    # return them as ORJSONResponse: that skips FastAPI's validate-then-serialize pass over every row,
+    # while the response_model on the route still describes the response in the OpenAPI schema.
+    profiles = await load_profiles(row[3] for row in rows)
+    messages = []
+    for row in rows:
+        profile = profiles.get(row[3])
+        if profile is None:
+            continue  # the sender is gone; the users JOIN used to drop these rows too
+        message = {
+            "id": row[0],
+            "content": row[1],
+            "timestamp": row[2],
+            "sender_id": row[3],
+            "receiver_id": row[4],
+            "group_id": row[5],
+            "is_read": bool(row[6]),
+            "files": json.loads(row[7]) if row[7] else no_files
+        }
+        if not compact:
+            message.update(profile)
+        messages.append(message)
+    if compact:
+        return ORJSONResponse({"messages": messages, "users": profiles})
+    return ORJSONResponse(messages)
+
 async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    if token:
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user_id: str = payload.get("sub")
-            if user_id is None:
-                raise credentials_exception
-        except JWTError as e:
-            print(f"JWT Error: {e}")
-            raise credentials_exception
-    else:
+    if not token:
         token = request.query_params.get("token")
         if not token:
             raise credentials_exception
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user_id: str = payload.get("sub")
-            if user_id is None:
-                raise credentials_exception
-        except JWTError as e:
-            print(f"JWT Error: {e}")
-            raise credentials_exception
+    user_id = decode_token_user_id(token, credentials_exception)
 
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, email, mobile, date_of_birth, avatar_url FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    if user is None:
+    identity = await load_identity(user_id)
+    if identity is None:
         raise credentials_exception
-    return {"id": user[0], "username": user[1], "email": user[2], "mobile": user[3], "date_of_birth": user[4], "avatar_url": user[5]}
+    return identity[0]
+
+def accepted_encodings(header: str) -> set:
+    # Content codings from an Accept-Encoding header, minus the ones refused with q=0
+    accepted = set()
+    for item in header.lower().split(","):
+        name, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            continue
+        if quality > 0:
+            accepted.add(name.strip())
+    return accepted
+
+class PageCache:
+    # Static HTML pages with precompressed bodies and strong ETags (one per encoding, as the bytes
+    # differ). Requests carrying a matching If-None-Match get 304 without a body.
+    def __init__(self):
+        self.pages = {}
+
+    def _load(self, path: str) -> dict:
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            body = f.read()
+        # Point the page at the fingerprinted assets
+        body = assets.rewrite_urls(body.decode("utf-8"), asset_manifest).encode("utf-8")
+        tag = hashlib.sha256(body).hexdigest()[:32]
+        bodies = {"identity": body, "gzip": gzip.compress(body, 9)}
+        if brotli is not None:
+            bodies["br"] = brotli.compress(body, quality=11)
+        return {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "checked": time.monotonic(),
+            "bodies": bodies,
+            "etags": {encoding: f'"{tag}-{encoding}"' for encoding in bodies},
+        }
+
+    def _changed(self, path: str, page: dict) -> bool:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return True
+        return stat.st_mtime_ns != page["mtime_ns"] or stat.st_size != page["size"]
+
+    async def preload(self, paths: List[str]):
+        for path in paths:
+            self.pages[path] = await asyncio.to_thread(self._load, path)
+
+    async def get(self, path: str) -> dict:
+        page = self.pages.get(path)
+        if page is not None and time.monotonic() - page["checked"] > PAGE_CACHE_CHECK_INTERVAL:
+            if self._changed(path, page):
+                page = None
+            else:
+                page["checked"] = time.monotonic()
+        if page is None:
+            page = self.pages[path] = await asyncio.to_thread(self._load, path)
+        return page
+
+    async def response(self, request: Request, path: str) -> Response:
+        page = await self.get(path)
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next((e for e in ("br", "gzip") if e in accepted and e in page["bodies"]), "identity")
+        headers = {"ETag": page["etags"][encoding], "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            presented = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in presented or presented & set(page["etags"].values()):
+                return Response(status_code=304, headers=headers)
+        return Response(content=page["bodies"][encoding], media_type="text/html; charset=utf-8", headers=headers)
+
+page_cache = PageCache()
 
 @app.get("/", response_class=HTMLResponse)
-async def get_signin():
-    with open("signin.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+async def get_signin(request: Request):
+    return await page_cache.response(request, "signin.html")
 
 @app.get("/signup", response_class=HTMLResponse)
-async def get_signup():
-    with open("signup.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+async def get_signup(request: Request):
+    return await page_cache.response(request, "signup.html")
 
 @app.get("/forgot-password", response_class=HTMLResponse)
-async def get_forgot_password():
-    with open("forgot-password.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+async def get_forgot_password(request: Request):
+    return await page_cache.response(request, "forgot-password.html")
 
 @app.post("/forgot-password")
 async def forgot_password(email: str = Form(...)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
-    user = cursor.fetchone()
-    if not user:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Пользователь с таким email не найден")
-    
-    user_id = user[0]
-    reset_token = create_reset_token(user_id)
+    def issue_reset_token(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
+        user = cursor.fetchone()
+        if not user:
+            raise HTTPException(status_code=404, detail="Пользователь с таким email не найден")
+        return create_reset_token(conn, user[0])
+
+    reset_token = await run_db(issue_reset_token)
     reset_link = f"http://localhost:8000/reset-password?token={reset_token}"
-    
+
     # Send the reset link via email
     send_reset_email(email, reset_link)
-    
-    conn.close()
+
     return {"message": "Ссылка для сброса пароля отправлена на ваш email"}
 
-@app.get("/reset-password", response_class=HTMLResponse)
-async def get_reset_password(request: Request):
-    token = request.query_params.get("token")
-    if not token:
-        raise HTTPException(status_code=400, detail="Токен для сброса пароля отсутствует")
-    
-    conn = sqlite3.connect("chat.db")
+def check_reset_token(conn, token: str) -> int:
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, expires_at FROM password_reset_tokens WHERE token = ?", (token,))
     token_data = cursor.fetchone()
     if not token_data:
-        conn.close()
         raise HTTPException(status_code=400, detail="Недействительный токен для сброса пароля")
-    
+
     user_id, expires_at = token_data
     expires_at = datetime.fromisoformat(expires_at)
     if datetime.utcnow() > expires_at:
         cursor.execute("DELETE FROM password_reset_tokens WHERE token = ?", (token,))
         conn.commit()
-        conn.close()
         raise HTTPException(status_code=400, detail="Срок действия токена истёк")
+    return user_id
+
+@app.get("/reset-password", response_class=HTMLResponse)
+async def get_reset_password(request: Request):
+    token = request.query_params.get("token")
+    if not token:
+        raise HTTPException(status_code=400, detail="Токен для сброса пароля отсутствует")
     
-    conn.close()
-    with open("reset-password.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    await run_db(check_reset_token, token)
+    return await page_cache.response(request, "reset-password.html")
 
 @app.post("/reset-password")
 async def reset_password(
@@ -393,84 +2579,579 @@ async def reset_password(
     if len(new_password) < 6:
         raise HTTPException(status_code=400, detail="Пароль должен содержать минимум 6 символов")
 
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, expires_at FROM password_reset_tokens WHERE token = ?", (token,))
-    token_data = cursor.fetchone()
-    if not token_data:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Недействительный токен для сброса пароля")
-    
-    user_id, expires_at = token_data
-    expires_at = datetime.fromisoformat(expires_at)
-    if datetime.utcnow() > expires_at:
+    user_id = await run_db(check_reset_token, token)
+    hashed_password = await get_password_hash(new_password)
+
+    def store_password(conn):
+        cursor = conn.cursor()
+        # Consuming the token first makes a concurrent second reset with the same token fail
         cursor.execute("DELETE FROM password_reset_tokens WHERE token = ?", (token,))
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=400, detail="Недействительный токен для сброса пароля")
+        cursor.execute(
+            "UPDATE users SET hashed_password = ? WHERE id = ?",
+            (hashed_password, user_id)
+        )
         conn.commit()
-        conn.close()
-        raise HTTPException(status_code=400, detail="Срок действия токена истёк")
-    
-    hashed_password = get_password_hash(new_password)
-    cursor.execute(
-        "UPDATE users SET hashed_password = ? WHERE id = ?",
-        (hashed_password, user_id)
-    )
-    cursor.execute("DELETE FROM password_reset_tokens WHERE token = ?", (token,))
-    conn.commit()
-    conn.close()
+
+    await run_db(store_password)
+    identity_cache.invalidate(user_id)
     return {"message": "Пароль успешно сброшен"}
 
+# Accepted upload types: kind of file, extension of the stored blob and a check on the first bytes,
+# so the declared content type can't smuggle in something else
+UPLOAD_TYPES = {
+    "image/jpeg": ("image", ".jpg", lambda head: head.startswith(b"\xff\xd8\xff")),
+    "image/png": ("image", ".png", lambda head: head.startswith(b"\x89PNG\r\n\x1a\n")),
+    "image/gif": ("image", ".gif", lambda head: head.startswith((b"GIF87a", b"GIF89a"))),
+    "video/mp4": ("video", ".mp4", lambda head: head[4:8] == b"ftyp"),
+    "video/webm": ("video", ".webm", lambda head: head.startswith(b"\x1a\x45\xdf\xa3")),
+    "application/pdf": ("file", ".pdf", lambda head: head.startswith(b"%PDF-")),
+    "text/plain": ("file", ".txt", lambda head: b"\x00" not in head),
+}
+UPLOAD_SNIFF_SIZE = 16
+
+STORE_BLOB_SQL = """
+    INSERT INTO blobs (url, digest, size, ref_count, uploaded_at) VALUES (?, ?, ?, 0, ?)
+    ON CONFLICT (url) DO UPDATE SET uploaded_at = excluded.uploaded_at
+"""
+
+def store_blob(conn, part_path: str, directory: str, digest: str, extension: str, size: int) -> str:
+    # Moves a finished upload to its content address and returns its URL; a second upload of the same
+    # content lands on the same file. Row and file are handled under the database write lock, which the
+    # collector also holds while deleting, so it can't remove a blob that was uploaded again meanwhile.
+    name = digest + extension
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(STORE_BLOB_SQL, (f"/{directory}/{name}", digest, size, datetime.utcnow().isoformat()))
+        os.replace(part_path, os.path.join(directory, name))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return f"/{directory}/{name}"
+
+def collect_blobs(conn) -> int:
+    # Deletes blobs that nothing has referenced since BLOB_GC_GRACE; returns how many were removed
+    cutoff = (datetime.utcnow() - timedelta(seconds=BLOB_GC_GRACE)).isoformat()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        urls = [row[0] for row in conn.execute(
+            "DELETE FROM blobs WHERE ref_count = 0 AND uploaded_at < ? RETURNING url", (cutoff,)
+        )]
+        for url in urls:
+            path = url.lstrip("/")
+            variants = glob.glob(glob.escape(os.path.splitext(path)[0]) + ".w*.webp")
+            for file_path in [path, media.placeholder_path(path), *variants]:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(urls)
+
+def spool_avatar(avatar: UploadFile) -> tuple:
+    # Reads, hashes and writes the avatar next to its final place without holding a database connection,
+    # like StreamingUpload does for attachments. Returns the store_blob arguments after conn.
+    if avatar.content_type not in ["image/jpeg", "image/png"]:
+        raise HTTPException(status_code=400, detail="Only JPEG or PNG images are allowed")
+    part_path = os.path.join(AVATARS_DIR, f"{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_path, "wb") as f:
+            while block := avatar.file.read(UPLOAD_WRITE_SIZE):
+                f.write(block)
+                digest.update(block)
+                size += len(block)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return part_path, AVATARS_DIR, digest.hexdigest(), UPLOAD_TYPES[avatar.content_type][1], size
+
+def store_avatar(conn, spooled: tuple) -> str:
+    # The blob row and the rename only, inside run_db
+    avatar_url = store_blob(conn, *spooled)
+    submit_media_job(avatar_url.lstrip("/"))
+    return avatar_url
+
+def discard_avatar(spooled: tuple | None):
+    # The part file of an avatar that was never stored (validation failed or the row could not be written)
+    if spooled and os.path.exists(spooled[0]):
+        os.remove(spooled[0])
+
+# Thumbnails are made in their own spawned pool so a burst of photo uploads never holds up logins. As with
+# password_executor, the workers import media.py and the starting script, never this module.
+media_executor = ProcessPoolExecutor(
+    max_workers=MEDIA_POOL_SIZE, mp_context=multiprocessing.get_context("spawn")
+)
+media_jobs = {}
+media_jobs_lock = threading.Lock()  # jobs are submitted from the event loop and from DB threads (avatars)
+MEDIA_IMAGE_EXTENSIONS = {extension for kind, extension, _ in UPLOAD_TYPES.values() if kind == "image"}
+BLOB_URL_RE = re.compile(r"^/static/(uploads|avatars)/[0-9a-f]{64}(\.[a-z0-9]+)$")
+
+def submit_media_job(path: str):
+    # Starts making the variants of an image blob unless that is already under way. Returns the job's
+    # future, or None when the queue is full; the variants are then made on first request instead.
+    with media_jobs_lock:
+        future = media_jobs.get(path)
+        if future is not None:
+            return future
+        if len(media_jobs) >= MEDIA_QUEUE_LIMIT:
+            return None
+        future = media_executor.submit(media.make_variants, path, MEDIA_THUMBNAIL_WIDTHS, MEDIA_PLACEHOLDER_WIDTH)
+        media_jobs[path] = future
+    future.add_done_callback(lambda done: finish_media_job(path, done))
+    return future
+
+def finish_media_job(path: str, future):
+    with media_jobs_lock:
+        media_jobs.pop(path, None)
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Не удалось создать миниатюры для {path}: {future.exception()}")
+
+async def wait_for_thumbnails(file_url: str) -> dict:
+    # {"thumbnails": {width: url}, "placeholder": data URI} for an uploaded image, or {} if making them
+    # takes longer than MEDIA_WAIT_TIMEOUT; the job keeps running either way
+    future = submit_media_job(file_url.lstrip("/"))
+    if future is None:
+        return {}
+    try:
+        placeholder = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), MEDIA_WAIT_TIMEOUT)
+    except Exception:
+        return {}
+    if placeholder is None:
+        return {}
+    path = file_url.lstrip("/")
+    return {
+        "thumbnails": {str(width): "/" + media.variant_path(path, width) for width in MEDIA_THUMBNAIL_WIDTHS},
+        "placeholder": placeholder,
+    }
+
+class UploadStats:
+    # Throughput of /upload-file; only touched from the event loop
+    def __init__(self):
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self.active,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "bytes": self.bytes,
+            "avg_mb_per_s": self.bytes / self.seconds / 1024 / 1024 if self.seconds else 0.0,
+        }
+
+upload_stats = UploadStats()
+
+class StreamingUpload:
+    # Parses the multipart body as it arrives and writes the "file" part straight into UPLOADS_DIR,
+    # without spooling it to a temporary file first. The type is checked against the first bytes and
+    # the size against the limit for that type while streaming, so a bad upload is cut off early.
+    # The content is hashed on the way and the finished file stored as a blob under its digest.
+    def __init__(self):
+        self.events = []
+        self.header_field = b""
+        self.header_value = b""
+        self.headers = {}
+        self.in_file_part = False
+        self.filename = None
+        self.content_type = None
+        self.file_type = None
+        self.limit = 0
+        self.size = 0
+        self.head = b""
+        self.pending = bytearray()
+        self.file = None
+        self.path = None
+        self.digest = None
+        self.file_url = None
+
+    def _callbacks(self):
+        def on_header_field(data, start, end):
+            self.header_field += data[start:end]
+
+        def on_header_value(data, start, end):
+            self.header_value += data[start:end]
+
+        def on_header_end():
+            self.headers[self.header_field.lower()] = self.header_value
+            self.header_field = b""
+            self.header_value = b""
+
+        return {
+            "on_part_begin": lambda: self.headers.clear(),
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": lambda: self.events.append(("headers", dict(self.headers))),
+            "on_part_data": lambda data, start, end: self.events.append(("data", data[start:end])),
+            "on_part_end": lambda: self.events.append(("end", None)),
+        }
+
+    async def receive(self, request: Request) -> dict:
+        _, params = parse_options_header(request.headers.get("content-type", ""))
+        if b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+        content_length = int(request.headers.get("content-length") or 0)
+        if content_length > max(UPLOAD_MAX_MB.values()) * 1024 * 1024 + 64 * 1024:
+            raise HTTPException(status_code=413, detail="File is too large")
+
+        parser = MultipartParser(params[b"boundary"], self._callbacks())
+        started = time.perf_counter()
+        upload_stats.active += 1
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                for event, value in self.events:
+                    await self._handle(event, value)
+                self.events.clear()
+            parser.finalize()
+            if self.file_url is None:
+                raise HTTPException(status_code=400, detail="No file in upload")
+        except BaseException as e:
+            await self._discard()
+            upload_stats.rejected += 1
+            if isinstance(e, ValueError):
+                raise HTTPException(status_code=400, detail="Malformed multipart body")
+            raise
+        finally:
+            upload_stats.active -= 1
+        upload_stats.completed += 1
+        upload_stats.bytes += self.size
+        upload_stats.seconds += time.perf_counter() - started
+        return {"file_url": self.file_url, "file_type": self.file_type, "file_name": self.filename}
+
+    async def _handle(self, event, value):
+        if event == "headers":
+            _, disposition = parse_options_header(value.get(b"content-disposition", b""))
+            self.in_file_part = disposition.get(b"name") == b"file" and self.content_type is None
+            if self.in_file_part:
+                self.filename = os.path.basename(disposition.get(b"filename", b"").decode("utf-8", "replace")) or "file"
+                self.content_type = value.get(b"content-type", b"").decode("latin-1").split(";")[0].strip()
+                if self.content_type not in UPLOAD_TYPES:
+                    print(f"Неподдерживаемый тип файла: {self.content_type}")
+                    raise HTTPException(status_code=400, detail="Unsupported file type")
+                self.file_type = UPLOAD_TYPES[self.content_type][0]
+                self.limit = UPLOAD_MAX_MB[self.file_type] * 1024 * 1024
+        elif event == "data" and self.in_file_part:
+            self.size += len(value)
+            if self.size > self.limit:
+                raise HTTPException(status_code=413, detail=f"File is larger than {UPLOAD_MAX_MB[self.file_type]} MB")
+            if self.file is None:
+                self.head += value
+                if len(self.head) < UPLOAD_SNIFF_SIZE:
+                    return
+                await self._open()
+                value = self.head
+            self.pending += value
+            if len(self.pending) >= UPLOAD_WRITE_SIZE:
+                await self._flush()
+        elif event == "end" and self.in_file_part:
+            if self.file is None:
+                await self._open()
+                self.pending += self.head
+            await self._flush()
+            await asyncio.to_thread(self.file.close)
+            self.file = None
+            # Visible under its final name only once complete
+            self.file_url = await run_db(
+                store_blob, self.path, UPLOADS_DIR, self.digest.hexdigest(), UPLOAD_TYPES[self.content_type][1], self.size
+            )
+            self.path = None
+            self.in_file_part = False
+
+    async def _open(self):
+        if not UPLOAD_TYPES[self.content_type][2](self.head):
+            raise HTTPException(status_code=400, detail="File content does not match its type")
+        self.path = os.path.join(UPLOADS_DIR, f"{uuid.uuid4().hex}.part")
+        self.digest = hashlib.sha256()
+        self.file = await asyncio.to_thread(open, self.path, "wb")
+
+    def _write(self, data: bytes):
+        self.file.write(data)
+        self.digest.update(data)
+
+    async def _flush(self):
+        if self.pending:
+            data = bytes(self.pending)
+            self.pending.clear()
+            await asyncio.to_thread(self._write, data)
+
+    async def _discard(self):
+        if self.file is not None:
+            await asyncio.to_thread(self.file.close)
+            self.file = None
+        if self.path is not None and os.path.exists(self.path):
+            await asyncio.to_thread(os.remove, self.path)
+
 @app.post("/upload-file")
-async def upload_file(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
-    print(f"Получен запрос на загрузку файла от пользователя {current_user['id']}, имя файла: {file.filename}")
-    allowed_image_types = ["image/jpeg", "image/png", "image/gif"]
-    allowed_video_types = ["video/mp4", "video/webm"]
-    allowed_file_types = ["application/pdf", "text/plain"]
-
-    file_type = None
-    if file.content_type in allowed_image_types:
-        file_type = "image"
-    elif file.content_type in allowed_video_types:
-        file_type = "video"
-    elif file.content_type in allowed_file_types:
-        file_type = "file"
-    else:
-        print(f"Неподдерживаемый тип файла: {file.content_type}")
+async def upload_file(request: Request, current_user: dict = Depends(get_current_user)):
+    # Reads the raw request stream; declaring an UploadFile parameter would make FastAPI spool the whole body first
+    print(f"Получен запрос на загрузку файла от пользователя {current_user['id']}")
+    result = await StreamingUpload().receive(request)
+    if result["file_type"] == "image":
+        result.update(await wait_for_thumbnails(result["file_url"]))
+    print(f"Файл успешно сохранён, возвращаю file_url: {result['file_url']}, file_type: {result['file_type']}")
+    return result
+
+# Resumable uploads for large attachments. POST /uploads opens a session, PUT /uploads/{id}/chunks/{n}
+# stores chunk n (repeating a PUT just replaces it), GET /uploads/{id} lists the chunks the server has,
+# and POST /uploads/{id}/complete joins them into UPLOADS_DIR with the same answer as /upload-file.
+def upload_session_dir(upload_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, upload_id)
+
+def upload_chunk_count(session: dict) -> int:
+    return -(-session["size"] // session["chunk_size"])
+
+def received_chunks(upload_id: str) -> List[int]:
+    try:
+        names = os.listdir(upload_session_dir(upload_id))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-len(".chunk")]) for name in names if name.endswith(".chunk"))
+
+def fetch_upload_session(conn, upload_id: str, user_id: int) -> dict:
+    row = conn.execute(
+        "SELECT filename, content_type, size, chunk_size FROM upload_sessions WHERE id = ? AND user_id = ?",
+        (upload_id, user_id)
+    ).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return {"filename": row[0], "content_type": row[1], "size": row[2], "chunk_size": row[3]}
+
+def touch_upload_session(conn, upload_id: str):
+    conn.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), upload_id))
+    conn.commit()
+
+def delete_upload_session(conn, upload_id: str, user_id: int) -> bool:
+    deleted = conn.execute("DELETE FROM upload_sessions WHERE id = ? AND user_id = ?", (upload_id, user_id)).rowcount
+    conn.commit()
+    return deleted > 0
+
+def expire_upload_sessions(conn) -> List[str]:
+    cutoff = (datetime.utcnow() - timedelta(seconds=UPLOAD_SESSION_TTL)).isoformat()
+    expired = [row[0] for row in conn.execute("DELETE FROM upload_sessions WHERE updated_at < ? RETURNING id", (cutoff,))]
+    conn.commit()
+    return expired
+
+async def upload_session_status(upload_id: str, session: dict) -> dict:
+    return {
+        "upload_id": upload_id,
+        "filename": session["filename"],
+        "content_type": session["content_type"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "chunk_count": upload_chunk_count(session),
+        "received": await asyncio.to_thread(received_chunks, upload_id),
+    }
+
+def assemble_chunks(chunk_paths: List[str], target_path: str) -> str:
+    # Streams chunk after chunk into the target and returns the SHA-256 of the whole file; at most
+    # UPLOAD_WRITE_SIZE bytes are in memory at a time
+    digest = hashlib.sha256()
+    with open(target_path, "wb") as target:
+        for path in chunk_paths:
+            with open(path, "rb") as chunk:
+                while block := chunk.read(UPLOAD_WRITE_SIZE):
+                    target.write(block)
+                    digest.update(block)
+    return digest.hexdigest()
+
+def remove_stale_session_dirs():
+    # Directories without a session row: the session expired or a worker died between mkdir and insert.
+    # Every stored chunk bumps the directory mtime, so anything older than the TTL is abandoned.
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for entry in os.scandir(UPLOAD_SESSIONS_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+async def sweep_storage():
+    # Background cleanup of abandoned upload sessions and of blobs nothing refers to any more
+    while True:
+        try:
+            expired = await run_db(expire_upload_sessions)
+            for upload_id in expired:
+                await asyncio.to_thread(shutil.rmtree, upload_session_dir(upload_id), True)
+            await asyncio.to_thread(remove_stale_session_dirs)
+            if expired:
+                print(f"Removed {len(expired)} abandoned upload sessions")
+            collected = await run_db(collect_blobs)
+            if collected:
+                print(f"Removed {collected} unreferenced blobs")
+        except Exception as e:
+            print(f"Storage sweep failed: {e}")
+        await asyncio.sleep(STORAGE_SWEEP_INTERVAL)
+
+@app.post("/uploads")
+async def create_upload_session(upload: UploadSessionCreate, current_user: dict = Depends(get_current_user)):
+    if upload.content_type not in UPLOAD_TYPES:
         raise HTTPException(status_code=400, detail="Unsupported file type")
+    file_type = UPLOAD_TYPES[upload.content_type][0]
+    if upload.size <= 0:
+        raise HTTPException(status_code=400, detail="File is empty")
+    if upload.size > UPLOAD_MAX_MB[file_type] * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"File is larger than {UPLOAD_MAX_MB[file_type]} MB")
+
+    upload_id = uuid.uuid4().hex
+    session = {
+        "filename": os.path.basename(upload.filename) or "file",
+        "content_type": upload.content_type,
+        "size": upload.size,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+    }
+    await asyncio.to_thread(os.makedirs, upload_session_dir(upload_id))
+
+    def store_session(conn):
+        now = datetime.utcnow().isoformat()
+        conn.execute(
+            """
+            INSERT INTO upload_sessions (id, user_id, filename, content_type, size, chunk_size, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (upload_id, current_user["id"], session["filename"], session["content_type"], session["size"],
+             session["chunk_size"], now, now)
+        )
+        conn.commit()
 
-    filename = f"{current_user['id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
-    file_path = os.path.join(UPLOADS_DIR, filename)
+    await run_db(store_session)
+    return await upload_session_status(upload_id, session)
 
-    print(f"Сохраняю файл по пути: {file_path}")
-    try:
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-    except Exception as e:
-        print(f"Ошибка сохранения файла: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
+@app.get("/uploads/{upload_id}")
+async def get_upload_session(upload_id: str, current_user: dict = Depends(get_current_user)):
+    session = await run_db(fetch_upload_session, upload_id, current_user["id"])
+    return await upload_session_status(upload_id, session)
 
-    file_url = f"/static/uploads/{filename}"
-    print(f"Файл успешно сохранён, возвращаю file_url: {file_url}, file_type: {file_type}")
-    return {"file_url": file_url, "file_type": file_type}
+@app.put("/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(upload_id: str, index: int, request: Request, current_user: dict = Depends(get_current_user)):
+    session = await run_db(fetch_upload_session, upload_id, current_user["id"])
+    if not 0 <= index < upload_chunk_count(session):
+        raise HTTPException(status_code=400, detail="Chunk index out of range")
+    expected = min(session["chunk_size"], session["size"] - index * session["chunk_size"])
+
+    path = os.path.join(upload_session_dir(upload_id), f"{index}.chunk")
+    part_path = path + f".{uuid.uuid4().hex}.part"
+    try:
+        file = await asyncio.to_thread(open, part_path, "wb")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    received = 0
+    head = b""
+    pending = bytearray()
+    try:
+        async for data in request.stream():
+            received += len(data)
+            if received > expected:
+                raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+            if len(head) < UPLOAD_SNIFF_SIZE:
+                head += data[:UPLOAD_SNIFF_SIZE - len(head)]
+            pending += data
+            if len(pending) >= UPLOAD_WRITE_SIZE:
+                await asyncio.to_thread(file.write, bytes(pending))
+                pending.clear()
+        if received != expected:
+            raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+        # The first chunk carries the file signature; a mismatch fails now rather than after the whole upload
+        if index == 0 and not UPLOAD_TYPES[session["content_type"]][2](head):
+            raise HTTPException(status_code=400, detail="File content does not match its type")
+        await asyncio.to_thread(file.write, bytes(pending))
+        await asyncio.to_thread(file.close)
+        # A chunk is either absent or complete; a repeated PUT of the same chunk replaces it whole
+        await asyncio.to_thread(os.replace, part_path, path)
+    except BaseException:
+        await asyncio.to_thread(file.close)
+        if os.path.exists(part_path):
+            await asyncio.to_thread(os.remove, part_path)
+        raise
+    await run_db(touch_upload_session, upload_id)
+    return {"upload_id": upload_id, "index": index, "size": received}
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload_session(upload_id: str, current_user: dict = Depends(get_current_user)):
+    session = await run_db(fetch_upload_session, upload_id, current_user["id"])
+    chunk_count = upload_chunk_count(session)
+    received = set(await asyncio.to_thread(received_chunks, upload_id))
+    missing = [index for index in range(chunk_count) if index not in received]
+    if missing:
+        raise HTTPException(status_code=409, detail=f"Upload is missing {len(missing)} of {chunk_count} chunks")
+    # Deleting the row claims the session, so a repeated or concurrent complete gets a 404 instead of a second file
+    if not await run_db(delete_upload_session, upload_id, current_user["id"]):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+    directory = upload_session_dir(upload_id)
+    file_type, extension, _ = UPLOAD_TYPES[session["content_type"]]
+    part_path = os.path.join(UPLOADS_DIR, f"{uuid.uuid4().hex}.part")
+    chunk_paths = [os.path.join(directory, f"{index}.chunk") for index in range(chunk_count)]
+    try:
+        digest = await asyncio.to_thread(assemble_chunks, chunk_paths, part_path)
+        file_url = await run_db(store_blob, part_path, UPLOADS_DIR, digest, extension, session["size"])
+    except BaseException:
+        if os.path.exists(part_path):
+            await asyncio.to_thread(os.remove, part_path)
+        raise
+    finally:
+        await asyncio.to_thread(shutil.rmtree, directory, True)
+    print(f"Файл собран из {chunk_count} частей: {file_url}")
+    result = {"file_url": file_url, "file_type": file_type, "file_name": session["filename"]}
+    if file_type == "image":
+        result.update(await wait_for_thumbnails(file_url))
+    return result
+
+@app.delete("/uploads/{upload_id}")
+async def cancel_upload_session(upload_id: str, current_user: dict = Depends(get_current_user)):
+    if not await run_db(delete_upload_session, upload_id, current_user["id"]):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    await asyncio.to_thread(shutil.rmtree, upload_session_dir(upload_id), True)
+    return {"message": "Upload cancelled"}
+
+@app.get("/media/variant")
+async def get_media_variant(url: str, width: int = Query(..., ge=1)):
+    # The smallest thumbnail at least `width` pixels wide of an image blob. Until it exists the original
+    # is served, uncached, and the thumbnails are made in the background.
+    match = BLOB_URL_RE.match(url)
+    if not match or match.group(2) not in MEDIA_IMAGE_EXTENSIONS:
+        # Files stored before content addressing have no thumbnails
+        if url.startswith(("/static/uploads/", "/static/avatars/")) and ".." not in url:
+            return RedirectResponse(url)
+        raise HTTPException(status_code=404, detail="File not found")
+    path = url.lstrip("/")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Blob names change with their content, so whatever is served under them never goes stale
+    immutable = {"Cache-Control": "public, max-age=31536000, immutable"}
+    widths = [candidate for candidate in sorted(MEDIA_THUMBNAIL_WIDTHS) if candidate >= width]
+    if not widths:
+        return FileResponse(path, headers=immutable)
+    variant = media.variant_path(path, widths[0])
+    if os.path.exists(variant):
+        return FileResponse(variant, headers=immutable)
+    submit_media_job(path)
+    return FileResponse(path, headers={"Cache-Control": "no-cache"})
 
 @app.get("/chat", response_class=HTMLResponse)
 async def get_chat(request: Request, current_user: dict = Depends(get_current_user)):
-    with open("chat.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return await page_cache.response(request, "chat.html")
 
 @app.get("/my-profile", response_class=HTMLResponse)
 async def get_profile(request: Request, current_user: dict = Depends(get_current_user)):
-    with open("my-profile.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return await page_cache.response(request, "my-profile.html")
 
 @app.get("/profile/{user_id}", response_class=HTMLResponse)
 async def get_user_profile(user_id: int, request: Request, current_user: dict = Depends(get_current_user)):
-    with open("profile.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return await page_cache.response(request, "profile.html")
 
 @app.get("/edit-profile", response_class=HTMLResponse)
 async def get_edit_profile(request: Request, current_user: dict = Depends(get_current_user)):
-    with open("edit-profile.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return await page_cache.response(request, "edit-profile.html")
 
 @app.get("/favicon.ico", response_class=FileResponse)
 async def favicon():
@@ -481,13 +3162,8 @@ async def favicon():
 
 @app.get("/users/me")
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT is_admin FROM users WHERE id = ?", (current_user["id"],))
-    row = cursor.fetchone()
-    conn.close()
-    is_admin = bool(row[0]) if row else False
-    current_user["is_admin"] = is_admin
+    identity = await load_identity(current_user["id"])
+    current_user["is_admin"] = identity[1] if identity else False
     return current_user
 
 @app.get("/users/search")
@@ -498,27 +3174,30 @@ async def search_users(
     print(f"Received search query: {query}")
     if len(query.strip()) < 2:
         raise HTTPException(status_code=422, detail="Query must be at least 2 characters long")
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, username, avatar_url FROM users WHERE username LIKE ? AND id != ? LIMIT 10",
-        (f"%{query}%", current_user["id"])
-    )
-    users = [{"id": user[0], "username": user[1], "avatar_url": user[2]} for user in cursor.fetchall()]
+
+    def find_users(conn):
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, username, avatar_url FROM users WHERE username LIKE ? AND id != ? LIMIT 10",
+            (f"%{query}%", current_user["id"])
+        )
+        return [{"id": user[0], "username": user[1], "avatar_url": user[2]} for user in cursor.fetchall()]
+
+    users = await run_db(find_users)
     print(f"Found users: {users}")
-    conn.close()
     return users
 
 @app.get("/users/{user_id}")
 async def get_user_info(user_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, username, email, mobile, date_of_birth, avatar_url FROM users WHERE id = ?",
-        (user_id,)
-    )
-    user = cursor.fetchone()
-    conn.close()
+    def fetch_user(conn):
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, username, email, mobile, date_of_birth, avatar_url FROM users WHERE id = ?",
+            (user_id,)
+        )
+        return cursor.fetchone()
+
+    user = await run_db(fetch_user)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return {
@@ -538,13 +3217,9 @@ async def update_user(
     avatar: UploadFile = File(None),
     current_user: dict = Depends(get_current_user)
 ):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
     if not username or len(username) < 3:
-        conn.close()
         raise HTTPException(status_code=400, detail="Username must be at least 3 characters long")
     if mobile and not mobile.replace(" ", "").replace("-", "").replace("+", "").isdigit():
-        conn.close()
         raise HTTPException(status_code=400, detail="Invalid phone number format")
     
     print(f"Received date_of_birth: {date_of_birth}")
@@ -554,66 +3229,83 @@ async def update_user(
             datetime.strptime(date_of_birth, "%Y-%m-%d")
         except ValueError as e:
             print(f"Date validation error: {e}")
-            conn.close()
             raise HTTPException(status_code=400, detail="Invalid date format, use YYYY-MM-DD")
-    
-    cursor.execute("SELECT id FROM users WHERE username = ? AND id != ?", (username, current_user['id']))
-    if cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Username already taken")
-    
+
+    def check_username(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE username = ? AND id != ?", (username, current_user['id']))
+        if cursor.fetchone():
+            raise HTTPException(status_code=400, detail="Username already taken")
+
+    await run_db(check_username)
+
     avatar_url = current_user.get('avatar_url')
     if avatar:
-        if avatar.content_type not in ["image/jpeg", "image/png"]:
-            conn.close()
-            raise HTTPException(status_code=400, detail="Only JPEG or PNG images are allowed")
-        filename = f"{current_user['id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{avatar.filename}"
-        file_path = os.path.join(AVATARS_DIR, filename)
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(avatar.file, f)
-        avatar_url = f"/static/avatars/{filename}"
-    
-    cursor.execute(
-        "UPDATE users SET username = ?, mobile = ?, date_of_birth = ?, avatar_url = ? WHERE id = ?",
-        (username, mobile, date_of_birth, avatar_url, current_user['id'])
-    )
-    conn.commit()
-    conn.close()
+        spooled = await asyncio.to_thread(spool_avatar, avatar)
+        try:
+            avatar_url = await run_db(store_avatar, spooled)
+        finally:
+            await asyncio.to_thread(discard_avatar, spooled)
+
+    def save_profile(conn):
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET username = ?, mobile = ?, date_of_birth = ?, avatar_url = ? WHERE id = ?",
+            (username, mobile, date_of_birth, avatar_url, current_user['id'])
+        )
+        conn.commit()
+
+    await run_db(save_profile)
+    identity_cache.invalidate(current_user["id"])
+    profile_cache.invalidate(current_user["id"])
     return {"message": "Profile updated successfully"}
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, hashed_password FROM users WHERE username = ?", (form_data.username,))
-    user = cursor.fetchone()
-    conn.close()
-    if not user or not verify_password(form_data.password, user[2]):
+    def fetch_credentials(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, username, hashed_password FROM users WHERE username = ?", (form_data.username,))
+        return cursor.fetchone()
+
+    user = await run_db(fetch_credentials)
+    valid, new_hash = await verify_password(form_data.password, user[2]) if user else (False, None)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        def store_rehash(conn):
+            cursor = conn.cursor()
+            # Only if the password was not changed in the meantime
+            cursor.execute(
+                "UPDATE users SET hashed_password = ? WHERE id = ? AND hashed_password = ?",
+                (new_hash, user[0], user[2])
+            )
+            conn.commit()
+
+        await run_db(store_rehash)
     access_token = create_access_token(data={"sub": str(user[0])})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/signup")
 async def signup(user: User):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        hashed_password = get_password_hash(user.password)
-        cursor.execute(
-            "INSERT INTO users (username, email, mobile, date_of_birth, hashed_password, avatar_url) VALUES (?, ?, ?, ?, ?, ?)",
-            (user.username, user.email, user.mobile, user.date_of_birth, hashed_password, None)
-        )
-        conn.commit()
-        return {"message": "User created successfully"}
-    except sqlite3.IntegrityError:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Username or email already exists")
-    finally:
-        conn.close()
+    hashed_password = await get_password_hash(user.password)
+
+    def insert_user(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO users (username, email, mobile, date_of_birth, hashed_password, avatar_url) VALUES (?, ?, ?, ?, ?, ?)",
+                (user.username, user.email, user.mobile, user.date_of_birth, hashed_password, None)
+            )
+            conn.commit()
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=400, detail="Username or email already exists")
+
+    await run_db(insert_user)
+    return {"message": "User created successfully"}
 
 @app.post("/groups")
 async def create_group(
@@ -623,413 +3315,413 @@ async def create_group(
     avatar: UploadFile = File(None),
     current_user: dict = Depends(get_current_user)
 ):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
+    def insert_group(conn):
+        cursor = conn.cursor()
         try:
-            member_ids_list = json.loads(member_ids)
-            if not isinstance(member_ids_list, list):
-                raise ValueError("member_ids must be a list")
-        except (json.JSONDecodeError, ValueError):
-            raise HTTPException(status_code=400, detail="Invalid member_ids format, must be a JSON list")
-
-        if not name or len(name) < 3:
-            raise HTTPException(status_code=400, detail="Group name must be at least 3 characters long")
-        cursor.execute("SELECT id FROM users WHERE id IN ({})".format(','.join(['?']*len(member_ids_list))), member_ids_list)
-        existing_users = [row[0] for row in cursor.fetchall()]
-        if len(existing_users) != len(member_ids_list):
-            raise HTTPException(status_code=400, detail="One or more user IDs are invalid")
-
-        avatar_url = None
-        if avatar:
-            if avatar.content_type not in ["image/jpeg", "image/png"]:
-                raise HTTPException(status_code=400, detail="Only JPEG or PNG images are allowed")
-            filename = f"group_{datetime.now().strftime('%Y%m%d%H%M%S')}_{avatar.filename}"
-            file_path = os.path.join(AVATARS_DIR, filename)
-            with open(file_path, "wb") as f:
-                shutil.copyfileobj(avatar.file, f)
-            avatar_url = f"/static/avatars/{filename}"
+            try:
+                member_ids_list = json.loads(member_ids)
+                if not isinstance(member_ids_list, list):
+                    raise ValueError("member_ids must be a list")
+            except (json.JSONDecodeError, ValueError):
+                raise HTTPException(status_code=400, detail="Invalid member_ids format, must be a JSON list")
 
-        cursor.execute(
-            "INSERT INTO groups (name, description, avatar_url, creator_id, created_at) VALUES (?, ?, ?, ?, ?)",
-            (name, description, avatar_url, current_user["id"], datetime.utcnow().isoformat())
-        )
-        group_id = cursor.lastrowid
-        member_ids_set = set(member_ids_list + [current_user["id"]])
-        cursor.executemany(
-            "INSERT INTO group_members (group_id, user_id) VALUES (?, ?)",
-            [(group_id, user_id) for user_id in member_ids_set]
-        )
-        conn.commit()
-        return {"message": "Group created successfully", "group_id": group_id}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
+            if not name or len(name) < 3:
+                raise HTTPException(status_code=400, detail="Group name must be at least 3 characters long")
+            cursor.execute("SELECT id FROM users WHERE id IN ({})".format(','.join(['?']*len(member_ids_list))), member_ids_list)
+            existing_users = [row[0] for row in cursor.fetchall()]
+            if len(existing_users) != len(member_ids_list):
+                raise HTTPException(status_code=400, detail="One or more user IDs are invalid")
+
+            avatar_url = store_avatar(conn, spooled) if spooled else None
+
+            cursor.execute(
+                "INSERT INTO groups (name, description, avatar_url, creator_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                (name, description, avatar_url, current_user["id"], datetime.utcnow().isoformat())
+            )
+            group_id = cursor.lastrowid
+            member_ids_set = set(member_ids_list + [current_user["id"]])
+            cursor.executemany(
+                "INSERT INTO group_members (group_id, user_id) VALUES (?, ?)",
+                [(group_id, user_id) for user_id in member_ids_set]
+            )
+            conn.commit()
+            return {"message": "Group created successfully", "group_id": group_id}
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    spooled = await asyncio.to_thread(spool_avatar, avatar) if avatar else None
+    try:
+        return await run_db(insert_group)
     finally:
-        conn.close()
+        await asyncio.to_thread(discard_avatar, spooled)
 
 @app.post("/groups/{group_id}/leave")
 async def leave_group(group_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        if not cursor.fetchone():
-            raise HTTPException(status_code=403, detail="Not a member of this group")
+    def leave(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            if not cursor.fetchone():
+                raise HTTPException(status_code=403, detail="Not a member of this group")
 
-        cursor.execute(
-            "SELECT creator_id FROM groups WHERE id = ?",
-            (group_id,)
-        )
-        group = cursor.fetchone()
-        if not group:
-            raise HTTPException(status_code=404, detail="Group not found")
-        if group[0] == current_user["id"]:
-            raise HTTPException(status_code=400, detail="Creator cannot leave the group")
+            cursor.execute(
+                "SELECT creator_id FROM groups WHERE id = ?",
+                (group_id,)
+            )
+            group = cursor.fetchone()
+            if not group:
+                raise HTTPException(status_code=404, detail="Group not found")
+            if group[0] == current_user["id"]:
+                raise HTTPException(status_code=400, detail="Creator cannot leave the group")
 
-        cursor.execute(
-            "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        cursor.execute(
-            "DELETE FROM messages WHERE group_id = ? AND sender_id = ?",
-            (group_id, current_user["id"])
-        )
-        conn.commit()
-        return {"message": "Successfully left the group"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+            unread_deltas = fetch_sender_unread(conn, current_user["id"], group_id)
+            cursor.execute(
+                "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            cursor.execute(
+                "DELETE FROM messages WHERE group_id = ? AND sender_id = ?",
+                (group_id, current_user["id"])
+            )
+            conn.commit()
+            state = fetch_conversation_state(conn, current_user["id"], None, group_id)
+            return fetch_recipient_ids(conn, current_user["id"], None, group_id), state, unread_deltas
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    recipient_ids, state, unread_deltas = await run_db(leave)
+    await publish_group_departure(current_user["id"], group_id, recipient_ids, state, unread_deltas)
+    return {"message": "Successfully left the group"}
 
 @app.post("/groups/{group_id}/add-member")
 async def add_group_member(group_id: int, user_id: int = Form(...), current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, что группа существует
-        cursor.execute(
-            "SELECT creator_id FROM groups WHERE id = ?",
-            (group_id,)
-        )
-        group = cursor.fetchone()
-        if not group:
-            raise HTTPException(status_code=404, detail="Group not found")
+    def add_member(conn):
+        cursor = conn.cursor()
+        try:
+            # Проверяем, что группа существует
+            cursor.execute(
+                "SELECT creator_id FROM groups WHERE id = ?",
+                (group_id,)
+            )
+            group = cursor.fetchone()
+            if not group:
+                raise HTTPException(status_code=404, detail="Group not found")
 
-        # Проверяем, является ли пользователь владельцем или администратором
-        cursor.execute(
-            "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        member = cursor.fetchone()
-        if not member and current_user["id"] != group[0]:
-            raise HTTPException(status_code=403, detail="Only the group creator or admins can add members")
+            # Проверяем, является ли пользователь владельцем или администратором
+            cursor.execute(
+                "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            member = cursor.fetchone()
+            if not member and current_user["id"] != group[0]:
+                raise HTTPException(status_code=403, detail="Only the group creator or admins can add members")
 
-        # Проверяем, что добавляемый пользователь существует
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="User not found")
+            # Проверяем, что добавляемый пользователь существует
+            cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="User not found")
 
-        # Проверяем, что пользователь еще не в группе
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, user_id)
-        )
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="User is already a member of this group")
+            # Проверяем, что пользователь еще не в группе
+            cursor.execute(
+                "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, user_id)
+            )
+            if cursor.fetchone():
+                raise HTTPException(status_code=400, detail="User is already a member of this group")
 
-        # Добавляем пользователя в группу
-        cursor.execute(
-            "INSERT INTO group_members (group_id, user_id, is_admin) VALUES (?, ?, 0)",
-            (group_id, user_id)
-        )
-        conn.commit()
-        return {"message": "User added to group successfully"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+            # Добавляем пользователя в группу
+            cursor.execute(
+                "INSERT INTO group_members (group_id, user_id, is_admin) VALUES (?, ?, 0)",
+                (group_id, user_id)
+            )
+            conn.commit()
+            return {"message": "User added to group successfully"}
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    return await run_db(add_member)
         
 @app.post("/groups/{group_id}/set-admin")
 async def set_group_admin(group_id: int, user_id: int = Form(...), current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, что группа существует
-        cursor.execute(
-            "SELECT creator_id FROM groups WHERE id = ?",
-            (group_id,)
-        )
-        group = cursor.fetchone()
-        if not group:
-            raise HTTPException(status_code=404, detail="Group not found")
+    def set_admin(conn):
+        cursor = conn.cursor()
+        try:
+            # Проверяем, что группа существует
+            cursor.execute(
+                "SELECT creator_id FROM groups WHERE id = ?",
+                (group_id,)
+            )
+            group = cursor.fetchone()
+            if not group:
+                raise HTTPException(status_code=404, detail="Group not found")
 
-        # Проверяем, является ли текущий пользователь владельцем или администратором
-        cursor.execute(
-            "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        current_member = cursor.fetchone()
-        if not current_member and current_user["id"] != group[0]:
-            raise HTTPException(status_code=403, detail="Only the group creator or admins can set admins")
+            # Проверяем, является ли текущий пользователь владельцем или администратором
+            cursor.execute(
+                "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            current_member = cursor.fetchone()
+            if not current_member and current_user["id"] != group[0]:
+                raise HTTPException(status_code=403, detail="Only the group creator or admins can set admins")
 
-        # Проверяем, что пользователь является членом группы
-        cursor.execute(
-            "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, user_id)
-        )
-        target_member = cursor.fetchone()
-        if not target_member:
-            raise HTTPException(status_code=400, detail="User is not a member of this group")
-        if target_member[0]:
-            raise HTTPException(status_code=400, detail="User is already an admin")
+            # Проверяем, что пользователь является членом группы
+            cursor.execute(
+                "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, user_id)
+            )
+            target_member = cursor.fetchone()
+            if not target_member:
+                raise HTTPException(status_code=400, detail="User is not a member of this group")
+            if target_member[0]:
+                raise HTTPException(status_code=400, detail="User is already an admin")
 
-        # Назначаем пользователя администратором
-        cursor.execute(
-            "UPDATE group_members SET is_admin = 1 WHERE group_id = ? AND user_id = ?",
-            (group_id, user_id)
-        )
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=400, detail="Failed to set user as admin")
-        conn.commit()
-        return {"message": "User set as admin successfully"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+            # Назначаем пользователя администратором
+            cursor.execute(
+                "UPDATE group_members SET is_admin = 1 WHERE group_id = ? AND user_id = ?",
+                (group_id, user_id)
+            )
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=400, detail="Failed to set user as admin")
+            conn.commit()
+            return {"message": "User set as admin successfully"}
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    return await run_db(set_admin)
         
 @app.post("/groups/{group_id}/remove-admin")
 async def remove_group_admin(group_id: int, user_id: int = Form(...), current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, что группа существует
-        cursor.execute(
-            "SELECT creator_id FROM groups WHERE id = ?",
-            (group_id,)
-        )
-        group = cursor.fetchone()
-        if not group:
-            raise HTTPException(status_code=404, detail="Group not found")
+    def remove_admin(conn):
+        cursor = conn.cursor()
+        try:
+            # Проверяем, что группа существует
+            cursor.execute(
+                "SELECT creator_id FROM groups WHERE id = ?",
+                (group_id,)
+            )
+            group = cursor.fetchone()
+            if not group:
+                raise HTTPException(status_code=404, detail="Group not found")
 
-        # Проверяем, является ли текущий пользователь владельцем или администратором
-        cursor.execute(
-            "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        current_member = cursor.fetchone()
-        if not current_member and current_user["id"] != group[0]:
-            raise HTTPException(status_code=403, detail="Only the group creator or admins can remove admins")
+            # Проверяем, является ли текущий пользователь владельцем или администратором
+            cursor.execute(
+                "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            current_member = cursor.fetchone()
+            if not current_member and current_user["id"] != group[0]:
+                raise HTTPException(status_code=403, detail="Only the group creator or admins can remove admins")
 
-        # Проверяем, что пользователь является членом группы
-        cursor.execute(
-            "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, user_id)
-        )
-        target_member = cursor.fetchone()
-        if not target_member:
-            raise HTTPException(status_code=400, detail="User is not a member of this group")
-        if not target_member[0]:
-            raise HTTPException(status_code=400, detail="User is not an admin")
-        if user_id == group[0]:
-            raise HTTPException(status_code=400, detail="Cannot remove admin status from the group creator")
-
-        # Снимаем статус администратора
-        cursor.execute(
-            "UPDATE group_members SET is_admin = 0 WHERE group_id = ? AND user_id = ?",
-            (group_id, user_id)
-        )
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=400, detail="Failed to remove admin status")
-        conn.commit()
-        return {"message": "Admin status removed successfully"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+            # Проверяем, что пользователь является членом группы
+            cursor.execute(
+                "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, user_id)
+            )
+            target_member = cursor.fetchone()
+            if not target_member:
+                raise HTTPException(status_code=400, detail="User is not a member of this group")
+            if not target_member[0]:
+                raise HTTPException(status_code=400, detail="User is not an admin")
+            if user_id == group[0]:
+                raise HTTPException(status_code=400, detail="Cannot remove admin status from the group creator")
+
+            # Снимаем статус администратора
+            cursor.execute(
+                "UPDATE group_members SET is_admin = 0 WHERE group_id = ? AND user_id = ?",
+                (group_id, user_id)
+            )
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=400, detail="Failed to remove admin status")
+            conn.commit()
+            return {"message": "Admin status removed successfully"}
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    return await run_db(remove_admin)
         
 @app.post("/groups/{group_id}/remove-member")
 async def remove_group_member(group_id: int, user_id: int = Form(...), current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, что группа существует
-        cursor.execute(
-            "SELECT creator_id FROM groups WHERE id = ?",
-            (group_id,)
-        )
-        group = cursor.fetchone()
-        if not group:
-            raise HTTPException(status_code=404, detail="Group not found")
+    def remove_member(conn):
+        cursor = conn.cursor()
+        try:
+            # Проверяем, что группа существует
+            cursor.execute(
+                "SELECT creator_id FROM groups WHERE id = ?",
+                (group_id,)
+            )
+            group = cursor.fetchone()
+            if not group:
+                raise HTTPException(status_code=404, detail="Group not found")
 
-        # Проверяем, является ли текущий пользователь владельцем или администратором
-        cursor.execute(
-            "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        current_member = cursor.fetchone()
-        if not current_member and current_user["id"] != group[0]:
-            raise HTTPException(status_code=403, detail="Only the group creator or admins can remove members")
+            # Проверяем, является ли текущий пользователь владельцем или администратором
+            cursor.execute(
+                "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            current_member = cursor.fetchone()
+            if not current_member and current_user["id"] != group[0]:
+                raise HTTPException(status_code=403, detail="Only the group creator or admins can remove members")
 
-        # Проверяем, что удаляемый пользователь является членом группы
-        cursor.execute(
-            "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, user_id)
-        )
-        target_member = cursor.fetchone()
-        if not target_member:
-            raise HTTPException(status_code=400, detail="User is not a member of this group")
+            # Проверяем, что удаляемый пользователь является членом группы
+            cursor.execute(
+                "SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, user_id)
+            )
+            target_member = cursor.fetchone()
+            if not target_member:
+                raise HTTPException(status_code=400, detail="User is not a member of this group")
 
-        # Запрещаем удалять владельца
-        if user_id == group[0]:
-            raise HTTPException(status_code=400, detail="Cannot remove the group creator")
+            # Запрещаем удалять владельца
+            if user_id == group[0]:
+                raise HTTPException(status_code=400, detail="Cannot remove the group creator")
 
-        # Если текущий пользователь - администратор (не владелец), он не может удалять других администраторов
-        if current_user["id"] != group[0] and target_member[0]:
-            raise HTTPException(status_code=403, detail="Admins cannot remove other admins")
+            # Если текущий пользователь - администратор (не владелец), он не может удалять других администраторов
+            if current_user["id"] != group[0] and target_member[0]:
+                raise HTTPException(status_code=403, detail="Admins cannot remove other admins")
 
-        # Удаляем пользователя из группы
-        cursor.execute(
-            "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, user_id)
-        )
-        # Удаляем сообщения пользователя в группе
-        cursor.execute(
-            "DELETE FROM messages WHERE group_id = ? AND sender_id = ?",
-            (group_id, user_id)
-        )
-        conn.commit()
-        return {"message": "User removed from group successfully"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+            unread_deltas = fetch_sender_unread(conn, user_id, group_id)
+            # Удаляем пользователя из группы
+            cursor.execute(
+                "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, user_id)
+            )
+            # Удаляем сообщения пользователя в группе
+            cursor.execute(
+                "DELETE FROM messages WHERE group_id = ? AND sender_id = ?",
+                (group_id, user_id)
+            )
+            conn.commit()
+            state = fetch_conversation_state(conn, user_id, None, group_id)
+            return fetch_recipient_ids(conn, user_id, None, group_id), state, unread_deltas
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    recipient_ids, state, unread_deltas = await run_db(remove_member)
+    await publish_group_departure(user_id, group_id, recipient_ids, state, unread_deltas)
+    return {"message": "User removed from group successfully"}
         
 @app.post("/groups/{group_id}/add_user", response_model=GroupInfo)
 async def add_user_to_group(group_id: int, user_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
+    def add_user(conn):
+        cursor = conn.cursor()
 
-    # Check if the current user is the group owner or admin
-    cursor.execute("SELECT creator_id FROM groups WHERE id = ?", (group_id,))
-    group = cursor.fetchone()
-    if not group:
-        raise HTTPException(status_code=404, detail="Group not found")
-    if group[0] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="Only the group owner can add users")
+        # Check if the current user is the group owner or admin
+        cursor.execute("SELECT creator_id FROM groups WHERE id = ?", (group_id,))
+        group = cursor.fetchone()
+        if not group:
+            raise HTTPException(status_code=404, detail="Group not found")
+        if group[0] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="Only the group owner can add users")
 
-    # Add the user to the group
-    cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
-    conn.commit()
+        # Add the user to the group
+        cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
+        conn.commit()
+
+    await run_db(add_user)
 
     # Fetch updated group info
-    return get_group_info(group_id)
+    return await get_group_info(group_id, current_user)
 
 @app.post("/groups/{group_id}/remove_user", response_model=GroupInfo)
 async def remove_user_from_group(group_id: int, user_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
+    def remove_user(conn):
+        cursor = conn.cursor()
 
-    # Check if the current user is the group owner or admin
-    cursor.execute("SELECT creator_id FROM groups WHERE id = ?", (group_id,))
-    group = cursor.fetchone()
-    if not group:
-        raise HTTPException(status_code=404, detail="Group not found")
-    if group[0] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="Only the group owner can remove users")
+        # Check if the current user is the group owner or admin
+        cursor.execute("SELECT creator_id FROM groups WHERE id = ?", (group_id,))
+        group = cursor.fetchone()
+        if not group:
+            raise HTTPException(status_code=404, detail="Group not found")
+        if group[0] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="Only the group owner can remove users")
 
-    # Remove the user from the group
-    cursor.execute("DELETE FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user_id))
-    conn.commit()
+        # Remove the user from the group
+        cursor.execute("DELETE FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user_id))
+        conn.commit()
+
+    await run_db(remove_user)
 
     # Fetch updated group info
-    return get_group_info(group_id)
+    return await get_group_info(group_id, current_user)
 
 @app.get("/groups", response_model=List[Group])
 async def get_groups(current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT g.id, g.name, g.description, g.avatar_url, g.creator_id, g.created_at
-        FROM groups g
-        JOIN group_members gm ON g.id = gm.group_id
-        WHERE gm.user_id = ?
-        """,
-        (current_user["id"],)
-    )
-    groups = [
-        {"id": row[0], "name": row[1], "description": row[2], "avatar_url": row[3], "creator_id": row[4], "created_at": row[5]}
-        for row in cursor.fetchall()
-    ]
-    conn.close()
-    return groups
-
-@app.get("/groups/{group_id}", response_model=GroupInfo)
-async def get_group_info(group_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, является ли пользователь членом группы
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        membership = cursor.fetchone()
-        if not membership:
-            raise HTTPException(status_code=403, detail="Not a member of this group")
-
-        # Получаем данные о группе
-        cursor.execute("""
-            SELECT g.id, g.name, g.description, g.avatar_url, g.creator_id, u.username AS creator_username
-            FROM groups g
-            JOIN users u ON g.creator_id = u.id
-            WHERE g.id = ?
-        """, (group_id,))
-        group = cursor.fetchone()
-        if not group:
-            raise HTTPException(status_code=404, detail="Group not found")
-
-        # Получаем данные об участниках, включая is_admin
-        cursor.execute("""
-            SELECT u.id, u.username, u.avatar_url, gm.is_admin
-            FROM group_members gm
-            JOIN users u ON gm.user_id = u.id
-            WHERE gm.group_id = ?
-        """, (group_id,))
-        members = [
-            {"id": m[0], "username": m[1], "avatar_url": m[2], "is_admin": bool(m[3])}
-            for m in cursor.fetchall()
+    def fetch_groups(conn):
+        cursor = conn.cursor()
+        cursor.execute(USER_GROUPS_SQL, (current_user["id"],))
+        return [
+            {"id": row[0], "name": row[1], "description": row[2], "avatar_url": row[3], "creator_id": row[4], "created_at": row[5]}
+            for row in cursor.fetchall()
         ]
 
-        # Получаем количество участников
-        cursor.execute(
-            "SELECT COUNT(*) FROM group_members WHERE group_id = ?",
-            (group_id,)
-        )
-        member_count = cursor.fetchone()[0]
+    return await run_db(fetch_groups)
 
-        return {
-            "id": group[0],
-            "name": group[1],
-            "description": group[2],
-            "avatar_url": group[3],
-            "creator": {"id": group[4], "username": group[5]},
-            "members": members,
-            "member_count": member_count
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch group info: {str(e)}")
-    finally:
-        conn.close()
+@app.get("/groups/{group_id}", response_model=GroupInfo)
+async def get_group_info(group_id: int, current_user: dict = Depends(get_current_user)):
+    def fetch_group_info(conn):
+        cursor = conn.cursor()
+        try:
+            # Проверяем, является ли пользователь членом группы
+            cursor.execute(
+                "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            membership = cursor.fetchone()
+            if not membership:
+                raise HTTPException(status_code=403, detail="Not a member of this group")
+
+            # Получаем данные о группе
+            cursor.execute("""
+                SELECT g.id, g.name, g.description, g.avatar_url, g.creator_id, u.username AS creator_username
+                FROM groups g
+                JOIN users u ON g.creator_id = u.id
+                WHERE g.id = ?
+            """, (group_id,))
+            group = cursor.fetchone()
+            if not group:
+                raise HTTPException(status_code=404, detail="Group not found")
+
+            # Получаем данные об участниках, включая is_admin
+            cursor.execute("""
+                SELECT u.id, u.username, u.avatar_url, gm.is_admin
+                FROM group_members gm
+                JOIN users u ON gm.user_id = u.id
+                WHERE gm.group_id = ?
+            """, (group_id,))
+            members = [
+                {"id": m[0], "username": m[1], "avatar_url": m[2], "is_admin": bool(m[3])}
+                for m in cursor.fetchall()
+            ]
+
+            # Получаем количество участников
+            cursor.execute(
+                "SELECT COUNT(*) FROM group_members WHERE group_id = ?",
+                (group_id,)
+            )
+            member_count = cursor.fetchone()[0]
+
+            return {
+                "id": group[0],
+                "name": group[1],
+                "description": group[2],
+                "avatar_url": group[3],
+                "creator": {"id": group[4], "username": group[5]},
+                "members": members,
+                "member_count": member_count
+            }
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to fetch group info: {str(e)}")
+
+    return await run_db(fetch_group_info)
 
 @app.put("/groups/{group_id}")
 async def update_group(
@@ -1039,7 +3731,7 @@ async def update_group(
     avatar: UploadFile = File(None),
     current_user: dict = Depends(get_current_user)
 ):
-    with get_db() as conn:
+    def save_group(conn):
         cursor = conn.cursor()
         try:
             # Проверяем, что группа существует
@@ -1062,15 +3754,7 @@ async def update_group(
                 raise HTTPException(status_code=400, detail="Group name must be at least 3 characters long")
 
             # Обработка аватара
-            avatar_url = None
-            if avatar:
-                if avatar.content_type not in ["image/jpeg", "image/png"]:
-                    raise HTTPException(status_code=400, detail="Only JPEG or PNG images are allowed")
-                filename = f"group_{datetime.now().strftime('%Y%m%d%H%M%S')}_{avatar.filename}"
-                file_path = os.path.join(AVATARS_DIR, filename)
-                with open(file_path, "wb") as f:
-                    shutil.copyfileobj(avatar.file, f)
-                avatar_url = f"/static/avatars/{filename}"
+            avatar_url = store_avatar(conn, spooled) if spooled else None
 
             # Обновляем группу
             if avatar_url:
@@ -1089,123 +3773,98 @@ async def update_group(
             conn.rollback()
             raise HTTPException(status_code=500, detail=str(e))
 
+    spooled = await asyncio.to_thread(spool_avatar, avatar) if avatar else None
+    try:
+        return await run_db(save_group)
+    finally:
+        await asyncio.to_thread(discard_avatar, spooled)
+
 @app.get("/messages/recent", response_model=List[RecentChat])
 async def get_recent_chats(current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            """
-            SELECT DISTINCT u.id, u.username, u.avatar_url,
-                   (SELECT COUNT(*) FROM messages m2 
-                    WHERE m2.receiver_id = ? AND m2.sender_id = u.id AND m2.is_read = 0) as unread_count,
-                   0 as is_group
-            FROM messages m
-            JOIN users u ON (u.id = m.sender_id OR u.id = m.receiver_id)
-            WHERE (m.sender_id = ? OR m.receiver_id = ?) AND u.id != ? AND m.group_id IS NULL
-            ORDER BY m.timestamp DESC
-            LIMIT 10
-            """,
-            (current_user["id"], current_user["id"], current_user["id"], current_user["id"])
-        )
-        private_chats = [
-            {"user_id": row[0], "username": row[1], "avatar_url": row[2], "unread_count": row[3], "is_group": False}
-            for row in cursor.fetchall()
-        ]
+    def fetch_recent_chats(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(RECENT_CHATS_SQL, (CONVERSATION_PREVIEW_LENGTH, current_user["id"], RECENT_CHATS_LIMIT))
+            return ORJSONResponse([
+                {"user_id": row[0], "group_id": row[1], "username": row[2], "avatar_url": row[3],
+                 "unread_count": row[4], "is_group": row[1] is not None,
+                 "last_message_id": row[5], "last_activity": row[6], "preview": row[7]}
+                for row in cursor.fetchall()
+            ])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to fetch recent chats: {str(e)}")
 
-        cursor.execute(
-            """
-            SELECT g.id, g.name, g.avatar_url,
-                   (SELECT COUNT(*) FROM messages m2 
-                    WHERE m2.group_id = g.id AND m2.is_read = 0 AND m2.sender_id != ?) as unread_count,
-                   1 as is_group
-            FROM groups g
-            JOIN group_members gm ON g.id = gm.group_id
-            JOIN users u ON g.creator_id = u.id
-            WHERE gm.user_id = ?
-            ORDER BY g.created_at DESC
-            LIMIT 10
-            """,
-            (current_user["id"], current_user["id"])
-        )
-        group_chats = [
-            {"group_id": row[0], "username": row[1], "avatar_url": row[2], "unread_count": row[3], "is_group": True}
-            for row in cursor.fetchall()
-        ]
+    return await run_db(fetch_recent_chats)
 
-        chats = private_chats + group_chats
-        chats.sort(key=lambda x: x["unread_count"], reverse=True)
-        conn.close()
-        return chats[:10]
-    except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Failed to fetch recent chats: {str(e)}")
+@app.get("/sync")
+async def sync_messages(
+    since: int = Query(..., ge=1, description="Last message id the client has seen"),
+    limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=SYNC_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    # New messages plus edits and deletes across all of the user's chats since `since`;
+    # when has_more is set, call again with since=last_message_id
+    return await run_db(fetch_sync_page, current_user["id"], since, limit)
+
+@app.get("/messages/search", response_model=List[MessageSearchResult])
+async def search_my_messages(
+    query: str = Query(..., min_length=2, description="Words to look for in message text"),
+    user_id: int | None = Query(None, description="Only search the private chat with this user"),
+    group_id: int | None = Query(None, description="Only search this group"),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(get_current_user)
+):
+    if not query.strip():
+        raise HTTPException(status_code=422, detail="Query must not be blank")
 
-@app.get("/messages/{receiver_id}", response_model=List[Message])
-async def get_messages(receiver_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            """
-            SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id, u.username, u.avatar_url, m.is_read, m.files
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            WHERE (m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?)
-            ORDER BY m.timestamp
-            """,
-            (current_user["id"], receiver_id, receiver_id, current_user["id"])
-        )
-        messages = [
-            {
-                "id": row[0],  # Добавляем id
-                "content": row[1],
-                "timestamp": row[2],
-                "sender_id": row[3],
-                "receiver_id": row[4],
-                "username": row[5],
-                "avatar_url": row[6],
-                "is_read": bool(row[7]),
-                "files": json.loads(row[8]) if row[8] else None
-            }
-            for row in cursor.fetchall()]
-        conn.close()
-        return messages
-    except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Failed to fetch messages: {str(e)}")
+    def find_messages(conn):
+        me = current_user["id"]
+        if group_id is not None:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, me))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=403, detail="Not a member of this group")
+            return search_messages(conn, query, SEARCH_GROUP_MESSAGES_SQL, (group_id,), limit, offset)
+        if user_id is not None:
+            return search_messages(conn, query, SEARCH_PRIVATE_MESSAGES_SQL, (me, user_id, user_id, me), limit, offset)
+        return search_messages(conn, query, SEARCH_MESSAGES_SQL, (me, me, me), limit, offset)
+
+    return await run_db(find_messages)
+
+@app.get("/messages/{receiver_id}", response_model=List[Message] | MessagePage)
+async def get_messages(
+    receiver_id: int,
+    before_id: int | None = Query(None, ge=1, description="Return messages older than this id"),
+    after_id: int | None = Query(None, ge=0, description="Return messages newer than this id"),
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+    compact: bool = Query(False, description="Return {messages, users} with each sender's profile once"),
+    current_user: dict = Depends(get_current_user)
+):
+    def fetch_messages(conn):
+        try:
+            return fetch_private_history_page(conn, current_user["id"], receiver_id, before_id, after_id, limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to fetch messages: {str(e)}")
 
-@app.get("/messages/group/{group_id}", response_model=List[Message])
-async def get_group_messages(group_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id,
-                   m.group_id, u.username, u.avatar_url, m.is_read, m.files
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            WHERE m.group_id = ?
-            ORDER BY m.timestamp ASC
-        """, (group_id,))
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({
-                "id": row[0],
-                "content": row[1],
-                "timestamp": row[2],
-                "sender_id": row[3],
-                "receiver_id": row[4],
-                "group_id": row[5],
-                "username": row[6],
-                "avatar_url": row[7],
-                "is_read": bool(row[8]),
-                "files": json.loads(row[9]) if row[9] else []
-            })
-        return messages
-    except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Failed to fetch group messages: {str(e)}")
+    return await history_response(await run_db(fetch_messages), compact)
+
+@app.get("/messages/group/{group_id}", response_model=List[Message] | MessagePage)
+async def get_group_messages(
+    group_id: int,
+    before_id: int | None = Query(None, ge=1, description="Return messages older than this id"),
+    after_id: int | None = Query(None, ge=0, description="Return messages newer than this id"),
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+    compact: bool = Query(False, description="Return {messages, users} with each sender's profile once"),
+    current_user: dict = Depends(get_current_user)
+):
+    def fetch_messages(conn):
+        try:
+            return fetch_group_history_page(conn, group_id, current_user["id"], before_id, after_id, limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to fetch group messages: {str(e)}")
+
+    return await history_response(await run_db(fetch_messages), compact, no_files=[])
     
 @app.put("/messages/{message_id}/edit")
 async def edit_message(
@@ -1213,320 +3872,318 @@ async def edit_message(
     content: str = Form(None),  # Делаем content опциональным
     current_user: dict = Depends(get_current_user)
 ):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, что сообщение существует и принадлежит текущему пользователю
-        cursor.execute(
-            "SELECT sender_id, receiver_id, group_id, timestamp, files FROM messages WHERE id = ?",
-            (message_id,)
-        )
-        message = cursor.fetchone()
-        if not message:
-            raise HTTPException(status_code=404, detail="Message not found")
-        if message[0] != current_user["id"]:
-            raise HTTPException(status_code=403, detail="You can only edit your own messages")
+    def update_message(conn):
+        cursor = conn.cursor()
+        try:
+            # Проверяем, что сообщение существует и принадлежит текущему пользователю
+            cursor.execute(
+                "SELECT sender_id, receiver_id, group_id, timestamp, files FROM messages WHERE id = ?",
+                (message_id,)
+            )
+            message = cursor.fetchone()
+            if not message:
+                raise HTTPException(status_code=404, detail="Message not found")
+            if message[0] != current_user["id"]:
+                raise HTTPException(status_code=403, detail="You can only edit your own messages")
 
-        # Если content предоставлен, проверяем, что он не пустой (если не null)
-        if content and len(content.strip()) == 0:
-            raise HTTPException(status_code=400, detail="Content cannot be empty")
+            # Если content предоставлен, проверяем, что он не пустой (если не null)
+            if content and len(content.strip()) == 0:
+                raise HTTPException(status_code=400, detail="Content cannot be empty")
 
-        # Обновляем сообщение
-        cursor.execute(
-            "UPDATE messages SET content = ? WHERE id = ?",
-            (content, message_id)  # content может быть null
-        )
-        conn.commit()
+            # Обновляем сообщение
+            cursor.execute(
+                "UPDATE messages SET content = ? WHERE id = ?",
+                (content, message_id)  # content может быть null
+            )
+            conn.commit()
 
-        # Получаем информацию о пользователе для отправки через WebSocket
-        cursor.execute("SELECT username, avatar_url FROM users WHERE id = ?", (current_user["id"],))
-        user_data = cursor.fetchone()
-        username = user_data[0]
-        avatar_url = user_data[1]
-
-        # Формируем полное сообщение для WebSocket
-        message_data = {
-            "action": "edit",
-            "message_id": message_id,
-            "content": content,  # Может быть null
-            "timestamp": message[3],
-            "sender_id": current_user["id"],
-            "receiver_id": message[1],
-            "group_id": message[2],
-            "username": username,
-            "avatar_url": avatar_url,
-            "is_read": False,
-            "files": json.loads(message[4]) if message[4] else None
-        }
+            # Формируем полное сообщение для WebSocket
+            message_data = {
+                "action": "edit",
+                "message_id": message_id,
+                "content": content,  # Может быть null
+                "timestamp": message[3],
+                "sender_id": current_user["id"],
+                "receiver_id": message[1],
+                "group_id": message[2],
+                # current_user comes from identity_cache, no need to read the users row again
+                "username": current_user["username"],
+                "avatar_url": current_user["avatar_url"],
+                "is_read": False,
+                "files": json.loads(message[4]) if message[4] else None
+            }
+            state = fetch_conversation_state(conn, current_user["id"], message[1], message[2])
+            return message_data, fetch_recipient_ids(conn, current_user["id"], message[1], message[2]), state
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to edit message: {str(e)}")
 
-        if message[2]:  # Если это групповое сообщение
-            cursor.execute("SELECT user_id FROM group_members WHERE group_id = ?", (message[2],))
-            member_ids = [row[0] for row in cursor.fetchall()]
-            for member_id in member_ids:
-                await manager.send_personal_message(message_data, member_id)
-        else:  # Если это личное сообщение
-            await manager.send_personal_message(message_data, current_user["id"])
-            if message[1]:
-                await manager.send_personal_message(message_data, message[1])
-
-        return {"message": "Message edited successfully"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to edit message: {str(e)}")
-    finally:
-        conn.close()
+    message_data, recipient_ids, state = await run_db(update_message)
+    await bus.publish(recipient_ids, message_data)
+    # Only an edit of the last message changes what the chat list shows
+    if state["last_message_id"] == message_id:
+        await publish_conversation_update(current_user["id"], message_data["receiver_id"], message_data["group_id"],
+                                          recipient_ids, {"preview": state["preview"]})
+
+    return {"message": "Message edited successfully"}
         
 @app.delete("/messages/{message_id}")
 async def delete_message(
     message_id: int,
     current_user: dict = Depends(get_current_user)
 ):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        # Проверяем, что сообщение существует и принадлежит текущему пользователю
-        cursor.execute(
-            "SELECT sender_id, receiver_id, group_id FROM messages WHERE id = ?",
-            (message_id,)
-        )
-        message = cursor.fetchone()
-        if not message:
-            raise HTTPException(status_code=404, detail="Message not found")
-        if message[0] != current_user["id"]:
-            raise HTTPException(status_code=403, detail="You can only delete your own messages")
-
-        # Удаляем сообщение
-        cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
-        conn.commit()
+    def remove_message(conn):
+        cursor = conn.cursor()
+        try:
+            # Проверяем, что сообщение существует и принадлежит текущему пользователю
+            cursor.execute(
+                "SELECT sender_id, receiver_id, group_id FROM messages WHERE id = ?",
+                (message_id,)
+            )
+            message = cursor.fetchone()
+            if not message:
+                raise HTTPException(status_code=404, detail="Message not found")
+            if message[0] != current_user["id"]:
+                raise HTTPException(status_code=403, detail="You can only delete your own messages")
 
-        # Отправляем уведомление об удалении всем участникам чата через WebSocket
-        message_data = {
-            "action": "delete",
-            "message_id": message_id,
-            "receiver_id": message[1],
-            "group_id": message[2]
-        }
+            read_ids = fetch_read_past(conn, current_user["id"], message[1], message[2], message_id)
 
-        if message[2]:  # Если это групповое сообщение
-            cursor.execute("SELECT user_id FROM group_members WHERE group_id = ?", (message[2],))
-            member_ids = [row[0] for row in cursor.fetchall()]
-            for member_id in member_ids:
-                await manager.send_personal_message(message_data, member_id)
-        else:  # Если это личное сообщение
-            await manager.send_personal_message(message_data, current_user["id"])
-            if message[1]:
-                await manager.send_personal_message(message_data, message[1])
-
-        return {"message": "Message deleted successfully"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to delete message: {str(e)}")
-    finally:
-        conn.close()
+            # Удаляем сообщение
+            cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            conn.commit()
+
+            # Отправляем уведомление об удалении всем участникам чата через WebSocket
+            message_data = {
+                "action": "delete",
+                "message_id": message_id,
+                "receiver_id": message[1],
+                "group_id": message[2]
+            }
+            state = fetch_conversation_state(conn, current_user["id"], message[1], message[2])
+            return message_data, fetch_recipient_ids(conn, current_user["id"], message[1], message[2]), state, read_ids
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to delete message: {str(e)}")
+
+    message_data, recipient_ids, state, read_ids = await run_db(remove_message)
+    await bus.publish(recipient_ids, message_data)
+    await publish_conversation_update(current_user["id"], message_data["receiver_id"], message_data["group_id"],
+                                      recipient_ids, state, unread_delta=-1, read_ids=read_ids)
 
+    return {"message": "Message deleted successfully"}
+
+
+async def send_read_receipt(user_id: int, last_read_id: int | None, receiver_id: int | None, group_id: int | None, recipient_ids: List[int]):
+    if not last_read_id:
+        return
+    receipt = {
+        "action": "read",
+        "user_id": user_id,
+        "receiver_id": receiver_id,
+        "group_id": group_id,
+        "last_read_message_id": last_read_id
+    }
+    await bus.publish(recipient_ids, receipt)
 
 @app.post("/messages/{receiver_id}/mark-read")
 async def mark_messages_as_read(receiver_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            """
-            UPDATE messages
-            SET is_read = 1
-            WHERE receiver_id = ? AND sender_id = ?
-            """,
-            (current_user["id"], receiver_id)
-        )
-        conn.commit()
-        conn.close()
-        return {"message": "Messages marked as read"}
-    except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Failed to mark messages as read: {str(e)}")
+    def mark_read(conn):
+        try:
+            last_read_id = update_read_cursor(conn, current_user["id"], private_conv_key(current_user["id"], receiver_id))
+            return last_read_id, fetch_recipient_ids(conn, current_user["id"], receiver_id, None)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to mark messages as read: {str(e)}")
+
+    last_read_id, recipient_ids = await run_db(mark_read)
+    await send_read_receipt(current_user["id"], last_read_id, receiver_id, None, recipient_ids)
+    return {"message": "Messages marked as read"}
 
 @app.post("/messages/group/{group_id}/mark-read")
 async def mark_group_messages_as_read(group_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            """
-            UPDATE messages
-            SET is_read = 1
-            WHERE group_id = ? AND sender_id != ?
-            """,
-            (group_id, current_user["id"])
-        )
-        conn.commit()
-        conn.close()
-        return {"message": "Group messages marked as read"}
-    except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=f"Failed to mark group messages as read: {str(e)}")
+    def mark_read(conn):
+        try:
+            last_read_id = update_read_cursor(conn, current_user["id"], group_conv_key(group_id))
+            return last_read_id, fetch_recipient_ids(conn, current_user["id"], None, group_id)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to mark group messages as read: {str(e)}")
+
+    last_read_id, recipient_ids = await run_db(mark_read)
+    await send_read_receipt(current_user["id"], last_read_id, None, group_id, recipient_ids)
+    return {"message": "Group messages marked as read"}
 
 @app.post("/messages/group/{group_id}/clear")
 async def clear_group_messages(group_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
-            (group_id, current_user["id"])
-        )
-        if not cursor.fetchone():
-            raise HTTPException(status_code=403, detail="Not a member of this group")
-        cursor.execute(
-            "DELETE FROM messages WHERE group_id = ? AND sender_id = ?",
-            (group_id, current_user["id"])
-        )
-        conn.commit()
-        conn.close()
-        return {"message": "Group chat cleared for user"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to clear group messages: {str(e)}")
-    finally:
-        conn.close()
+    def clear_messages(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
+                (group_id, current_user["id"])
+            )
+            if not cursor.fetchone():
+                raise HTTPException(status_code=403, detail="Not a member of this group")
+            unread_deltas = fetch_sender_unread(conn, current_user["id"], group_id)
+            cursor.execute(
+                "DELETE FROM messages WHERE group_id = ? AND sender_id = ?",
+                (group_id, current_user["id"])
+            )
+            conn.commit()
+            state = fetch_conversation_state(conn, current_user["id"], None, group_id)
+            return fetch_recipient_ids(conn, current_user["id"], None, group_id), state, unread_deltas
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to clear group messages: {str(e)}")
+
+    recipient_ids, state, unread_deltas = await run_db(clear_messages)
+    await publish_conversation_update(current_user["id"], None, group_id, recipient_ids, state,
+                                      unread_deltas=unread_deltas)
+    return {"message": "Group chat cleared for user"}
 
 @app.post("/messages/{receiver_id}/clear")
 async def clear_private_messages(receiver_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            """
-            DELETE FROM messages 
-            WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
-            """,
-            (current_user["id"], receiver_id, receiver_id, current_user["id"])
-        )
-        conn.commit()
-        conn.close()
-        return {"message": "Private chat cleared"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to clear private messages: {str(e)}")
-    finally:
-        conn.close()
+    def clear_messages(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                DELETE FROM messages 
+                WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
+                """,
+                (current_user["id"], receiver_id, receiver_id, current_user["id"])
+            )
+            conn.commit()
+            state = fetch_conversation_state(conn, current_user["id"], receiver_id, None)
+            return fetch_recipient_ids(conn, current_user["id"], receiver_id, None), state
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to clear private messages: {str(e)}")
+
+    recipient_ids, state = await run_db(clear_messages)
+    # Both sides drop the chat from their lists (last_message_id 0)
+    await publish_conversation_update(current_user["id"], receiver_id, None, recipient_ids, state)
+    return {"message": "Private chat cleared"}
 
 @app.post("/messages/{receiver_id}/delete")
 async def delete_private_chat(receiver_id: int, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
+    def delete_chat(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                DELETE FROM messages 
+                WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
+                """,
+                (current_user["id"], receiver_id, receiver_id, current_user["id"])
+            )
+            conn.commit()
+            state = fetch_conversation_state(conn, current_user["id"], receiver_id, None)
+            return fetch_recipient_ids(conn, current_user["id"], receiver_id, None), state
+        except Exception as e:
+            conn.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to delete private chat: {str(e)}")
+
+    recipient_ids, state = await run_db(delete_chat)
+    # Both sides drop the chat from their lists (last_message_id 0)
+    await publish_conversation_update(current_user["id"], receiver_id, None, recipient_ids, state)
+    return {"message": "Private chat deleted"}
+
+async def websocket_user_id(websocket: WebSocket) -> int | None:
+    # Browsers cannot set headers on a WebSocket, so the access token comes as ?token=
+    token = websocket.query_params.get("token")
+    if not token:
+        return None
     try:
-        cursor.execute(
-            """
-            DELETE FROM messages 
-            WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
-            """,
-            (current_user["id"], receiver_id, receiver_id, current_user["id"])
-        )
-        conn.commit()
-        conn.close()
-        return {"message": "Private chat deleted"}
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to delete private chat: {str(e)}")
-    finally:
-        conn.close()
+        user_id = decode_token_user_id(token, HTTPException(status_code=status.HTTP_401_UNAUTHORIZED))
+    except HTTPException:
+        return None
+    return user_id if await load_identity(user_id) is not None else None
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    await manager.connect(websocket, user_id)
+    # Только владелец токена: без этого по /ws/<id> можно было бы получать чужие сообщения и историю через resume
+    if await websocket_user_id(websocket) != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    connection = await manager.connect(websocket, user_id)
+    if len(manager.active_connections[user_id]) == 1:
+        await bus.subscribe(user_id)
+    presence.mark(user_id)
     try:
+        await presence.snapshot(connection)
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            message = await connection.receive()
+
+            if message.get("action") == "pong":
+                continue
+
+            # Набор текста: троттлинг и рассылка в TypingRelay, в базу ничего не пишется
+            if message.get("action") == "typing":
+                await typing_relay.typing(user_id, message.get("receiver_id"), message.get("group_id"))
+                continue
+
+            # Возобновление после переподключения: досылаем всё, что клиент пропустил
+            if message.get("action") == "resume":
+                since = int(message.get("last_seen_id") or 0)
+                while since > 0:
+                    page = await run_db(fetch_sync_page, user_id, since)
+                    # Только этой сессии: остальные вкладки ничего не пропускали
+                    connection.enqueue(encode_frame({"action": "sync", **page}, connection.binary))
+                    if not page["has_more"]:
+                        break
+                    since = page["last_message_id"]
+                continue
             
             # Проверяем, является ли сообщение действием edit или delete
             if "action" in message and message["action"] in ["edit", "delete"]:
                 # Просто пересылаем сообщение другим участникам без сохранения в базе
-                if "group_id" in message and message["group_id"]:
-                    conn = sqlite3.connect("chat.db")
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT user_id FROM group_members WHERE group_id = ?", (message["group_id"],))
-                    member_ids = [row[0] for row in cursor.fetchall()]
-                    conn.close()
-                    for member_id in member_ids:
-                        await manager.send_personal_message(message, member_id)
-                else:
-                    await manager.send_personal_message(message, user_id)
-                    if "receiver_id" in message and message["receiver_id"]:
-                        await manager.send_personal_message(message, message["receiver_id"])
+                recipient_ids = await run_db(fetch_recipient_ids, user_id, message.get("receiver_id"), message.get("group_id"))
+                await bus.publish(recipient_ids, message)
                 continue  # Пропускаем дальнейшую обработку
 
-            # Обрабатываем как новое сообщение
-            conn = sqlite3.connect("chat.db")
-            cursor = conn.cursor()
-            is_group_message = "group_id" in message and message["group_id"]
-
-            # Сохраняем сообщение в базе данных
-            files_json = json.dumps(message.get("files")) if message.get("files") else None
-            cursor.execute(
-                "INSERT INTO messages (sender_id, receiver_id, group_id, content, timestamp, is_read, files) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (
-                    user_id,
-                    message.get("receiver_id"),
-                    message.get("group_id"),
-                    message.get("content"),
-                    datetime.utcnow().isoformat(),
-                    0,
-                    files_json
-                )
-            )
-            message_id = cursor.lastrowid  # Получаем ID нового сообщения
-            conn.commit()
-
-            cursor.execute("SELECT username, avatar_url FROM users WHERE id = ?", (user_id,))
-            user_data = cursor.fetchone()
-            username = user_data[0]
-            avatar_url = user_data[1]
-
+            # Обрабатываем как новое сообщение: имя и аватар отправителя берём из кэша,
+            # а запись идёт общей транзакцией через message_writer
+            identity = await load_identity(user_id)
+            if identity is None:
+                break
+            message_id, timestamp, recipient_ids = await message_writer.write(user_id, message)
             message_data = {
-                "id": message_id,  # Добавляем ID сообщения
+                "id": message_id,
                 "content": message.get("content"),
-                "timestamp": datetime.utcnow().isoformat(),
+                "timestamp": timestamp,
                 "sender_id": user_id,
                 "receiver_id": message.get("receiver_id"),
                 "group_id": message.get("group_id"),
-                "username": username,
-                "avatar_url": avatar_url,
+                "username": identity[0]["username"],
+                "avatar_url": identity[0]["avatar_url"],
                 "is_read": False,
                 "files": message.get("files")
             }
-
-            if is_group_message:
-                cursor.execute("SELECT user_id FROM group_members WHERE group_id = ?", (message["group_id"],))
-                member_ids = [row[0] for row in cursor.fetchall()]
-                for member_id in member_ids:
-                    await manager.send_personal_message(message_data, member_id)
-            else:
-                await manager.send_personal_message(message_data, user_id)
-                await manager.send_personal_message(message_data, message["receiver_id"])
-            conn.close()
+            await bus.publish(recipient_ids, message_data)
+            await publish_conversation_update(user_id, message_data["receiver_id"], message_data["group_id"], recipient_ids, {
+                "last_message_id": message_id,
+                "last_activity": timestamp,
+                "preview": message_preview(message_data["content"]),
+            }, unread_delta=1)
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
-        manager.disconnect(user_id)
+        manager.disconnect(user_id, connection)
+        presence.mark(user_id)
+        if user_id not in manager.active_connections:
+            await bus.unsubscribe(user_id)
         
 @app.get("/settings", response_class=HTMLResponse)
 async def get_settings(request: Request):
-    with open("settings.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    return HTMLResponse(content=html_content)
+    return await page_cache.response(request, "settings.html")
 
 # Admin-related functions
-def is_admin(user: dict) -> bool:
-    with get_db() as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT is_admin FROM users WHERE id = ?", (user["id"],))
-        result = cursor.fetchone()
-        return result and result[0] == 1
+async def user_is_admin(user: dict) -> bool:
+    identity = await load_identity(user["id"])
+    return identity is not None and identity[1]
 
 async def get_admin_user(request: Request, token: str = Depends(oauth2_scheme)):
     user = await get_current_user(request, token)
-    if not is_admin(user):
+    if not await user_is_admin(user):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not enough permissions"
@@ -1536,12 +4193,11 @@ async def get_admin_user(request: Request, token: str = Depends(oauth2_scheme)):
 # Admin endpoints
 @app.get("/admin", response_class=HTMLResponse)
 async def get_admin_page(request: Request, current_user: dict = Depends(get_admin_user)):
-    with open("templates/admin.html", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return await page_cache.response(request, "templates/admin.html")
 
 @app.get("/admin/chats", response_model=List[AdminChat])
 async def get_all_chats(current_user: dict = Depends(get_admin_user), search: str = ""):
-    with get_db() as db:
+    def fetch_chats(db):
         cursor = db.cursor()
         base_query = """
             WITH chat_pairs AS (
@@ -1591,7 +4247,8 @@ async def get_all_chats(current_user: dict = Depends(get_admin_user), search: st
         base_query += " ORDER BY last_message_time DESC NULLS LAST"
         cursor.execute(base_query, params)
         chats = cursor.fetchall()
-        return [
+        # Only the AdminChat fields: the last message columns are there for the ordering
+        return ORJSONResponse([
             {
                 "id": f"{chat[0]}_{chat[1]}",
                 "user1_id": chat[0],
@@ -1600,15 +4257,15 @@ async def get_all_chats(current_user: dict = Depends(get_admin_user), search: st
                 "user2_username": chat[3],
                 "user1_avatar_url": chat[4],
                 "user2_avatar_url": chat[5],
-                "last_message": chat[6],
-                "last_message_time": chat[7],
             }
             for chat in chats
-        ]
+        ])
+
+    return await run_db(fetch_chats)
 
 @app.get("/admin/groups", response_model=List[AdminGroup])
 async def get_all_groups(current_user: dict = Depends(get_admin_user)):
-    with get_db() as db:
+    def fetch_groups(db):
         cursor = db.cursor()
         cursor.execute("""
             SELECT g.id, g.name, g.description, g.avatar_url, u.username as creator_username,
@@ -1620,64 +4277,79 @@ async def get_all_groups(current_user: dict = Depends(get_admin_user)):
             ORDER BY g.created_at DESC
         """)
         groups = cursor.fetchall()
-        return [
-            AdminGroup(
-                id=group[0],
-                name=group[1],
-                description=group[2],
-                avatar_url=group[3],
-                creator_username=group[4],
-                member_count=group[5],
-                created_at=group[6]
-            )
+        return ORJSONResponse([
+            {
+                "id": group[0],
+                "name": group[1],
+                "description": group[2],
+                "avatar_url": group[3],
+                "creator_username": group[4],
+                "member_count": group[5],
+                "created_at": group[6]
+            }
             for group in groups
-        ]
-
-@app.get("/admin/messages/{chat_id}", response_model=List[Message])
-async def get_chat_messages(chat_id: str, current_user: dict = Depends(get_admin_user)):
+        ])
+
+    return await run_db(fetch_groups)
+
+@app.get("/admin/messages/search", response_model=List[MessageSearchResult])
+async def admin_search_messages(
+    query: str = Query(..., min_length=2),
+    chat_id: str | None = Query(None, description="Private chat as user1_user2"),
+    group_id: int | None = Query(None),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(get_admin_user)
+):
+    if not query.strip():
+        raise HTTPException(status_code=422, detail="Query must not be blank")
+    if chat_id is not None:
+        try:
+            user1_id, user2_id = map(int, chat_id.split("_"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid chat_id format")
+
+    def find_messages(db):
+        if group_id is not None:
+            return search_messages(db, query, SEARCH_GROUP_MESSAGES_SQL, (group_id,), limit, offset)
+        if chat_id is not None:
+            return search_messages(
+                db, query, SEARCH_PRIVATE_MESSAGES_SQL, (user1_id, user2_id, user2_id, user1_id), limit, offset
+            )
+        return search_messages(db, query, SEARCH_ALL_MESSAGES_SQL, (), limit, offset)
+
+    return await run_db(find_messages)
+
+@app.get("/admin/messages/{chat_id}", response_model=List[Message] | MessagePage)
+async def get_chat_messages(
+    chat_id: str,
+    before_id: int | None = Query(None, ge=1),
+    after_id: int | None = Query(None, ge=0),
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+    compact: bool = Query(False),
+    current_user: dict = Depends(get_admin_user)
+):
     # chat_id is in the form 'user1id_user2id'
     try:
         user1_id, user2_id = map(int, chat_id.split('_'))
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid chat_id format")
-    with get_db() as db:
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id,
-                   m.group_id, u.username, u.avatar_url, m.is_read, m.files
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            WHERE ((m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?))
-              AND m.group_id IS NULL
-            ORDER BY m.timestamp ASC
-        """, (user1_id, user2_id, user2_id, user1_id))
-        messages = cursor.fetchall()
-        return [
-            Message(
-                id=msg[0],
-                content=msg[1],
-                timestamp=msg[2],
-                sender_id=msg[3],
-                receiver_id=msg[4],
-                group_id=msg[5],
-                username=msg[6],
-                avatar_url=msg[7],
-                is_read=bool(msg[8]),
-                files=json.loads(msg[9]) if msg[9] else []
-            )
-            for msg in messages
-        ]
+
+    def fetch_messages(db):
+        return fetch_private_history_page(db, user1_id, user2_id, before_id, after_id, limit)
+
+    return await history_response(await run_db(fetch_messages), compact, no_files=[])
 
 @app.post("/admin/set-admin/{user_id}")
 async def set_user_as_admin(user_id: int, current_user: dict = Depends(get_current_user)):
     # First, check if the current user is already an admin
-    if not is_admin(current_user):
+    if not await user_is_admin(current_user):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not enough permissions"
         )
-    
-    with get_db() as db:
+
+    def grant_admin(db):
         cursor = db.cursor()
         # Check if the target user exists
         cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
@@ -1689,33 +4361,59 @@ async def set_user_as_admin(user_id: int, current_user: dict = Depends(get_curre
         db.commit()
         return {"message": "User set as admin successfully"}
 
-@app.get("/admin/messages/group/{group_id}", response_model=List[Message])
-async def admin_get_group_messages(group_id: int, current_user: dict = Depends(get_admin_user)):
-    with get_db() as db:
-        cursor = db.cursor()
-        cursor.execute("""
-            SELECT m.id, m.content, m.timestamp, m.sender_id, m.receiver_id,
-                   m.group_id, u.username, u.avatar_url, m.is_read, m.files
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            WHERE m.group_id = ?
-            ORDER BY m.timestamp ASC
-        """, (group_id,))
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({
-                "id": row[0],
-                "content": row[1],
-                "timestamp": row[2],
-                "sender_id": row[3],
-                "receiver_id": row[4],
-                "group_id": row[5],
-                "username": row[6],
-                "avatar_url": row[7],
-                "is_read": bool(row[8]),
-                "files": json.loads(row[9]) if row[9] else []
-            })
-        return messages
+    result = await run_db(grant_admin)
+    identity_cache.invalidate(user_id)
+    return result
+
+@app.get("/admin/db-stats")
+async def get_db_stats(current_user: dict = Depends(get_admin_user)):
+    stats = db_stats.snapshot()
+    stats["pool"].update(db_pool.status())
+    stats["message_writer"] = message_writer.stats()
+    return stats
+
+@app.get("/admin/ws-stats")
+async def get_ws_stats(current_user: dict = Depends(get_admin_user)):
+    stats = ws_stats.snapshot()
+    stats["sessions"] = sum(len(sessions) for sessions in manager.active_connections.values())
+    return stats
+
+@app.get("/admin/upload-stats")
+async def get_upload_stats(current_user: dict = Depends(get_admin_user)):
+    return upload_stats.snapshot()
+
+@app.get("/admin/storage-stats")
+async def get_storage_stats(current_user: dict = Depends(get_admin_user)):
+    def fetch_storage_stats(conn):
+        row = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(ref_count), 0), COALESCE(SUM(ref_count = 0), 0) FROM blobs"
+        ).fetchone()
+        # references / blobs is how many times an average stored file is reused
+        return {"blobs": row[0], "bytes": row[1], "references": row[2], "unreferenced": row[3]}
+
+    return await run_db(fetch_storage_stats)
+
+@app.get("/admin/cache-stats")
+async def get_cache_stats(current_user: dict = Depends(get_admin_user)):
+    return {
+        "tokens": token_cache.snapshot(),
+        "identities": identity_cache.snapshot(),
+        "profiles": profile_cache.snapshot(),
+    }
+
+@app.get("/admin/messages/group/{group_id}", response_model=List[Message] | MessagePage)
+async def admin_get_group_messages(
+    group_id: int,
+    before_id: int | None = Query(None, ge=1),
+    after_id: int | None = Query(None, ge=0),
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+    compact: bool = Query(False),
+    current_user: dict = Depends(get_admin_user)
+):
+    def fetch_messages(db):
+        return fetch_group_history_page(db, group_id, current_user["id"], before_id, after_id, limit)
+
+    return await history_response(await run_db(fetch_messages), compact, no_files=[])
 
 @app.post('/translate')
 async def translate(request: Request):
@@ -1740,5 +4438,6 @@ async def translate(request: Request):
     return response.json()
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Spawned pool workers re-import the script that started the process; hand over to run.py so that
+    # script is not this module
+    os.execv(sys.executable, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")])
\ No newline at end of file
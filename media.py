@@ -0,0 +1,53 @@
+import base64
+import io
+import os
+
+from PIL import Image, ImageFilter, ImageOps
+
+# Image variants for the media process pool. Like passwords.py, this and the starting script (run.py,
+# inert when re-imported) are all the pool workers import, so it stays free of app state.
+
+def variant_path(path: str, width: int) -> str:
+    # static/uploads/<digest>.png -> static/uploads/<digest>.w320.webp
+    return f"{os.path.splitext(path)[0]}.w{width}.webp"
+
+def placeholder_path(path: str) -> str:
+    return f"{os.path.splitext(path)[0]}.blur.jpg"
+
+def make_variants(path: str, widths: list, placeholder_width: int) -> str | None:
+    # Writes a WebP thumbnail for every width (never wider than the original) and a tiny blurred JPEG,
+    # and returns the placeholder as a data: URI. Files that already exist are kept, so running this
+    # twice for the same blob is cheap. Animated images get no variants; None is returned for them.
+    with Image.open(path) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+
+        for width in sorted(widths, reverse=True):
+            target = variant_path(path, width)
+            if os.path.exists(target):
+                continue
+            variant = image.copy()
+            variant.thumbnail((width, width * 4))
+            _save_atomically(variant, target, "WEBP", quality=80, method=4)
+
+        target = placeholder_path(path)
+        if not os.path.exists(target):
+            placeholder = image.convert("RGB")
+            placeholder.thumbnail((placeholder_width, placeholder_width * 4))
+            placeholder = placeholder.filter(ImageFilter.GaussianBlur(1))
+            _save_atomically(placeholder, target, "JPEG", quality=40)
+
+    with open(target, "rb") as f:
+        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+
+def _save_atomically(image, target: str, format: str, **options):
+    # Written under a temporary name and renamed, so a half-written variant is never served
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    part = f"{target}.{os.getpid()}.part"
+    with open(part, "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(part, target)
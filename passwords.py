@@ -0,0 +1,22 @@
+from passlib.context import CryptContext
+
+# bcrypt work for the password process pool. Besides the starting script (run.py, which does nothing when
+# re-imported) this module is all the pool workers import, so it stays free of app state: no database,
+# no FastAPI app, nothing that runs at import time.
+
+_contexts = {}
+
+def _context(rounds: int) -> CryptContext:
+    context = _contexts.get(rounds)
+    if context is None:
+        context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+        _contexts[rounds] = context
+    return context
+
+def hash_password(password: str, rounds: int) -> str:
+    return _context(rounds).hash(password)
+
+def verify_and_update(password: str, hashed_password: str, rounds: int):
+    # Returns (valid, new_hash). new_hash is set when the stored hash was made with a different cost
+    # than the configured one and should replace it.
+    return _context(rounds).verify_and_update(password, hashed_password)
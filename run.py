@@ -0,0 +1,14 @@
+# Starts the app the way it is meant to be served: uvicorn with TunedWebSocketProtocol, which the uvicorn
+# CLI cannot be given. The password and media pools spawn their workers, and a spawned worker re-imports
+# the script that started the process. That script has to be this one and not main.py, or every worker
+# would run the migrations, open the database and build the app again. Everything here stays under the
+# __main__ guard so the workers get nothing from it but passwords.py or media.py.
+#
+#   python run.py
+
+if __name__ == "__main__":
+    import uvicorn
+
+    from ws_protocol import TunedWebSocketProtocol
+
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, ws=TunedWebSocketProtocol)
@@ -4,6 +4,13 @@ document.addEventListener('DOMContentLoaded', function() {
     let currentGroupId = null;
     let currentUserId = null;
 
+    // History is paged by message id; older pages are fetched when scrolling to the top
+    const MESSAGES_PAGE_SIZE = 50;
+    let messagesUrl = null;
+    let loadedMessages = [];
+    let hasMoreMessages = false;
+    let isLoadingMessages = false;
+
     // Initialize admin panel
     initAdminPanel();
 
@@ -210,34 +217,63 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
-    async function loadChatMessages(chatId) {
+    async function fetchMessagesPage(url, params) {
+        const response = await fetch(`${url}?${new URLSearchParams(params)}`, {
+            headers: {
+                'Authorization': `Bearer ${localStorage.getItem('token')}`
+            }
+        });
+        return response.json();
+    }
+
+    async function loadMessages(url) {
         try {
-            const response = await fetch(`/admin/messages/${chatId}`, {
-                headers: {
-                    'Authorization': `Bearer ${localStorage.getItem('token')}`
-                }
-            });
-            const messages = await response.json();
-            displayMessages(messages);
+            messagesUrl = url;
+            const messages = await fetchMessagesPage(url, { limit: MESSAGES_PAGE_SIZE });
+            if (url !== messagesUrl) return;
+            loadedMessages = messages;
+            hasMoreMessages = messages.length === MESSAGES_PAGE_SIZE;
+            displayMessages(loadedMessages);
         } catch (error) {
             showFlashMessage('Ошибка при загрузке сообщений', 'danger');
         }
     }
 
-    async function loadGroupMessages(groupId) {
+    async function loadOlderMessages() {
+        if (isLoadingMessages || !hasMoreMessages || loadedMessages.length === 0) return;
+        isLoadingMessages = true;
+        const url = messagesUrl;
         try {
-            const response = await fetch(`/admin/messages/group/${groupId}`, {
-                headers: {
-                    'Authorization': `Bearer ${localStorage.getItem('token')}`
-                }
-            });
-            const messages = await response.json();
-            displayMessages(messages);
+            const messages = await fetchMessagesPage(url, { before_id: loadedMessages[0].id, limit: MESSAGES_PAGE_SIZE });
+            if (url !== messagesUrl) return;
+            hasMoreMessages = messages.length === MESSAGES_PAGE_SIZE;
+            if (messages.length === 0) return;
+            const messagesContainer = document.getElementById('chat-messages');
+            const offsetFromBottom = messagesContainer.scrollHeight - messagesContainer.scrollTop;
+            loadedMessages = messages.concat(loadedMessages);
+            displayMessages(loadedMessages);
+            messagesContainer.scrollTop = messagesContainer.scrollHeight - offsetFromBottom;
         } catch (error) {
             showFlashMessage('Ошибка при загрузке сообщений', 'danger');
+        } finally {
+            isLoadingMessages = false;
         }
     }
 
+    document.getElementById('chat-messages').addEventListener('scroll', (e) => {
+        if (e.target.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
+
+    async function loadChatMessages(chatId) {
+        await loadMessages(`/admin/messages/${chatId}`);
+    }
+
+    async function loadGroupMessages(groupId) {
+        await loadMessages(`/admin/messages/group/${groupId}`);
+    }
+
     function displayMessages(messages) {
         const messagesContainer = document.getElementById('chat-messages');
         messagesContainer.innerHTML = '';
@@ -26,6 +26,182 @@ function formatDateToRussian(date) {
     return `${day} ${month}`;
 }
 
+// Экранирование пользовательского текста перед вставкой в HTML
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML.replace(/"/g, '&quot;');
+}
+
+// Уменьшенная копия изображения (аватара или вложения) шириной не меньше width;
+// пока миниатюры нет, сервер отдаёт оригинал
+function mediaVariantUrl(url, width) {
+    return `/media/variant?url=${encodeURIComponent(url)}&width=${Math.round(width * (window.devicePixelRatio || 1))}`;
+}
+
+// Превью изображения в сообщении: браузер сам выбирает миниатюру по srcset,
+// а размытая заглушка видна, пока она загружается
+function imagePreviewHtml(file) {
+    const thumbnails = Object.entries(file.thumbnails || {})
+        .filter(([width, url]) => /^\d+$/.test(width) && /^\/static\/uploads\/[0-9a-f]{64}\.w\d+\.webp$/.test(url));
+    const placeholder = /^data:image\/jpeg;base64,[A-Za-z0-9+\/=]+$/.test(file.placeholder || '') ? file.placeholder : null;
+    const srcset = thumbnails.map(([width, url]) => `${url} ${width}w`).join(', ');
+    return `<img src="${escapeHtml(file.file_url)}" alt="Image" class="preview-image-sent" loading="lazy"` +
+        (srcset ? ` srcset="${srcset}" sizes="300px"` : '') +
+        (placeholder ? ` style="background: url(${placeholder}) center / cover no-repeat"` : '') + '>';
+}
+
+// Индикатор набора: отправляем не чаще раза в TYPING_SEND_MS (как TYPING_INTERVAL на сервере),
+// показываем TYPING_SHOWN_MS после последнего события
+const TYPING_SEND_MS = 3000;
+const TYPING_SHOWN_MS = 6000;
+
+// Бинарный протокол WebSocket (chat.msgpack.v1): MessagePack, в котором известные ключи передаются
+// номером в WIRE_KEYS вместо строки. Таблица должна совпадать с wire.KEYS на сервере
+const WIRE_SUBPROTOCOL = 'chat.msgpack.v1';
+const WIRE_KEYS = [
+    'action', 'id', 'message_id', 'content', 'timestamp', 'sender_id', 'receiver_id', 'group_id',
+    'username', 'avatar_url', 'is_read', 'files', 'file_url', 'file_type', 'file_name', 'thumbnails',
+    'placeholder', 'user_id', 'last_read_message_id', 'last_seen_id', 'messages', 'changes', 'has_more',
+    'last_message_id', 'edited', 'deleted',
+];
+const WIRE_KEY_INDEX = new Map(WIRE_KEYS.map((key, index) => [key, index]));
+
+function wirePack(value) {
+    const encoder = new TextEncoder();
+    let buffer = new Uint8Array(256);
+    let view = new DataView(buffer.buffer);
+    let length = 0;
+
+    function reserve(size) {
+        if (length + size <= buffer.length) return;
+        const grown = new Uint8Array(Math.max(buffer.length * 2, length + size));
+        grown.set(buffer);
+        buffer = grown;
+        view = new DataView(buffer.buffer);
+    }
+    function byte(b) {
+        reserve(1);
+        buffer[length++] = b;
+    }
+    function fixed(type, size, setter, number) {
+        byte(type);
+        reserve(size);
+        setter.call(view, length, number);
+        length += size;
+    }
+    function sized(size, fixBase, fixLimit, type8, type16, type32) {
+        if (size < fixLimit) byte(fixBase | size);
+        else if (type8 !== null && size <= 0xff) fixed(type8, 1, view.setUint8, size);
+        else if (size <= 0xffff) fixed(type16, 2, view.setUint16, size);
+        else fixed(type32, 4, view.setUint32, size);
+    }
+    function write(item) {
+        if (item === null || item === undefined) byte(0xc0);
+        else if (item === false) byte(0xc2);
+        else if (item === true) byte(0xc3);
+        else if (typeof item === 'number') {
+            if (!Number.isSafeInteger(item)) fixed(0xcb, 8, view.setFloat64, item);
+            else if (item >= 0 && item < 0x80) byte(item);
+            else if (item < 0 && item >= -0x20) byte(item & 0xff);
+            else if (item >= 0 && item <= 0xffffffff) fixed(0xce, 4, view.setUint32, item);
+            else if (item < 0 && item >= -0x80000000) fixed(0xd2, 4, view.setInt32, item);
+            else fixed(0xd3, 8, view.setBigInt64, BigInt(item));
+        } else if (typeof item === 'string') {
+            const data = encoder.encode(item);
+            sized(data.length, 0xa0, 0x20, 0xd9, 0xda, 0xdb);
+            reserve(data.length);
+            buffer.set(data, length);
+            length += data.length;
+        } else if (Array.isArray(item)) {
+            sized(item.length, 0x90, 0x10, null, 0xdc, 0xdd);
+            item.forEach(write);
+        } else if (typeof item === 'object') {
+            // Как и JSON.stringify, пропускаем поля со значением undefined
+            const entries = Object.entries(item).filter(([, entry]) => entry !== undefined);
+            sized(entries.length, 0x80, 0x10, null, 0xde, 0xdf);
+            for (const [key, entry] of entries) {
+                write(WIRE_KEY_INDEX.has(key) ? WIRE_KEY_INDEX.get(key) : key);
+                write(entry);
+            }
+        } else {
+            throw new TypeError(`Нельзя закодировать ${typeof item}`);
+        }
+    }
+
+    write(value);
+    return buffer.slice(0, length);
+}
+
+function wireUnpack(data) {
+    const bytes = new Uint8Array(data);
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const decoder = new TextDecoder();
+    let offset = 0;
+
+    function fixed(size, getter) {
+        const number = getter.call(view, offset);
+        offset += size;
+        return typeof number === 'bigint' ? Number(number) : number;
+    }
+    function slice(size) {
+        if (offset + size > bytes.length) throw new Error('Кадр обрывается');
+        const part = bytes.subarray(offset, offset + size);
+        offset += size;
+        return part;
+    }
+    function array(size) {
+        const items = [];
+        for (let i = 0; i < size; i++) items.push(read());
+        return items;
+    }
+    function map(size) {
+        const result = {};
+        for (let i = 0; i < size; i++) {
+            const key = read();
+            result[typeof key === 'number' && key < WIRE_KEYS.length ? WIRE_KEYS[key] : key] = read();
+        }
+        return result;
+    }
+    function read() {
+        if (offset >= bytes.length) throw new Error('Кадр обрывается');
+        const type = bytes[offset++];
+        if (type < 0x80) return type;
+        if (type >= 0xe0) return type - 0x100;
+        if (type <= 0x8f) return map(type & 0x0f);
+        if (type <= 0x9f) return array(type & 0x0f);
+        if (type <= 0xbf) return decoder.decode(slice(type & 0x1f));
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return slice(fixed(1, view.getUint8)).slice();
+            case 0xc5: return slice(fixed(2, view.getUint16)).slice();
+            case 0xc6: return slice(fixed(4, view.getUint32)).slice();
+            case 0xca: return fixed(4, view.getFloat32);
+            case 0xcb: return fixed(8, view.getFloat64);
+            case 0xcc: return fixed(1, view.getUint8);
+            case 0xcd: return fixed(2, view.getUint16);
+            case 0xce: return fixed(4, view.getUint32);
+            case 0xcf: return fixed(8, view.getBigUint64);
+            case 0xd0: return fixed(1, view.getInt8);
+            case 0xd1: return fixed(2, view.getInt16);
+            case 0xd2: return fixed(4, view.getInt32);
+            case 0xd3: return fixed(8, view.getBigInt64);
+            case 0xd9: return decoder.decode(slice(fixed(1, view.getUint8)));
+            case 0xda: return decoder.decode(slice(fixed(2, view.getUint16)));
+            case 0xdb: return decoder.decode(slice(fixed(4, view.getUint32)));
+            case 0xdc: return array(fixed(2, view.getUint16));
+            case 0xdd: return array(fixed(4, view.getUint32));
+            case 0xde: return map(fixed(2, view.getUint16));
+            case 0xdf: return map(fixed(4, view.getUint32));
+        }
+        throw new Error(`Неизвестный тип 0x${type.toString(16)}`);
+    }
+
+    return read();
+}
+
 // === Move these functions to global scope ===
 async function loadRecentChats() {
     const token = localStorage.getItem('token');
@@ -69,7 +245,7 @@ async function addChatToList(userId, groupId, username, avatarUrl, unreadCount,
         avatarDiv.className = 'group-avatar';
         if (avatarUrl) {
             const avatarImg = document.createElement('img');
-            avatarImg.src = avatarUrl;
+            avatarImg.src = mediaVariantUrl(avatarUrl, 48);
             avatarImg.alt = username;
             avatarDiv.appendChild(avatarImg);
         } else {
@@ -648,6 +824,16 @@ document.addEventListener('DOMContentLoaded', async () => {
         let hasMarkedAsRead = false;
         let hasInteracted = false;
         let lastMessageDate = null; // Для отслеживания последней даты сообщения
+        const MESSAGES_PAGE_SIZE = 50;
+        let oldestLoadedMessageId = null; // Курсор для подгрузки более старых сообщений
+        let hasMoreHistory = false;
+        let isLoadingHistory = false;
+        let lastSeenMessageId = 0; // Самое новое сообщение, известное клиенту, для синхронизации при переподключении
+        let reconnectDelay = 1000;
+        const onlineUsers = new Set(); // Собеседники в сети, по событиям presence
+        const typingUsers = new Map(); // Ключ чата -> Map(userId -> {name, until})
+        let lastTypingSent = 0;
+        let recentChatsReload = null; // Отложенная перезагрузка списка чатов
 
         let selectedFiles = [];
         const chatForm = document.getElementById('chat-form');
@@ -698,6 +884,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                     currentGroupId = isGroup ? parseInt(chatItem.dataset.id) : null;
                     currentChatUserId = isGroup ? null : parseInt(chatItem.dataset.id);
                     console.log('Выбран чат, currentGroupId:', currentGroupId, 'currentChatUserId:', currentChatUserId);
+                    updateChatStatus();
                 }
             });
         }
@@ -846,7 +1033,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                         files: fileDataList.length > 0 ? fileDataList : null
                     };
                     console.log('Отправляю сообщение:', messageData);
-                    ws.send(JSON.stringify(messageData));
+                    sendEvent(messageData);
                     messageInput.value = '';
                     selectedFiles = [];
                     updatePreview();
@@ -937,7 +1124,81 @@ document.addEventListener('DOMContentLoaded', async () => {
             });
         }
 
+        // Большие видео загружаются по частям: после обрыва связи или перезагрузки страницы
+        // загрузка продолжается с тех частей, которых ещё нет на сервере
+        const RESUMABLE_UPLOAD_MIN_SIZE = 8 * 1024 * 1024;
+        const CHUNK_RETRY_LIMIT = 5;
+
+        async function uploadJson(url, options = {}) {
+            const response = await fetch(url, {
+                ...options,
+                headers: { 'Authorization': `Bearer ${token}`, ...(options.headers || {}) }
+            });
+            const result = await response.json();
+            if (!response.ok) {
+                const error = new Error(result.detail);
+                error.status = response.status;
+                throw error;
+            }
+            return result;
+        }
+
+        async function uploadResumable(file) {
+            const sessionKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+            let session = null;
+            const savedId = localStorage.getItem(sessionKey);
+            if (savedId) {
+                try {
+                    session = await uploadJson(`/uploads/${savedId}`);
+                } catch (error) {
+                    localStorage.removeItem(sessionKey);
+                }
+            }
+            if (!session) {
+                session = await uploadJson('/uploads', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ filename: file.name, content_type: file.type, size: file.size })
+                });
+                localStorage.setItem(sessionKey, session.upload_id);
+            }
+
+            const received = new Set(session.received);
+            for (let index = 0; index < session.chunk_count; index++) {
+                if (received.has(index)) continue;
+                const chunk = file.slice(index * session.chunk_size, (index + 1) * session.chunk_size);
+                for (let attempt = 1; ; attempt++) {
+                    try {
+                        await uploadJson(`/uploads/${session.upload_id}/chunks/${index}`, { method: 'PUT', body: chunk });
+                        break;
+                    } catch (error) {
+                        // Ответ сервера с ошибкой (кроме 5xx) повторять бесполезно
+                        if ((error.status && error.status < 500) || attempt >= CHUNK_RETRY_LIMIT) throw error;
+                        console.warn(`Повтор части ${index} (${attempt}):`, error.message);
+                        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+                    }
+                }
+                console.log(`Загружена часть ${index + 1}/${session.chunk_count} файла ${file.name}`);
+            }
+
+            const result = await uploadJson(`/uploads/${session.upload_id}/complete`, { method: 'POST' });
+            localStorage.removeItem(sessionKey);
+            return result;
+        }
+
         async function uploadAndSendFile(file) {
+            if (file.type.startsWith('video/') && file.size > RESUMABLE_UPLOAD_MIN_SIZE) {
+                try {
+                    console.log('Загружаю видео по частям:', file.name);
+                    const result = await uploadResumable(file);
+                    console.log('Файл успешно загружен:', result);
+                    return { file_url: result.file_url, file_type: result.file_type, file_name: result.file_name };
+                } catch (error) {
+                    console.error('Ошибка загрузки файла:', error);
+                    showFlashMessage(`Не удалось загрузить файл: ${error.message}`, 'danger');
+                    throw error;
+                }
+            }
             const formData = new FormData();
             formData.append('file', file);
             try {
@@ -952,7 +1213,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                 const result = await response.json();
                 if (response.ok) {
                     console.log('Файл успешно загружен:', result);
-                    return { file_url: result.file_url, file_type: result.file_type };
+                    return { file_url: result.file_url, file_type: result.file_type, file_name: result.file_name };
                 } else {
                     console.error('Ошибка сервера:', result.detail);
                     showFlashMessage(result.detail, 'danger');
@@ -1334,7 +1595,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                     chatList.innerHTML = '<div class="group-item">Нет недавних чатов</div>';
                 } else {
                     recentChats.forEach(chat => {
-                        addChatToList(chat.user_id, chat.group_id, chat.username, chat.avatar_url, chat.unread_count, chat.is_group);
+                        addChatToList(chat.user_id, chat.group_id, chat.username, chat.avatar_url, chat.unread_count, chat.is_group, chat);
                     });
                 }
             } catch (error) {
@@ -1343,8 +1604,8 @@ document.addEventListener('DOMContentLoaded', async () => {
             }
         }
 
-        // Добавление пользователя или группы в список чатов
-        async function addChatToList(userId, groupId, username, avatarUrl, unreadCount, isGroup) {
+        // Добавление пользователя или группы в список чатов; conversation — превью и время из /messages/recent
+        async function addChatToList(userId, groupId, username, avatarUrl, unreadCount, isGroup, conversation = null) {
             const id = isGroup ? groupId : userId;
             const existingChat = document.querySelector(`.group-item[data-id="${id}"][data-is-group="${isGroup}"]`);
             if (!existingChat) {
@@ -1352,13 +1613,14 @@ document.addEventListener('DOMContentLoaded', async () => {
                 chatItem.className = 'group-item';
                 chatItem.dataset.id = id;
                 chatItem.dataset.isGroup = isGroup;
+                chatItem.classList.toggle('online', !isGroup && onlineUsers.has(userId));
 
                 // Добавляем аватарку
                 const avatarDiv = document.createElement('div');
                 avatarDiv.className = 'group-avatar';
                 if (avatarUrl) {
                     const avatarImg = document.createElement('img');
-                    avatarImg.src = avatarUrl;
+                    avatarImg.src = mediaVariantUrl(avatarUrl, 48);
                     avatarImg.alt = username;
                     avatarDiv.appendChild(avatarImg);
                 } else {
@@ -1376,10 +1638,16 @@ document.addEventListener('DOMContentLoaded', async () => {
                 const infoDiv = document.createElement('div');
                 infoDiv.className = 'group-info';
                 infoDiv.innerHTML = `
-                    <span class="group-name">${username}</span>
+                    <div class="group-text">
+                        <span class="group-name">${username}</span>
+                        <span class="group-preview"></span>
+                    </div>
                     ${unreadCount > 0 ? `<span class="unread-count">${unreadCount}</span>` : ''}
                 `;
                 chatItem.appendChild(infoDiv);
+                if (conversation) {
+                    setChatPreview(chatItem, conversation);
+                }
                 chatItem.addEventListener('click', async () => {
                     if (currentChatUserId || currentGroupId) {
                         await markMessagesAsRead(currentChatUserId, currentGroupId);
@@ -1486,6 +1754,291 @@ document.addEventListener('DOMContentLoaded', async () => {
             }
         }
 
+        function noteMessageSeen(messageId) {
+            if (messageId && messageId > lastSeenMessageId) {
+                lastSeenMessageId = messageId;
+            }
+        }
+
+        // Применение пропущенных за время отключения событий (ответ на resume)
+        function applySync(sync) {
+            console.log('Синхронизация:', sync);
+            sync.messages.forEach(handleServerEvent);
+            sync.edited.forEach(handleServerEvent);
+            sync.deleted.forEach(handleServerEvent);
+            noteMessageSeen(sync.last_message_id);
+            // conversation_updated за время обрыва не приходили: список чатов перечитываем один раз
+            if (!sync.has_more && (sync.messages.length || sync.edited.length || sync.deleted.length)) {
+                scheduleRecentChatsReload();
+            }
+        }
+
+        // Инкрементальные обновления списка чатов от сервера вместо повторной загрузки /messages/recent
+        function applyConversationUpdate(event) {
+            const isGroup = Boolean(event.group_id);
+            const id = isGroup ? event.group_id : event.user_id;
+            const chatItem = chatList.querySelector(`.group-item[data-id="${id}"][data-is-group="${isGroup}"]`);
+            if (!chatItem) {
+                // Новый собеседник или чат за пределами недавних: один запрос на пачку таких событий
+                if (event.last_message_id) scheduleRecentChatsReload();
+                return;
+            }
+            if (event.removed || (!isGroup && event.last_message_id === 0)) {
+                chatItem.remove(); // В личном чате не осталось сообщений или нас больше нет в группе
+                return;
+            }
+            const isOpen = isGroup ? id === currentGroupId : id === currentChatUserId;
+            if (event.unread_delta && !isOpen) {
+                const counter = chatItem.querySelector('.unread-count');
+                const count = (counter ? parseInt(counter.textContent) : 0) + event.unread_delta;
+                updateUnreadCount(id, isGroup, Math.max(0, count));
+            }
+            setChatPreview(chatItem, event);
+            if (event.last_activity) placeChatItem(chatItem);
+        }
+
+        function scheduleRecentChatsReload() {
+            if (recentChatsReload) return;
+            recentChatsReload = setTimeout(() => {
+                recentChatsReload = null;
+                loadRecentChats();
+            }, 500);
+        }
+
+        // Превью последнего сообщения и время активности чата (для сортировки)
+        function setChatPreview(chatItem, conversation) {
+            if (conversation.last_activity) {
+                chatItem.dataset.lastActivity = conversation.last_activity;
+            }
+            const previewEl = chatItem.querySelector('.group-preview');
+            if (previewEl && conversation.preview !== undefined) {
+                previewEl.textContent = conversation.preview || (conversation.last_message_id === 0 ? '' : 'Вложение');
+            }
+        }
+
+        // Ставим чат перед первым, у которого активность была раньше
+        function placeChatItem(chatItem) {
+            const activity = chatItem.dataset.lastActivity || '';
+            const next = [...chatList.querySelectorAll('.group-item[data-id]')]
+                .find(item => item !== chatItem && (item.dataset.lastActivity || '') < activity);
+            if (next) {
+                chatList.insertBefore(chatItem, next);
+            } else {
+                chatList.appendChild(chatItem);
+            }
+        }
+
+        // Квитанция о прочтении: наша собственная (из другой вкладки) или собеседника
+        function applyReadReceipt(receipt) {
+            if (receipt.user_id === currentUserId) {
+                if (receipt.group_id) {
+                    updateUnreadCount(receipt.group_id, true, 0);
+                } else {
+                    updateUnreadCount(receipt.receiver_id, false, 0);
+                }
+                return;
+            }
+            const isCurrentChat = receipt.group_id
+                ? receipt.group_id === currentGroupId
+                : receipt.user_id === currentChatUserId;
+            if (!isCurrentChat) return;
+            document.querySelectorAll('.chat-message.own-message').forEach(div => {
+                if (parseInt(div.dataset.messageId) <= receipt.last_read_message_id) {
+                    div.dataset.read = 'true';
+                }
+            });
+        }
+
+        // Присутствие: сервер присылает изменения пачкой, не чаще раза в пару секунд
+        function applyPresence(event) {
+            (event.online || []).forEach(userId => onlineUsers.add(userId));
+            (event.offline || []).forEach(userId => onlineUsers.delete(userId));
+            document.querySelectorAll('.group-item[data-is-group="false"]').forEach(item => {
+                item.classList.toggle('online', onlineUsers.has(parseInt(item.dataset.id)));
+            });
+            updateChatStatus();
+        }
+
+        // Набор текста: в личном чате приходит user_ids собеседника, в группе — все, кто печатает
+        function applyTyping(event) {
+            const key = event.group_id ? `g${event.group_id}` : `u${event.user_ids[0]}`;
+            const typists = typingUsers.get(key) || new Map();
+            const until = Date.now() + TYPING_SHOWN_MS;
+            event.user_ids.forEach((userId, index) => {
+                if (userId !== currentUserId) {
+                    typists.set(userId, { name: (event.usernames || [])[index], until });
+                }
+            });
+            typingUsers.set(key, typists);
+            updateChatStatus();
+        }
+
+        // Сообщение от пользователя означает, что он закончил печатать
+        function clearTyping(message) {
+            const typists = typingUsers.get(message.group_id ? `g${message.group_id}` : `u${message.sender_id}`);
+            if (typists && typists.delete(message.sender_id)) {
+                updateChatStatus();
+            }
+        }
+
+        function updateChatStatus() {
+            const statusEl = document.getElementById('chat-status');
+            if (!statusEl) return;
+            const now = Date.now();
+            const key = currentGroupId ? `g${currentGroupId}` : `u${currentChatUserId}`;
+            const typists = [...(typingUsers.get(key) || new Map()).values()].filter(typist => typist.until > now);
+            if (typists.length && currentGroupId) {
+                const names = typists.map(typist => typist.name).filter(Boolean);
+                statusEl.textContent = names.length > 2
+                    ? `${names.slice(0, 2).join(', ')} и ещё ${names.length - 2} печатают...`
+                    : `${names.join(', ')} ${names.length > 1 ? 'печатают' : 'печатает'}...`;
+            } else if (typists.length) {
+                statusEl.textContent = 'печатает...';
+            } else if (currentChatUserId && onlineUsers.has(currentChatUserId)) {
+                statusEl.textContent = 'в сети';
+            } else {
+                statusEl.textContent = '';
+            }
+            statusEl.classList.toggle('typing', typists.length > 0);
+        }
+
+        // Устаревшие индикаторы набора убираем сами: событие об окончании набора не приходит
+        setInterval(() => {
+            const now = Date.now();
+            let expired = false;
+            typingUsers.forEach(typists => typists.forEach((typist, userId) => {
+                if (typist.until <= now) {
+                    typists.delete(userId);
+                    expired = true;
+                }
+            }));
+            if (expired) updateChatStatus();
+        }, 1000);
+
+        // Сообщаем о наборе текста не чаще раза в TYPING_SEND_MS, сервер троттлит так же
+        if (messageInput) {
+            messageInput.addEventListener('input', () => {
+                if (!currentChatUserId && !currentGroupId) return;
+                if (!ws || ws.readyState !== WebSocket.OPEN || !messageInput.value) return;
+                const now = Date.now();
+                if (now - lastTypingSent < TYPING_SEND_MS) return;
+                lastTypingSent = now;
+                sendEvent({ action: 'typing', receiver_id: currentChatUserId, group_id: currentGroupId });
+            });
+        }
+
+        // Отправка события в том формате, о котором договорились при подключении
+        function sendEvent(event) {
+            ws.send(ws.protocol === WIRE_SUBPROTOCOL ? wirePack(event) : JSON.stringify(event));
+        }
+
+        // Обработка событий от сервера (WebSocket и результаты синхронизации)
+        function handleServerEvent(message) {
+            console.log('Получено WebSocket-сообщение:', message);
+
+            if (message.action === 'ping') {
+                // Сервер закрывает сессии, от которых давно ничего не приходило
+                if (ws && ws.readyState === WebSocket.OPEN) {
+                    sendEvent({ action: 'pong' });
+                }
+                return;
+            }
+
+            if (message.action === 'sync') {
+                applySync(message);
+                return;
+            }
+
+            if (message.action === 'read') {
+                applyReadReceipt(message);
+                return;
+            }
+
+            if (message.action === 'conversation_updated') {
+                applyConversationUpdate(message);
+                return;
+            }
+
+            if (message.action === 'presence') {
+                applyPresence(message);
+                return;
+            }
+
+            if (message.action === 'typing') {
+                applyTyping(message);
+                return;
+            }
+
+            // Проверяем наличие action и определяем тип сообщения
+            const isEditAction = message.action === 'edit';
+            const isDeleteAction = message.action === 'delete';
+            const isNewMessage = !message.action || message.action === 'create';
+
+            // Дополнительно логируем значения условий для отладки
+            console.log('Условия:', { isNewMessage, isEditAction, isDeleteAction });
+
+            // Список чатов и счётчики непрочитанных обновляет conversation_updated
+            if (isNewMessage) {
+                noteMessageSeen(message.id);
+                clearTyping(message);
+            }
+
+            // Обрабатываем сообщение только если оно относится к текущему чату
+            const isCurrentPrivateChat = !message.group_id && currentChatUserId !== null &&
+                (message.receiver_id === currentChatUserId || message.sender_id === currentChatUserId);
+            const isCurrentGroupChat = message.group_id && message.group_id === currentGroupId;
+            if (isCurrentPrivateChat || isCurrentGroupChat) {
+                if (isEditAction) {
+                    console.log('Обработка действия edit для сообщения:', message);
+                    const messageDiv = document.querySelector(`.chat-message[data-message-id="${message.message_id}"]`);
+                    if (messageDiv) {
+                        const contentText = messageDiv.querySelector('.content-text');
+                        if (contentText) {
+                            if (message.content) {
+                                contentText.textContent = message.content;
+                                contentText.style.display = 'block';
+                                console.log(`Сообщение с ID ${message.message_id} обновлено: ${message.content}`);
+                            } else {
+                                contentText.style.display = 'none';
+                                console.log(`Сообщение с ID ${message.message_id} обновлено: текст удалён`);
+                            }
+                        } else {
+                            console.warn(`Не найден .content-text для сообщения с ID ${message.message_id}`);
+                        }
+                    } else {
+                        console.warn(`Сообщение с ID ${message.message_id} не найдено в DOM`);
+                    }
+                } else if (isDeleteAction) {
+                    console.log('Обработка действия delete для сообщения:', message);
+                    const messageDiv = document.querySelector(`.chat-message[data-message-id="${message.message_id}"]`);
+                    if (messageDiv) {
+                        messageDiv.remove();
+                        console.log(`Сообщение с ID ${message.message_id} удалено`);
+                    } else {
+                        console.warn(`Сообщение с ID ${message.message_id} не найдено в DOM`);
+                    }
+                } else if (isNewMessage) {
+                    // Проверяем, не существует ли уже сообщение с таким ID
+                    const existingMessage = document.querySelector(`.chat-message[data-message-id="${message.id}"]`);
+                    if (existingMessage) {
+                        console.log(`Сообщение с ID ${message.id} уже отображено, обновляем его вместо добавления нового`);
+                        const contentText = existingMessage.querySelector('.content-text');
+                        if (contentText && message.content) {
+                            contentText.textContent = message.content;
+                        }
+                    } else {
+                        console.log('Отображаем новое сообщение:', message);
+                        displayMessage(message);
+                        updateUnreadDivider();
+                    }
+                } else {
+                    console.warn('Неизвестное действие:', message.action);
+                }
+            } else {
+                console.log('Сообщение не относится к текущему чату:', { receiver_id: message.receiver_id, group_id: message.group_id });
+            }
+        }
+
         // Инициализация WebSocket
         async function initWebSocket() {
             console.log('Инициализация WebSocket');
@@ -1505,110 +2058,35 @@ document.addEventListener('DOMContentLoaded', async () => {
                 }
                 const user = await response.json();
                 currentUserId = user.id;
-                ws = new WebSocket(`ws://${window.location.host}/ws/${user.id}`);
+                // Предлагаем бинарный протокол; если сервер его не выбрал, ws.protocol пуст и общаемся JSON.
+                // batch=1: сервер может присылать несколько событий одним кадром-массивом; token: без него сокет закрывается
+                ws = new WebSocket(`ws://${window.location.host}/ws/${user.id}?batch=1&token=${encodeURIComponent(token)}`, [WIRE_SUBPROTOCOL]);
+                ws.binaryType = 'arraybuffer';
                 // ws = new WebSocket(`ws://192.168.0.100:8000/ws/${userId}`);
 
                 ws.onopen = () => {
                     console.log('WebSocket соединение установлено');
+                    reconnectDelay = 1000;
+                    if (lastSeenMessageId > 0) {
+                        // Просим сервер дослать только пропущенное, без перезагрузки истории
+                        sendEvent({ action: 'resume', last_seen_id: lastSeenMessageId });
+                    }
                 };
 
                 ws.onmessage = (event) => {
-                    const message = JSON.parse(event.data);
-                    console.log('Получено WebSocket-сообщение:', message);
-                
-                    // Проверяем наличие action и определяем тип сообщения
-                    const isEditAction = message.action === 'edit';
-                    const isDeleteAction = message.action === 'delete';
-                    const isNewMessage = !message.action || message.action === 'create';
-                
-                    // Дополнительно логируем значения условий для отладки
-                    console.log('Условия:', { isNewMessage, isEditAction, isDeleteAction });
-                
-                    // Обновляем счётчик непрочитанных сообщений только для новых сообщений
-                    if (isNewMessage && message.sender_id !== currentUserId && !message.is_read) {
-                        const senderId = message.sender_id;
-                        const groupId = message.group_id;
-                        if (groupId) {
-                            if (groupId !== currentGroupId) {
-                                const chatItem = document.querySelector(`.group-item[data-id="${groupId}"][data-is-group="true"]`);
-                                let currentCount = 0;
-                                if (chatItem) {
-                                    const counter = chatItem.querySelector('.unread-count');
-                                    currentCount = counter ? parseInt(counter.textContent) : 0;
-                                }
-                                updateUnreadCount(groupId, true, currentCount + 1);
-                            }
-                            addChatToList(null, groupId, message.username, message.avatar_url, 0, true);
-                        } else {
-                            if (senderId !== currentChatUserId) {
-                                const chatItem = document.querySelector(`.group-item[data-id="${senderId}"][data-is-group="false"]`);
-                                let currentCount = 0;
-                                if (chatItem) {
-                                    const counter = chatItem.querySelector('.unread-count');
-                                    currentCount = counter ? parseInt(counter.textContent) : 0;
-                                }
-                                updateUnreadCount(senderId, false, currentCount + 1);
-                            }
-                            addChatToList(senderId, null, message.username, message.avatar_url, 0, false);
-                        }
-                    }
-                
-                    // Обрабатываем сообщение только если оно относится к текущему чату
-                    if ((message.receiver_id === currentChatUserId && !message.group_id) || message.group_id === currentGroupId) {
-                        if (isEditAction) {
-                            console.log('Обработка действия edit для сообщения:', message);
-                            const messageDiv = document.querySelector(`.chat-message[data-message-id="${message.message_id}"]`);
-                            if (messageDiv) {
-                                const contentText = messageDiv.querySelector('.content-text');
-                                if (contentText) {
-                                    if (message.content) {
-                                        contentText.textContent = message.content;
-                                        contentText.style.display = 'block';
-                                        console.log(`Сообщение с ID ${message.message_id} обновлено: ${message.content}`);
-                                    } else {
-                                        contentText.style.display = 'none';
-                                        console.log(`Сообщение с ID ${message.message_id} обновлено: текст удалён`);
-                                    }
-                                } else {
-                                    console.warn(`Не найден .content-text для сообщения с ID ${message.message_id}`);
-                                }
-                            } else {
-                                console.warn(`Сообщение с ID ${message.message_id} не найдено в DOM`);
-                            }
-                        } else if (isDeleteAction) {
-                            console.log('Обработка действия delete для сообщения:', message);
-                            const messageDiv = document.querySelector(`.chat-message[data-message-id="${message.message_id}"]`);
-                            if (messageDiv) {
-                                messageDiv.remove();
-                                console.log(`Сообщение с ID ${message.message_id} удалено`);
-                            } else {
-                                console.warn(`Сообщение с ID ${message.message_id} не найдено в DOM`);
-                            }
-                        } else if (isNewMessage) {
-                            // Проверяем, не существует ли уже сообщение с таким ID
-                            const existingMessage = document.querySelector(`.chat-message[data-message-id="${message.id}"]`);
-                            if (existingMessage) {
-                                console.log(`Сообщение с ID ${message.id} уже отображено, обновляем его вместо добавления нового`);
-                                const contentText = existingMessage.querySelector('.content-text');
-                                if (contentText && message.content) {
-                                    contentText.textContent = message.content;
-                                }
-                            } else {
-                                console.log('Отображаем новое сообщение:', message);
-                                displayMessage(message);
-                                updateUnreadDivider();
-                            }
-                        } else {
-                            console.warn('Неизвестное действие:', message.action);
-                        }
+                    const message = typeof event.data === 'string' ? JSON.parse(event.data) : wireUnpack(event.data);
+                    if (Array.isArray(message)) {
+                        message.forEach(handleServerEvent);
                     } else {
-                        console.log('Сообщение не относится к текущему чату:', { receiver_id: message.receiver_id, group_id: message.group_id });
+                        handleServerEvent(message);
                     }
                 };
 
                 ws.onclose = () => {
                     console.log('WebSocket соединение закрыто');
-                    showFlashMessage('WebSocket отключен, обновите страницу', 'warning');
+                    showFlashMessage('Соединение потеряно, переподключаемся...', 'warning');
+                    setTimeout(initWebSocket, reconnectDelay);
+                    reconnectDelay = Math.min(reconnectDelay * 2, 30000);
                 };
 
                 ws.onerror = (error) => {
@@ -1621,11 +2099,21 @@ document.addEventListener('DOMContentLoaded', async () => {
             }
         }
 
-        // Загрузка сообщений
+        function messagesUrl(userId, groupId, params) {
+            const base = groupId ? `/messages/group/${groupId}` : `/messages/${userId}`;
+            return `${base}?${new URLSearchParams({ ...params, compact: true })}`;
+        }
+
+        // История приходит в компактном виде: профиль каждого отправителя один раз в users
+        function expandMessages(page) {
+            return page.messages.map(message => ({ ...message, ...page.users[message.sender_id] }));
+        }
+
+        // Загрузка сообщений (только последняя страница, остальное подгружается при прокрутке вверх)
         async function loadMessages(userId, groupId) {
             console.log('Загружаю сообщения для:', { userId, groupId });
             try {
-                const url = groupId ? `/messages/group/${groupId}` : `/messages/${userId}`;
+                const url = messagesUrl(userId, groupId, { limit: MESSAGES_PAGE_SIZE });
                 const response = await fetch(url, {
                     headers: { 'Authorization': `Bearer ${token}` }
                 });
@@ -1633,11 +2121,16 @@ document.addEventListener('DOMContentLoaded', async () => {
                     const errorText = await response.text();
                     throw new Error(`Не удалось загрузить сообщения: ${response.status} (${errorText})`);
                 }
-                const messages = await response.json();
+                const messages = expandMessages(await response.json());
                 console.log('Загружены сообщения:', messages); // Логируем загруженные сообщения
                 chatMessages.innerHTML = '';
                 lastMessageDate = null;
-                messages.forEach(displayMessage);
+                oldestLoadedMessageId = messages.length > 0 ? messages[0].id : null;
+                hasMoreHistory = messages.length === MESSAGES_PAGE_SIZE;
+                if (messages.length > 0) {
+                    noteMessageSeen(messages[messages.length - 1].id);
+                }
+                messages.forEach(message => displayMessage(message));
                 const firstUnreadMessage = chatMessages.querySelector('.chat-message:not(.own-message):not([data-read="true"])');
                 if (firstUnreadMessage) {
                     firstUnreadMessage.scrollIntoView({ behavior: 'smooth', block: 'center' });
@@ -1651,8 +2144,54 @@ document.addEventListener('DOMContentLoaded', async () => {
             }
         }
 
+        // Подгрузка предыдущей страницы истории при прокрутке к началу чата
+        async function loadOlderMessages() {
+            if (isLoadingHistory || !hasMoreHistory || !oldestLoadedMessageId) return;
+            isLoadingHistory = true;
+            const userId = currentChatUserId;
+            const groupId = currentGroupId;
+            try {
+                const url = messagesUrl(userId, groupId, { before_id: oldestLoadedMessageId, limit: MESSAGES_PAGE_SIZE });
+                const response = await fetch(url, {
+                    headers: { 'Authorization': `Bearer ${token}` }
+                });
+                if (!response.ok) {
+                    const errorText = await response.text();
+                    throw new Error(`Не удалось загрузить сообщения: ${response.status} (${errorText})`);
+                }
+                const messages = expandMessages(await response.json());
+                if (userId !== currentChatUserId || groupId !== currentGroupId) return; // Чат сменился во время загрузки
+                hasMoreHistory = messages.length === MESSAGES_PAGE_SIZE;
+                if (messages.length === 0) return;
+                oldestLoadedMessageId = messages[0].id;
+
+                // Рендерим страницу отдельно, чтобы разделители дат считались от её начала
+                const fragment = document.createDocumentFragment();
+                const newestMessageDate = lastMessageDate;
+                lastMessageDate = null;
+                messages.forEach(message => displayMessage(message, fragment));
+                const pageLastDate = lastMessageDate;
+                lastMessageDate = newestMessageDate;
+
+                // Если страница заканчивается тем же днём, с которого начинался чат, убираем дублирующий разделитель
+                const firstChild = chatMessages.firstElementChild;
+                if (firstChild && firstChild.classList.contains('date-divider') && firstChild.dataset.date === pageLastDate) {
+                    firstChild.remove();
+                }
+
+                const previousHeight = chatMessages.scrollHeight;
+                chatMessages.insertBefore(fragment, chatMessages.firstChild);
+                chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+            } catch (error) {
+                console.error('Ошибка загрузки истории сообщений:', error);
+                showFlashMessage(`Не удалось загрузить сообщения: ${error.message}`, 'danger');
+            } finally {
+                isLoadingHistory = false;
+            }
+        }
+
         // Отображение сообщения
-        function displayMessage(message) {
+        function displayMessage(message, container = chatMessages) {
             if (message.action === 'edit' || message.action === 'delete') {
                 console.warn('displayMessage вызвана для сообщения с action:', message.action, '— игнорируем');
                 return;
@@ -1667,7 +2206,8 @@ document.addEventListener('DOMContentLoaded', async () => {
                 const divider = document.createElement('div');
                 divider.className = 'date-divider';
                 divider.textContent = formatDateToRussian(messageDate);
-                chatMessages.appendChild(divider);
+                divider.dataset.date = messageDateString;
+                container.appendChild(divider);
                 lastMessageDate = messageDateString;
             }
         
@@ -1681,7 +2221,7 @@ document.addEventListener('DOMContentLoaded', async () => {
             avatarDiv.className = 'message-avatar';
             if (message.avatar_url) {
                 const avatarImg = document.createElement('img');
-                avatarImg.src = message.avatar_url;
+                avatarImg.src = mediaVariantUrl(message.avatar_url, 48);
                 avatarImg.alt = message.username;
                 avatarDiv.appendChild(avatarImg);
             } else {
@@ -1716,7 +2256,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                     if (file.file_type === 'image') {
                         mediaContent += `
                             <a class="media-link" data-media-url="${file.file_url}" data-media-type="image">
-                                <img src="${file.file_url}" alt="Image" class="preview-image-sent">
+                                ${imagePreviewHtml(file)}
                             </a>`;
                     } else if (file.file_type === 'video') {
                         mediaContent += `
@@ -1727,9 +2267,10 @@ document.addEventListener('DOMContentLoaded', async () => {
                                 </video>
                             </a>`;
                     } else if (file.file_type === 'file') {
-                        const fileName = file.file_url.split('/').pop();
+                        // Файлы хранятся под хэшем содержимого, исходное имя приходит отдельно
+                        const fileName = escapeHtml(file.file_name || file.file_url.split('/').pop());
                         mediaContent += `
-                            <a href="${file.file_url}" class="file-link" download>
+                            <a href="${file.file_url}" class="file-link" download="${fileName}">
                                 <svg viewBox="0 0 24 24" fill="none" stroke="#fff" stroke-width="2">
                                     <path d="M12 12v9m0 0l-4-4m4 4l4-4m-9-5V5a2 2 0 012-2h4a2 2 0 012 2v6" stroke-linecap="round" stroke-linejoin="round"/>
                                 </svg>
@@ -1826,13 +2367,13 @@ document.addEventListener('DOMContentLoaded', async () => {
                                         } else {
                                             contentText.style.display = 'none';
                                         }
-                                        ws.send(JSON.stringify({
+                                        sendEvent({
                                             action: 'edit',
                                             message_id: message.id,
                                             content: newContent || null,
                                             receiver_id: currentChatUserId,
                                             group_id: currentGroupId
-                                        }));
+                                        });
                                     } else {
                                         showFlashMessage(result.detail, 'danger');
                                         if (originalContent) {
@@ -1877,12 +2418,12 @@ document.addEventListener('DOMContentLoaded', async () => {
                                 const result = await response.json();
                                 if (response.ok) {
                                     div.remove();
-                                    ws.send(JSON.stringify({
+                                    sendEvent({
                                         action: 'delete',
                                         message_id: message.id,
                                         receiver_id: currentChatUserId,
                                         group_id: currentGroupId
-                                    }));
+                                    });
                                 } else {
                                     showFlashMessage(result.detail, 'danger');
                                 }
@@ -1953,8 +2494,10 @@ document.addEventListener('DOMContentLoaded', async () => {
                 div.appendChild(contentDiv);
             }
 
-            chatMessages.appendChild(div);
-            chatMessages.scrollTop = chatMessages.scrollHeight;
+            container.appendChild(div);
+            if (container === chatMessages) {
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            }
         }
         
         function updatePreview() {
@@ -2096,6 +2639,9 @@ document.addEventListener('DOMContentLoaded', async () => {
             if (currentChatUserId || currentGroupId) {
                 hasInteracted = true;
                 updateUnreadDivider();
+                if (chatMessages.scrollTop < 100) {
+                    loadOlderMessages();
+                }
             }
         });
 
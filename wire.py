@@ -0,0 +1,165 @@
+import struct
+
+# Binary WebSocket frames for clients that ask for the SUBPROTOCOL: MessagePack, except that map keys
+# listed in KEYS travel as their index (one byte) instead of the string. Keys not in the table are sent
+# as strings, so new fields work before the table learns about them. static/script.js carries the same
+# table; any change to it needs a new subprotocol version.
+
+SUBPROTOCOL = "chat.msgpack.v1"
+
+KEYS = (
+    "action", "id", "message_id", "content", "timestamp", "sender_id", "receiver_id", "group_id",
+    "username", "avatar_url", "is_read", "files", "file_url", "file_type", "file_name", "thumbnails",
+    "placeholder", "user_id", "last_read_message_id", "last_seen_id", "messages", "changes", "has_more",
+    "last_message_id", "edited", "deleted",
+)
+KEY_INDEX = {key: index for index, key in enumerate(KEYS)}
+
+def pack(obj) -> bytes:
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+def _pack(obj, out: bytearray):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -0x20 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xffffffff:
+            out += struct.pack(">BI", 0xce, obj)
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out += struct.pack(">BQ", 0xcf, obj)
+        elif -0x80000000 <= obj < 0:
+            out += struct.pack(">Bi", 0xd2, obj)
+        else:
+            out += struct.pack(">Bq", 0xd3, obj)
+    elif isinstance(obj, float):
+        out += struct.pack(">Bd", 0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        size = len(data)
+        if size < 0x20:
+            out.append(0xa0 | size)
+        elif size <= 0xff:
+            out += struct.pack(">BB", 0xd9, size)
+        elif size <= 0xffff:
+            out += struct.pack(">BH", 0xda, size)
+        else:
+            out += struct.pack(">BI", 0xdb, size)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        size = len(obj)
+        if size <= 0xff:
+            out += struct.pack(">BB", 0xc4, size)
+        elif size <= 0xffff:
+            out += struct.pack(">BH", 0xc5, size)
+        else:
+            out += struct.pack(">BI", 0xc6, size)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        out += array_header(len(obj))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        size = len(obj)
+        if size < 0x10:
+            out.append(0x80 | size)
+        elif size <= 0xffff:
+            out += struct.pack(">BH", 0xde, size)
+        else:
+            out += struct.pack(">BI", 0xdf, size)
+        for key, value in obj.items():
+            if not isinstance(key, str):
+                raise TypeError("Map keys must be strings")
+            _pack(KEY_INDEX.get(key, key), out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"Cannot pack {type(obj).__name__}")
+
+def array_header(size: int) -> bytes:
+    # Lets already packed values be sent as one array: array_header(len(items)) + b"".join(items)
+    if size < 0x10:
+        return bytes((0x90 | size,))
+    if size <= 0xffff:
+        return struct.pack(">BH", 0xdc, size)
+    return struct.pack(">BI", 0xdd, size)
+
+def unpack(data: bytes):
+    # Raises ValueError on anything that is not exactly one well-formed value
+    try:
+        obj, offset = _unpack(memoryview(data), 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed frame: {e}") from None
+    if offset != len(data):
+        raise ValueError("Trailing bytes after frame")
+    return obj
+
+# Fixed-size formats: type byte -> (struct format, size)
+_FIXED = {
+    0xca: (">f", 4), 0xcb: (">d", 8),
+    0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+    0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8),
+}
+# Variable-size formats: type byte -> format of the length that follows
+_STR = {0xd9: ">B", 0xda: ">H", 0xdb: ">I"}
+_BIN = {0xc4: ">B", 0xc5: ">H", 0xc6: ">I"}
+_ARRAY = {0xdc: ">H", 0xdd: ">I"}
+_MAP = {0xde: ">H", 0xdf: ">I"}
+
+def _length(data, offset: int, fmt: str):
+    return struct.unpack_from(fmt, data, offset)[0], offset + struct.calcsize(fmt)
+
+def _unpack(data, offset: int):
+    byte = data[offset]
+    offset += 1
+    if byte < 0x80:
+        return byte, offset
+    if byte >= 0xe0:
+        return byte - 0x100, offset
+    if byte == 0xc0:
+        return None, offset
+    if byte == 0xc2:
+        return False, offset
+    if byte == 0xc3:
+        return True, offset
+    if byte in _FIXED:
+        fmt, size = _FIXED[byte]
+        return struct.unpack_from(fmt, data, offset)[0], offset + size
+
+    if 0xa0 <= byte <= 0xbf or byte in _STR:
+        size, offset = (byte & 0x1f, offset) if byte <= 0xbf else _length(data, offset, _STR[byte])
+        if offset + size > len(data):
+            raise IndexError("string runs past the end")
+        return str(data[offset:offset + size], "utf-8"), offset + size
+    if byte in _BIN:
+        size, offset = _length(data, offset, _BIN[byte])
+        if offset + size > len(data):
+            raise IndexError("bytes run past the end")
+        return bytes(data[offset:offset + size]), offset + size
+
+    if 0x90 <= byte <= 0x9f or byte in _ARRAY:
+        size, offset = (byte & 0x0f, offset) if byte <= 0x9f else _length(data, offset, _ARRAY[byte])
+        items = []
+        for _ in range(size):
+            item, offset = _unpack(data, offset)
+            items.append(item)
+        return items, offset
+    if 0x80 <= byte <= 0x8f or byte in _MAP:
+        size, offset = (byte & 0x0f, offset) if byte <= 0x8f else _length(data, offset, _MAP[byte])
+        result = {}
+        for _ in range(size):
+            key, offset = _unpack(data, offset)
+            if isinstance(key, int) and 0 <= key < len(KEYS):
+                key = KEYS[key]
+            elif not isinstance(key, str):
+                raise ValueError("Map keys must be strings or key indexes")
+            result[key], offset = _unpack(data, offset)
+        return result, offset
+    raise ValueError(f"Unsupported type byte 0x{byte:02x}")
@@ -0,0 +1,49 @@
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from websockets.frames import Opcode
+from websockets.legacy.framing import Frame
+
+import main
+
+# The server side of the WebSocket, for uvicorn's ws= setting. It subclasses uvicorn's websockets
+# implementation and uses the legacy websockets framing, neither of which is public API, so it lives
+# apart from the app: main.py never imports it and runs under any server, only run.py (and bench_ws.py)
+# hand it to uvicorn. Pinned uvicorn and websockets versions keep it working.
+
+class TunedWebSocketProtocol(WebSocketProtocol):
+    # uvicorn's websockets protocol with the WS_DEFLATE_* settings instead of the library defaults, and
+    # counting what goes out for ws_stats: payload bytes of data frames and the bytes actually written
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.available_extensions = [
+            ServerPerMessageDeflateFactory(
+                server_max_window_bits=main.WS_DEFLATE_SERVER_WINDOW_BITS,
+                client_max_window_bits=main.WS_DEFLATE_CLIENT_WINDOW_BITS,
+                compress_settings={"memLevel": main.WS_DEFLATE_MEM_LEVEL, "level": main.WS_DEFLATE_LEVEL},
+            )
+        ] if main.WS_DEFLATE else []
+        self.written = 0
+        self.counted_deflate = False
+
+    def _write_counted(self, data: bytes):
+        self.written += len(data)
+        self.transport.write(data)
+
+    def write_frame_sync(self, fin: bool, opcode: int, data: bytes):
+        # Same as the base class, with the transport write going through the counter
+        if self.extensions and not self.counted_deflate:
+            self.counted_deflate = True
+            main.ws_stats.deflate_sessions += 1
+        frame = Frame(fin, Opcode(opcode), data)
+        if self.debug:
+            self.logger.debug("> %s", frame)
+        self.written = 0
+        frame.write(self._write_counted, mask=False, extensions=self.extensions)
+        if opcode in (Opcode.TEXT, Opcode.BINARY, Opcode.CONT):
+            main.ws_stats.record_wire(len(data), self.written)
+
+    def connection_lost(self, exc):
+        if self.counted_deflate:
+            main.ws_stats.deflate_sessions -= 1
+            self.counted_deflate = False
+        super().connection_lost(exc)